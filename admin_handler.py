@@ -1,13 +1,24 @@
+import os
 import json
+import hashlib
 from datetime import datetime
+from storage import save_json, SnapshotStore
+
+def plan_key(plan_id):
+    """Short stable id of a plan for callback_data, whatever the length of the plan id"""
+    return hashlib.sha1(str(plan_id).encode()).hexdigest()[:8]
 
 class AdminPanel:
-    def __init__(self, db_file='admin.json'):
+    def __init__(self, db_file='admin.json', read_only=False):
+        """`read_only` replicas never write and pick up changes with reload_if_changed"""
         self.db_file = db_file
+        self.read_only = read_only
+        self._mtime = None
         self._load_db()
 
     def _load_db(self):
         try:
+            self._mtime = os.stat(self.db_file).st_mtime_ns
             with open(self.db_file, 'r') as f:
                 self.db = json.load(f)
         except FileNotFoundError:
@@ -18,14 +29,27 @@ class AdminPanel:
                     'allow_registration': True,
                     'maintenance_mode': False,
                     'backup_enabled': True,
-                    'backup_frequency': 'daily'
+                    'backup_frequency': 'daily',
+                    'backup_retention_days': 30
                 }
             }
-            self._save_db()
+            if not self.read_only:
+                self._save_db()
 
     def _save_db(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.db, f, indent=2)
+        if self.read_only:
+            raise PermissionError(f"{self.db_file} is read-only in this process")
+        save_json(self.db_file, self.db)
+        self._mtime = os.stat(self.db_file).st_mtime_ns
+
+    def reload_if_changed(self):
+        try:
+            changed = os.stat(self.db_file).st_mtime_ns != self._mtime
+        except FileNotFoundError:
+            return False
+        if changed:
+            self._load_db()
+        return changed
 
     def is_admin(self, user_id):
         return str(user_id) in self.db['admins']
@@ -58,6 +82,15 @@ class AdminPanel:
     def get_plans(self):
         return self.db['plans']
 
+    def find_plan(self, key):
+        """The plan id behind a `plan_key`; older buttons carry the plan id itself"""
+        if key in self.db['plans']:
+            return key
+        for plan_id in self.db['plans']:
+            if plan_key(plan_id) == key:
+                return plan_id
+        return None
+
     def update_settings(self, settings):
         self.db['settings'].update(settings)
         self._save_db()
@@ -65,10 +98,11 @@ class AdminPanel:
     def get_settings(self):
         return self.db['settings']
 
-class UserManager:
+class UserManager(SnapshotStore):
     def __init__(self, db_file='users.json'):
         self.db_file = db_file
-        self._load_db()
+        if not self._load_snapshot():
+            self._load_db()
 
     def _load_db(self):
         try:
@@ -77,10 +111,19 @@ class UserManager:
         except FileNotFoundError:
             self.db = {'users': {}}
             self._save_db()
+        self._rebuild_stats()
+
+    def _rebuild_stats(self):
+        self._total = len(self.db['users'])
+        self._active = sum(1 for user in self.db['users'].values() if user.get('active', True))
+
+    def _count_user(self, user, delta):
+        self._total += delta
+        if user.get('active', True):
+            self._active += delta
 
     def _save_db(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.db, f, indent=2)
+        save_json(self.db_file, self.db)
 
     def register_user(self, user_id, username, first_name, last_name=None):
         user_data = {
@@ -91,7 +134,11 @@ class UserManager:
             'hosting_accounts': [],
             'active': True
         }
+        previous = self.db['users'].get(str(user_id))
+        if previous:
+            self._count_user(previous, -1)
         self.db['users'][str(user_id)] = user_data
+        self._count_user(user_data, 1)
         self._save_db()
         return user_data
 
@@ -100,7 +147,10 @@ class UserManager:
 
     def update_user(self, user_id, data):
         if str(user_id) in self.db['users']:
-            self.db['users'][str(user_id)].update(data)
+            user = self.db['users'][str(user_id)]
+            self._count_user(user, -1)
+            user.update(data)
+            self._count_user(user, 1)
             self._save_db()
             return self.db['users'][str(user_id)]
         return None
@@ -119,15 +169,15 @@ class UserManager:
         return {k: v for k, v in self.db['users'].items() if v.get('active', True)}
 
     def deactivate_user(self, user_id):
-        if str(user_id) in self.db['users']:
-            self.db['users'][str(user_id)]['active'] = False
-            self._save_db()
-            return True
-        return False
+        return self.update_user(user_id, {'active': False}) is not None
 
     def activate_user(self, user_id):
-        if str(user_id) in self.db['users']:
-            self.db['users'][str(user_id)]['active'] = True
-            self._save_db()
-            return True
-        return False
+        return self.update_user(user_id, {'active': True}) is not None
+
+    def get_stats(self):
+        """User counts, maintained by the mutators instead of scanning users"""
+        return {
+            'total': self._total,
+            'active': self._active,
+            'inactive': self._total - self._active
+        }
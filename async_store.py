@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import functools
+
+from storage import LazyStore
+
+logger = logging.getLogger(__name__)
+
+_FLUSH = object()
+
+
+class AsyncStore:
+    """Async facade over a JSON store that keeps disk and network off the event loop.
+
+    Reads are plain attribute access on the store and are served from
+    memory. Writes go through a queue drained by a single writer task, so
+    each store sees one write at a time:
+
+    - `writes` only touch memory and run on the loop,
+    - `blocking_writes` also call DirectAdmin and run in `executor`,
+    - `blocking_reads` call DirectAdmin without changing the store and run
+      in `executor` directly.
+
+    While started, the store's ``_save_db`` only marks it dirty. The writer
+    then saves once per batch of writes, in `executor`. No queued write is
+    applied while a save serializes the store, and a write's result is
+    returned once it is on disk. That only holds for writes made through
+    the facade: calling the store's methods directly, e.g. from a thread,
+    can change it while it is being saved, so every writer, schedulers
+    included, must go through the facade.
+    """
+
+    def __init__(self, store, writes=(), blocking_writes=(), blocking_reads=(), defer_saves=True):
+        self._source = store
+        self._writes = set(writes) | set(blocking_writes)
+        self._blocking = set(blocking_writes) | set(blocking_reads)
+        self._defer_saves = defer_saves
+        self._store = None
+        self._queue = None
+        self._task = None
+        self._executor = None
+        self._loop = None
+        self._dirty = False
+        self._flush_scheduled = False
+
+    def __getattr__(self, name):
+        if name in self._writes:
+            return functools.partial(self._submit, name)
+        if name in self._blocking:
+            return functools.partial(self._run_blocking, name)
+        return getattr(self._source, name)
+
+    def start(self, executor):
+        self._store = self._source.wait() if isinstance(self._source, LazyStore) else self._source
+        self._executor = executor
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        if self._defer_saves:
+            # Instance attribute, shadows the class method until stop()
+            self._store._save_db = self._mark_dirty
+        self._task = asyncio.create_task(self._run_writer())
+
+    async def stop(self):
+        """Apply queued writes, save and restore synchronous saves"""
+        if self._task is None:
+            return
+        done = self._loop.create_future()
+        self._queue.put_nowait((_FLUSH, None, None, done))
+        await done
+        self._task.cancel()
+        self._task = None
+        if self._defer_saves:
+            del self._store._save_db
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            # Saves may be requested from worker threads too
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (_FLUSH, None, None, None))
+
+    async def _submit(self, name, *args, **kwargs):
+        future = self._loop.create_future()
+        self._queue.put_nowait((name, args, kwargs, future))
+        return await future
+
+    async def _run_blocking(self, name, *args, **kwargs):
+        method = getattr(self._store, name)
+        return await self._loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    async def _run_writer(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            results = []
+            for name, args, kwargs, future in batch:
+                if name is _FLUSH:
+                    results.append((future, None, None))
+                    continue
+                method = getattr(self._store, name)
+                try:
+                    if name in self._blocking:
+                        result = await self._loop.run_in_executor(
+                            self._executor, functools.partial(method, *args, **kwargs)
+                        )
+                    else:
+                        result = method(*args, **kwargs)
+                    results.append((future, result, None))
+                except Exception as e:
+                    results.append((future, None, e))
+
+            self._flush_scheduled = False
+            if self._dirty:
+                self._dirty = False
+                try:
+                    await self._loop.run_in_executor(self._executor, type(self._store)._save_db, self._store)
+                except Exception as e:
+                    # Memory is ahead of the disk until the next successful save
+                    logger.error(f"Failed to save {self._store.db_file}, retrying: {e}")
+                    self._loop.call_later(5, self._mark_dirty)
+
+            for future, result, error in results:
+                if future is None or future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta
+
+from deadline_queue import DeadlineScheduler
+from hosting_handler import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+
+class BackupScheduler(DeadlineScheduler):
+    """Spread automated backups over a nightly window.
+
+    Each account gets a fixed slot inside the window derived from a hash of
+    its username, so the slot is stable across restarts and accounts are
+    spread evenly instead of all starting at once. For weekly and monthly
+    frequencies the hash also picks the weekday or day of month. At most
+    `max_concurrent` backups run per DirectAdmin server; a backup holds its
+    slot until its file appears on the server or `timeout` passes. Backups
+    are created and updated through `async_hosting`, the store's
+    `AsyncStore` facade.
+    """
+
+    job_name = 'backup_scheduler'
+
+    def __init__(self, hosting_manager, async_hosting, admin_panel, window_start=2, window_hours=4,
+                 max_concurrent=2, poll_interval=60, timeout=7200):
+        super().__init__()
+        self.hosting_manager = hosting_manager
+        self.async_hosting = async_hosting
+        self.admin_panel = admin_panel
+        self.window_start = window_start
+        self.window_seconds = window_hours * 3600
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._semaphores = {}
+        self._tasks = set()
+        hosting_manager.add_account_listener(self.track)
+        self.rebuild()
+
+    def _hash(self, username):
+        return int(hashlib.sha1(username.encode()).hexdigest(), 16)
+
+    def _runs_on(self, day, frequency, digest):
+        if frequency == 'weekly':
+            return day.weekday() == (digest >> 32) % 7
+        if frequency == 'monthly':
+            return day.day == (digest >> 32) % 28 + 1
+        return True
+
+    def next_slot(self, username, after=None):
+        after = after or datetime.now()
+        frequency = self.admin_panel.get_settings().get('backup_frequency', 'daily')
+        digest = self._hash(username)
+        offset = timedelta(hours=self.window_start, seconds=digest % self.window_seconds)
+        day = datetime.combine(after.date(), datetime.min.time())
+        for _ in range(62):
+            slot = day + offset
+            if slot > after and self._runs_on(day, frequency, digest):
+                return slot.timestamp()
+            day += timedelta(days=1)
+        return (after + timedelta(days=1)).timestamp()
+
+    def rebuild(self):
+        """Recompute every slot, e.g. after backup_frequency changed"""
+        for account in self.hosting_manager.get_active_accounts():
+            self.schedule(account['username'], self.next_slot(account['username']))
+
+    def track(self, account):
+        if account['status'] != 'active':
+            self.unschedule(account['username'])
+        elif account['username'] not in self.queue:
+            self.schedule(account['username'], self.next_slot(account['username']))
+
+    def _semaphore(self, server):
+        if server not in self._semaphores:
+            self._semaphores[server] = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphores[server]
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def process_due(self, usernames, context):
+        enabled = self.admin_panel.get_settings()['backup_enabled']
+        for username in usernames:
+            if enabled:
+                self._spawn(self._backup(username))
+            self.queue.push(username, self.next_slot(username, after=datetime.now() + timedelta(minutes=1)))
+
+    async def _backup(self, username):
+        account = self.hosting_manager.get_account(username)
+        if not account or account['status'] != 'active':
+            return
+        server = account.get('server', self.hosting_manager.da_handler.url)
+        async with self._semaphore(server):
+            result = await self.async_hosting.create_backup(username)
+            if result['status'] != 'success':
+                logger.error(f"Automated backup of {username} failed: {result['message']}")
+                return
+            await self._wait_for_completion(result['backup'])
+
+    async def _wait_for_completion(self, backup):
+        deadline = parse_datetime(backup['created_at']).timestamp() + self.timeout
+        while backup['status'] == 'queued':
+            if time.time() > deadline:
+                logger.error(f"Backup #{backup['backup_id']} of {backup['username']} timed out")
+                await self.async_hosting.update_backup(backup['backup_id'], status='failed')
+                return
+            await asyncio.sleep(self.poll_interval)
+            await self.async_hosting.check_backup(backup['backup_id'])
+
+    def watch(self, backup):
+        """Track completion of a backup started outside the scheduler"""
+        return self._spawn(self._wait_for_completion(backup))
+
+    def start(self, job_queue):
+        super().start(job_queue)
+        for backup in self.hosting_manager.get_pending_backups():
+            self.watch(backup)
+
+    async def stop_all(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,339 @@
+"""Replay scripted customer journeys through the real bot handlers.
+
+Runs bot.py's Application in-process against a fake Bot API and local
+stub DirectAdmin and Zarinpal servers, each with configurable latency.
+Every virtual user goes through /start, the plan list, a purchase up to
+the payment link, the resource usage page and a new ticket; virtual
+admins claim and answer the tickets as they come in.
+
+A step is timed from the moment its update is queued until the
+Application has finished processing it, so time spent waiting behind
+other users' updates counts. Reports throughput, p50/p95/p99 per step
+and how long the event loop was blocked.
+
+Usage: python benchmarks/load_test.py [--users N] [--concurrency N] ...
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+FIRST_USER_ID = 100000
+PLAN_ID = 'basic'
+
+
+class FakeBotAPI(BaseRequest):
+    """Answer Bot API calls in-process after `latency` seconds"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, data):
+        chat_id = int(data.get('chat_id', 0))
+        return {
+            'message_id': int(data.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': data.get('text', '')
+        }
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Load Test', 'username': 'load_test_bot'}
+        elif endpoint in ('sendMessage', 'sendDocument', 'editMessageText'):
+            result = self._message(data)
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class StubServer:
+    """Local HTTP server answering every request with `respond(path)` after `latency`"""
+
+    def __init__(self, respond, latency=0.0):
+        self.respond = respond
+        self.latency = latency
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.requests += 1
+                time.sleep(stub.latency)
+                body = stub.respond(self.path).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _reply
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def directadmin_response(path):
+    if path.startswith('/CMD_API_SHOW_USER_USAGE'):
+        return 'quota=512&bandwidth=2048'
+    return 'error=0&text=ok'
+
+
+def zarinpal_response(path):
+    if path.endswith('/request'):
+        return json.dumps({'data': {'code': 100, 'authority': f'A{time.time_ns():035d}'}})
+    return json.dumps({'data': {'code': 100, 'ref_id': 1}})
+
+
+def seed(directory, users, admins):
+    """Write a catalog with one plan and give every user one hosting account"""
+    now = datetime.now()
+    data = {
+        'admin.json': {
+            'admins': [str(admin_id) for admin_id in admins],
+            'plans': {PLAN_ID: {'name': 'پایه', 'price': 150000, 'quota': 1024, 'bandwidth': 10240}},
+            'settings': {'allow_registration': True, 'maintenance_mode': False, 'backup_enabled': False,
+                         'backup_frequency': 'daily', 'backup_retention_days': 30}
+        },
+        'hosting.json': {'accounts': [
+            {
+                'user_id': FIRST_USER_ID + i, 'username': f'acct{i}', 'domain': f'site{i}.ir',
+                'email': f'user{i}@example.com', 'package': PLAN_ID, 'created_at': now.isoformat(),
+                'status': 'active', 'expiry_date': (now + timedelta(days=365)).isoformat()
+            } for i in range(users)
+        ], 'backups': {}, 'databases': []},
+    }
+    for name, content in data.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(content, f)
+
+
+class Driver:
+    """Feed updates into the Application and time each one until it is processed"""
+
+    def __init__(self, application):
+        self.application = application
+        self.samples = {}
+        self._update_ids = itertools.count(1)
+        self._waiting = {}
+        process_update = application.process_update
+
+        async def tracked(update):
+            try:
+                await process_update(update)
+            finally:
+                waiter = self._waiting.pop(getattr(update, 'update_id', None), None)
+                if waiter:
+                    waiter.set_result(None)
+
+        application.process_update = tracked
+
+    async def send(self, step, user_id, text=None, callback_data=None):
+        update_id = next(self._update_ids)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+        message = {'message_id': update_id, 'date': int(time.time()), 'from': user,
+                   'chat': {'id': user_id, 'type': 'private'}, 'text': text or 'menu'}
+        if callback_data is None:
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            data = {'update_id': update_id, 'message': message}
+        else:
+            data = {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+                'message': message, 'data': callback_data
+            }}
+        waiter = self._waiting[update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        await waiter
+        self.samples.setdefault(step, []).append(time.perf_counter() - started)
+
+
+async def customer(driver, cb, index, think_time, tickets, payment_db):
+    user_id = FIRST_USER_ID + index
+    steps = [
+        ('start', {'text': '/start'}),
+        ('show_plans', {'callback_data': cb('show_plans')}),
+        ('select_plan', {'callback_data': cb('select_plan', PLAN_ID)}),
+        ('domain', {'text': f'shop{index}.ir'}),
+        ('email_and_payment', {'text': f'user{index}@example.com'}),
+        ('resource_usage', {'callback_data': cb('resource_usage')}),
+        ('support', {'callback_data': cb('support')}),
+        ('new_ticket', {'callback_data': cb('new_ticket')}),
+        ('ticket_subject', {'text': 'مشکل در اتصال'}),
+        ('ticket_message', {'text': 'سلام، سایت من باز نمی‌شود. لطفاً بررسی کنید.'}),
+    ]
+    for step, kwargs in steps:
+        await driver.send(step, user_id, **kwargs)
+        await asyncio.sleep(think_time)
+        if step == 'email_and_payment':
+            payment = next(p for p in reversed(payment_db.db['payments']) if p['user_id'] == user_id)
+            await driver.send('verify_payment', user_id, callback_data=cb('verify_payment', payment['authority']))
+            await asyncio.sleep(think_time)
+    tickets.put_nowait(user_id)
+
+
+async def support_agent(driver, cb, admin_id, ticket_system, tickets, think_time):
+    while True:
+        user_id = await tickets.get()
+        if user_id is None:
+            return
+        ticket = ticket_system.get_user_tickets(user_id)[-1]
+        await driver.send('admin_claim', admin_id, callback_data=cb('reply_admin_ticket', ticket['ticket_id']))
+        await driver.send('admin_reply', admin_id, text='سلام، مشکل برطرف شد.')
+        await asyncio.sleep(think_time)
+
+
+async def watch_loop(stalls, interval=0.01):
+    """Record how late each wakeup is; lateness means something blocked the loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        stalls.append(max(0.0, loop.time() - started - interval))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args, bot):
+    fake_api = FakeBotAPI(args.telegram_latency)
+    application = bot.build_application(updater=False, request=fake_api)
+    driver = Driver(application)
+    stalls = []
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        watcher = asyncio.create_task(watch_loop(stalls))
+
+        tickets = asyncio.Queue()
+        admins = [asyncio.create_task(support_agent(driver, bot.cb, admin_id, bot.ticket_system, tickets,
+                                                    args.think_time))
+                  for admin_id in args.admin_ids]
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(index):
+            async with semaphore:
+                await customer(driver, bot.cb, index, args.think_time, tickets, bot.payment_db)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(i) for i in range(args.users)))
+        for _ in admins:
+            tickets.put_nowait(None)
+        await asyncio.gather(*admins)
+        elapsed = time.perf_counter() - started
+
+        watcher.cancel()
+        await application.stop()
+        await bot.post_stop(application)
+    return elapsed, driver.samples, stalls, fake_api.calls
+
+
+def report(elapsed, samples, stalls, calls, args, stubs):
+    total = sum(len(values) for values in samples.values())
+    print(f"{args.users} users, concurrency {args.concurrency}, {len(args.admin_ids)} admins, "
+          f"think time {args.think_time * 1000:.0f}ms")
+    print(f"latency: telegram {args.telegram_latency * 1000:.0f}ms, "
+          f"directadmin {args.directadmin_latency * 1000:.0f}ms, zarinpal {args.zarinpal_latency * 1000:.0f}ms\n")
+    print(f"{total} updates in {elapsed:.2f}s: {total / elapsed:.1f} updates/s, "
+          f"{args.users / elapsed:.1f} journeys/s\n")
+
+    width = max(len(step) for step in samples)
+    print(f"{'step':<{width}}  {'count':>6}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}  {'max ms':>8}")
+    for step, values in samples.items():
+        print(f"{step:<{width}}  {len(values):6d}  {percentile(values, 0.5) * 1000:8.1f}  "
+              f"{percentile(values, 0.95) * 1000:8.1f}  {percentile(values, 0.99) * 1000:8.1f}  "
+              f"{max(values) * 1000:8.1f}")
+
+    blocked = [stall for stall in stalls if stall >= args.stall_threshold]
+    print(f"\nevent loop: blocked {sum(blocked):.2f}s of {elapsed:.2f}s "
+          f"({len(blocked)} stalls over {args.stall_threshold * 1000:.0f}ms, "
+          f"longest {max(stalls, default=0) * 1000:.1f}ms)")
+    print("requests: " + ", ".join(f"{name} {count}" for name, count in sorted(calls.items())) +
+          f", directadmin {stubs['directadmin'].requests}, zarinpal {stubs['zarinpal'].requests}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='customer journeys to run')
+    parser.add_argument('--concurrency', type=int, default=50, help='customers active at the same time')
+    parser.add_argument('--admins', type=int, default=3)
+    parser.add_argument('--think-time', type=float, default=0.2, help='seconds between a user\'s steps')
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--directadmin-latency', type=float, default=0.1)
+    parser.add_argument('--zarinpal-latency', type=float, default=0.3)
+    parser.add_argument('--stall-threshold', type=float, default=0.02,
+                        help='event loop wakeups later than this count as stalls')
+    args = parser.parse_args()
+    args.admin_ids = [1000 + i for i in range(args.admins)]
+
+    stubs = {
+        'directadmin': StubServer(directadmin_response, args.directadmin_latency),
+        'zarinpal': StubServer(zarinpal_response, args.zarinpal_latency),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        seed(directory, args.users, args.admin_ids)
+        os.chdir(directory)
+        os.environ.update({
+            'TELEGRAM_TOKEN': '0:load-test',
+            'DA_URL': stubs['directadmin'].url,
+            'DA_USERNAME': 'admin',
+            'DA_PASSWORD': 'load-test',
+            'METRICS_PORT': '0',
+            'SHARD_COUNT': '1',
+            # Scripted users are faster than people; keep them out of flood control
+            'FLOOD_RATE': '1000',
+            'FLOOD_BURST': '1000',
+            'DEBOUNCE_WINDOW': '0',
+        })
+        import bot
+        # Per-update INFO lines would drown the report
+        logging.getLogger().setLevel(logging.WARNING)
+        bot.payment_handler.api_url = f"{stubs['zarinpal'].url}/pg/v4/payment/"
+
+        elapsed, samples, stalls, calls = asyncio.run(run(args, bot))
+        os.chdir(ROOT)
+    for stub in stubs.values():
+        stub.stop()
+    report(elapsed, samples, stalls, calls, args, stubs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Measure how long list views take to render 100 rows.
+
+Compares the previous rendering (a jdatetime conversion per timestamp and
+``+=`` concatenation) with render_handler's compiled templates, with the
+Jalali cache cold (first view of the rows) and warm (any later refresh).
+
+Usage: python benchmarks/render_bench.py [--rows N] [--repeat N]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import jdatetime
+
+from hosting_handler import parse_datetime
+from render_handler import Template, format_jalali, pack_messages
+
+WORDS = ['سلام', 'هاست', 'مشکل', 'SSL', 'دامنه', 'ایمیل', 'پرداخت', 'تمدید', 'سرعت', 'بکاپ']
+
+TICKET_ROW = Template("{status} شماره تیکت: {ticket_id}\n📌 موضوع: {subject}\n📅 تاریخ: {created_at:jalali}\n")
+ACCOUNT_ROW = Template(
+    "{status} {domain}\n👤 نام کاربری: {username}\n📦 پلن: {package}\n📅 تاریخ انقضا: {expiry_date:jalali_date}\n"
+)
+
+
+def generate(rows):
+    random.seed(42)
+    now = datetime.now()
+    tickets = [{
+        'ticket_id': i + 1,
+        'subject': ' '.join(random.choices(WORDS, k=4)),
+        'status': random.choice(['open', 'closed']),
+        'created_at': (now - timedelta(seconds=random.randint(0, 10 ** 7))).isoformat()
+    } for i in range(rows)]
+    accounts = [{
+        'domain': f'site{i}.ir', 'username': f'acct{i}', 'package': f'plan{i % 4}',
+        'status': random.choice(['active', 'suspended']),
+        'expiry_date': (now + timedelta(seconds=random.randint(0, 10 ** 7))).isoformat()
+    } for i in range(rows)]
+    return tickets, accounts
+
+
+def jalali_uncached(value, fmt='%Y/%m/%d %H:%M'):
+    return jdatetime.datetime.fromgregorian(datetime=parse_datetime(value)).strftime(fmt)
+
+
+def tickets_before(tickets):
+    message = "📋 تیکت‌های شما:\n\n"
+    for ticket in tickets:
+        status = "🟢" if ticket['status'] == 'open' else "🔴"
+        message += f"{status} شماره تیکت: {ticket['ticket_id']}\n"
+        message += f"📌 موضوع: {ticket['subject']}\n"
+        message += f"📅 تاریخ: {jalali_uncached(ticket['created_at'])}\n\n"
+    return [message]
+
+
+def tickets_after(tickets):
+    blocks = ["📋 تیکت‌های شما:\n"]
+    for ticket in tickets:
+        blocks.append(TICKET_ROW.render(ticket, status="🟢" if ticket['status'] == 'open' else "🔴"))
+    return pack_messages(blocks)
+
+
+def accounts_before(accounts):
+    message = "👤 پنل کاربری\n\n🌐 هاست‌های شما:\n\n"
+    for account in accounts:
+        status_emoji = "🟢" if account['status'] == 'active' else "🔴"
+        message += f"{status_emoji} {account['domain']}\n"
+        message += f"👤 نام کاربری: {account['username']}\n"
+        message += f"📦 پلن: {account['package']}\n"
+        message += f"📅 تاریخ انقضا: {jalali_uncached(account['expiry_date'], '%Y/%m/%d')}\n\n"
+    return [message]
+
+
+def accounts_after(accounts):
+    blocks = ["👤 پنل کاربری\n", "🌐 هاست‌های شما:\n"]
+    blocks.extend(
+        ACCOUNT_ROW.render(account, status="🟢" if account['status'] == 'active' else "🔴")
+        for account in accounts
+    )
+    return pack_messages(blocks)
+
+
+def measure(render, rows, repeat, cold=False):
+    """Best time of `repeat` renders, in ms per 100 rows"""
+    best = float('inf')
+    for _ in range(repeat):
+        if cold:
+            format_jalali.cache_clear()
+        started = time.perf_counter()
+        render(rows)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000 * 100 / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    tickets, accounts = generate(args.rows)
+    print(f"{args.rows} rows, best of {args.repeat}, ms per 100 rows\n")
+    print(f"{'view':<12}{'before':>10}{'cold':>10}{'warm':>10}{'messages':>10}")
+    for name, rows, before, after in (('my_tickets', tickets, tickets_before, tickets_after),
+                                      ('user_panel', accounts, accounts_before, accounts_after)):
+        measure(after, rows, 1)
+        warm = measure(after, rows, args.repeat)
+        print(f"{name:<12}{measure(before, rows, args.repeat):>10.2f}"
+              f"{measure(after, rows, args.repeat, cold=True):>10.2f}{warm:>10.2f}"
+              f"{len(after(rows)):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Measure cold start time of the bot, broken down by phase.
+
+Generates synthetic stores in a temporary directory, then times:
+
+- importing the bot's dependencies,
+- loading each large store from JSON (parse plus index rebuild),
+- writing and loading each store's snapshot,
+- importing bot.py and waiting for every lazy store, with and without
+  snapshots.
+
+Usage: python benchmarks/startup_bench.py [--users N] [--tickets N] ...
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ['سلام', 'هاست', 'مشکل', 'SSL', 'دامنه', 'ایمیل', 'پرداخت', 'تمدید', 'سرعت',
+         'دیتابیس', 'بکاپ', 'ftp', 'خطا', 'سرور', 'وردپرس', 'لطفا', 'بررسی', 'کنید']
+
+
+def timestamp(days_ago):
+    return (datetime.now() - timedelta(days=days_ago, seconds=random.randint(0, 86400))).isoformat()
+
+
+def generate(directory, users, accounts, tickets, payments):
+    random.seed(42)
+    sentence = lambda n: ' '.join(random.choices(WORDS, k=n))
+    data = {
+        'users.json': {'users': {
+            str(100000 + i): {
+                'username': f'user{i}', 'first_name': f'User {i}', 'last_name': None,
+                'registered_at': timestamp(random.randint(0, 700)), 'hosting_accounts': [],
+                'active': random.random() > 0.05
+            } for i in range(users)
+        }},
+        'hosting.json': {'accounts': [
+            {
+                'user_id': 100000 + random.randrange(users), 'username': f'acct{i}',
+                'domain': f'site{i}.ir', 'email': f'user{i}@example.com', 'package': f'plan{i % 4}',
+                'created_at': timestamp(random.randint(30, 700)),
+                'status': random.choice(['active'] * 8 + ['suspended', 'deleted']),
+                'expiry_date': (datetime.now() + timedelta(days=random.randint(-30, 365))).isoformat()
+            } for i in range(accounts)
+        ], 'backups': {}, 'databases': []},
+        'tickets.json': {'tickets': [
+            {
+                'ticket_id': i + 1, 'user_id': 100000 + random.randrange(users),
+                'subject': sentence(4), 'status': random.choice(['open', 'closed', 'closed']),
+                'messages': [
+                    {'user_id': 0, 'message': sentence(25), 'timestamp': timestamp(30 - j),
+                     'is_admin': j % 2 == 1}
+                    for j in range(random.randint(1, 8))
+                ],
+                'created_at': timestamp(31), 'updated_at': timestamp(0)
+            } for i in range(tickets)
+        ], 'last_ticket_id': tickets},
+        'payments.json': {'payments': [
+            {
+                'user_id': 100000 + random.randrange(users), 'amount': random.choice([150000, 300000, 600000]),
+                'description': sentence(3), 'authority': f'A{i:032d}', 'metadata': {},
+                'status': random.choice(['pending', 'verified', 'failed']),
+                'created_at': timestamp(random.randint(0, 700)), 'updated_at': timestamp(0)
+            } for i in range(payments)
+        ]},
+    }
+    for name, content in data.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(content, f, indent=2)
+    return {name: os.path.getsize(os.path.join(directory, name)) for name in data}
+
+
+def timed(label, results, func):
+    started = time.perf_counter()
+    value = func()
+    results.append((label, time.perf_counter() - started))
+    return value
+
+
+def bench_stores(directory):
+    from admin_handler import UserManager
+    from hosting_handler import HostingManager
+    from payment_handler import PaymentDatabase
+    from ticket_handler import TicketSystem
+
+    factories = {
+        'users.json': UserManager,
+        'hosting.json': lambda db_file: HostingManager(None, db_file),
+        'tickets.json': TicketSystem,
+        'payments.json': PaymentDatabase,
+    }
+    results = []
+    for name, factory in factories.items():
+        path = os.path.join(directory, name)
+        store = timed(f"{name}: JSON parse + indexes", results, lambda: factory(path))
+        timed(f"{name}: snapshot write", results, store.save_snapshot)
+        timed(f"{name}: snapshot load", results, lambda: factory(path))
+        os.remove(path + '.snapshot')
+    return results
+
+
+BOOT_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import bot
+imported = time.perf_counter()
+bot.wait_for_stores()
+print(imported - started, time.perf_counter() - started)
+if {save!r}:
+    bot.save_snapshots()
+"""
+
+
+def bench_boot(directory, save_snapshots=False):
+    env = dict(os.environ, DA_URL='http://127.0.0.1:1', TELEGRAM_TOKEN='0:bench')
+    output = subprocess.run(
+        [sys.executable, '-c', BOOT_SCRIPT.format(root=ROOT, save=save_snapshots)],
+        cwd=directory, env=env, capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(output[0]), float(output[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--tickets', type=int, default=20000)
+    parser.add_argument('--payments', type=int, default=50000)
+    args = parser.parse_args()
+
+    results = []
+    timed("import telegram, jdatetime, requests", results,
+          lambda: __import__('telegram.ext') and __import__('jdatetime') and __import__('requests'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        sizes = generate(directory, args.users, args.accounts, args.tickets, args.payments)
+        for name, size in sizes.items():
+            print(f"{name}: {size / 1024 / 1024:.1f} MB")
+        print()
+
+        results.extend(bench_stores(directory))
+
+        imported, ready = bench_boot(directory, save_snapshots=True)
+        results.append(("bot.py import (JSON)", imported))
+        results.append(("bot.py import until stores ready (JSON)", ready))
+
+        imported, ready = bench_boot(directory)
+        results.append(("bot.py import (snapshots)", imported))
+        results.append(("bot.py import until stores ready (snapshots)", ready))
+
+    width = max(len(label) for label, _ in results)
+    for label, seconds in results:
+        print(f"{label:<{width}}  {seconds * 1000:9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,43 @@ import os
 import logging
 from datetime import datetime
 import asyncio
-import schedule
+import shutil
+import tempfile
 import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, TypeHandler, filters, ConversationHandler
 from dotenv import load_dotenv
 import jdatetime
+from urllib.parse import parse_qs, urlparse
 
 from directadmin_handler import DirectAdminHandler
-from payment_handler import ZarinpalPayment, PaymentDatabase
+from payment_handler import ZarinpalPayment, PaymentDatabase, PaymentConsumer
 from ticket_handler import TicketSystem
-from admin_handler import AdminPanel, UserManager
-from hosting_handler import HostingManager
+from admin_handler import AdminPanel, UserManager, plan_key
+from hosting_handler import HostingManager, parse_datetime
+from search_index import normalize_with_offsets, tokenize
+from triage_handler import TriageQueue
+from domain_registry import DomainRegistry, normalize_domain
+from broadcast_handler import BroadcastManager
+from rate_limiter import RateLimitedSender
+from bulk_handler import BULK_ACTIONS, BulkOperationManager, select_accounts
+from flood_handler import FloodControl
+from persistence_handler import SQLitePersistence
+from callback_router import CallbackRouter
+from expiry_scheduler import ExpiryScheduler
+from backup_scheduler import BackupScheduler
+from reminder_handler import ReminderScheduler
+from quota_handler import QuotaMonitor
+from metrics_handler import REGISTRY, MetricsServer, monitor_loop_lag
+from storage import LazyStore
+from async_store import AsyncStore
+from state_backup import StateBackup
+from render_handler import Template, format_jalali, pack_messages
+from export_handler import EXPORT_FIELDS, EXPORT_FORMATS, export_rows, payment_rows, account_rows, ticket_rows
+from shard_handler import ShardCluster, update_user_id
+from tracing_handler import TracedApplication, TracedRequest, SamplingProfiler
 
 # Load environment variables
 load_dotenv()
@@ -24,6 +49,21 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Sharded mode (see shard_handler.py): this process owns the users whose id
+# hashes to SHARD_INDEX and keeps their stores under shards/<index>/
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+# Admins are homed on shard 0, see shard_handler
+cluster = ShardCluster(SHARD_INDEX, SHARD_COUNT, is_admin=lambda user_id: admin_panel.is_admin(user_id))
+
+def data_file(name):
+    """Path of a per-user store for this shard"""
+    if SHARD_COUNT == 1:
+        return name
+    directory = os.path.join('shards', str(SHARD_INDEX))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
 # Initialize handlers
 da_handler = DirectAdminHandler(
     url=os.getenv('DA_URL'),
@@ -36,367 +76,1255 @@ payment_handler = ZarinpalPayment(
     sandbox=os.getenv('ZARINPAL_SANDBOX', 'true').lower() == 'true'
 )
 
-payment_db = PaymentDatabase()
-ticket_system = TicketSystem()
-admin_panel = AdminPanel()
-user_manager = UserManager()
-hosting_manager = HostingManager(da_handler)
+# Admins, plans and settings are small and needed right away; the large
+# stores load in background threads while the bot connects to Telegram
+# Admin updates are routed to shard 0, the only writer of the shared catalog
+admin_panel = AdminPanel(read_only=SHARD_INDEX != 0)
+payment_db = LazyStore(lambda: PaymentDatabase(data_file('payments.json')), name='PaymentDatabase')
+ticket_system = LazyStore(
+    lambda: TicketSystem(data_file('tickets.json'), SHARD_INDEX, SHARD_COUNT), name='TicketSystem'
+)
+user_manager = LazyStore(lambda: UserManager(data_file('users.json')), name='UserManager')
+hosting_manager = LazyStore(lambda: HostingManager(da_handler, data_file('hosting.json')), name='HostingManager')
+
+# Handlers write through these facades so JSON saves and DirectAdmin calls
+# run on `offload` threads instead of blocking every other update
+offload = ThreadPoolExecutor(max_workers=int(os.getenv('OFFLOAD_THREADS', '8')), thread_name_prefix='offload')
+async_tickets = AsyncStore(ticket_system, writes=('create_ticket', 'add_message', 'close_ticket', 'reopen_ticket'))
+async_users = AsyncStore(user_manager, writes=(
+    'register_user', 'update_user', 'add_hosting_account', 'deactivate_user', 'activate_user'
+))
+# Replicas must keep raising on writes instead of deferring them
+async_admin = AsyncStore(admin_panel, writes=('update_settings', 'update_plan', 'remove_plan'),
+                         defer_saves=not admin_panel.read_only)
+async_hosting = AsyncStore(
+    hosting_manager,
+    writes=('update_backup',),
+    blocking_writes=('create_hosting_account', 'add_domain', 'create_database', 'create_backup', 'check_backup',
+                     'suspend_account', 'unsuspend_account', 'delete_account', 'renew_account',
+                     'cleanup_old_backups', 'bulk_update'),
+    blocking_reads=('get_resource_usage', 'get_account_info')
+)
+# Appending to the event log is file I/O, so payment events are blocking writes
+async_payments = AsyncStore(payment_db, blocking_writes=('create_payment', 'mark_redirected', 'update_payment'))
+async_stores = [async_tickets, async_users, async_admin, async_hosting, async_payments]
+
+# Telegram's limit is per bot, so shards split it, and broadcasts, reminders
+# and quota alerts share one sender
+telegram_sender = RateLimitedSender(rate=float(os.getenv('SEND_RATE', '25')) / SHARD_COUNT)
+broadcast_manager = BroadcastManager(
+    user_manager,
+    telegram_sender,
+    db_file=data_file('broadcasts.json')
+)
+flood_control = FloodControl(
+    rate=float(os.getenv('FLOOD_RATE', '1')),
+    burst=int(os.getenv('FLOOD_BURST', '5')),
+    debounce_window=float(os.getenv('DEBOUNCE_WINDOW', '1.5')),
+    is_exempt=admin_panel.is_admin
+)
+router = CallbackRouter(is_admin=admin_panel.is_admin)
+expiry_scheduler = LazyStore(lambda: ExpiryScheduler(hosting_manager, async_hosting), name='ExpiryScheduler')
+backup_scheduler = LazyStore(lambda: BackupScheduler(
+    hosting_manager,
+    async_hosting,
+    admin_panel,
+    window_start=int(os.getenv('BACKUP_WINDOW_START', '2')),
+    window_hours=int(os.getenv('BACKUP_WINDOW_HOURS', '4')),
+    max_concurrent=int(os.getenv('BACKUP_MAX_CONCURRENT', '2'))
+), name='BackupScheduler')
+triage = LazyStore(
+    lambda: TriageQueue(ticket_system, is_paying=hosting_manager.has_active_account), name='TriageQueue'
+)
+reminder_scheduler = LazyStore(lambda: ReminderScheduler(
+    hosting_manager,
+    telegram_sender,
+    renew_callback=lambda username: cb('renew', username),
+    db_file=data_file('reminders.json')
+), name='ReminderScheduler')
+quota_monitor = LazyStore(lambda: QuotaMonitor(
+    hosting_manager,
+    admin_panel,
+    telegram_sender,
+    fetch_usage=lambda username: async_hosting.get_resource_usage(username),
+    upgrade_callback=lambda username: cb('upgrade', username),
+    db_file=data_file('quota_alerts.json'),
+    max_concurrent=int(os.getenv('QUOTA_MAX_CONCURRENT', '4'))
+), name='QuotaMonitor')
+domain_registry = LazyStore(lambda: DomainRegistry(
+    hosting_manager,
+    reservation_ttl=int(os.getenv('DOMAIN_RESERVATION_TTL', '1800'))
+), name='DomainRegistry')
+lazy_stores = [payment_db, ticket_system, user_manager, hosting_manager,
+               expiry_scheduler, backup_scheduler, triage, reminder_scheduler, quota_monitor, domain_registry]
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call, e.g. to Zarinpal, on the offload pool"""
+    return await asyncio.get_running_loop().run_in_executor(offload, partial(func, *args, **kwargs))
+
+command_duration = REGISTRY.histogram(
+    'bot_command_duration_seconds', 'Command handler latency', labels=('command',)
+)
+REGISTRY.gauge('bot_store_records', 'Records held by each store', labels=('store', 'kind'), function=lambda: {
+    ('payments', 'payments'): len(payment_db.db['payments']),
+    ('tickets', 'tickets'): len(ticket_system.db['tickets']),
+    ('users', 'users'): len(user_manager.db['users']),
+    ('hosting', 'accounts'): len(hosting_manager.db['accounts']),
+    ('hosting', 'backups'): sum(len(backups) for backups in hosting_manager.db['backups'].values()),
+    ('hosting', 'databases'): len(hosting_manager.db['databases']),
+    ('broadcasts', 'broadcasts'): len(broadcast_manager.db['broadcasts']),
+})
+REGISTRY.add_collector(router.collect_metrics)
+QUOTA_CHECK_INTERVAL = int(os.getenv('QUOTA_CHECK_INTERVAL', '3600'))
+STATE_BACKUP_INTERVAL = int(os.getenv('STATE_BACKUP_INTERVAL', '3600'))
+state_backup = StateBackup(
+    os.getenv('STATE_BACKUP_DIR', 'state_backups'),
+    retention_days=int(os.getenv('BACKUP_RETENTION_DAYS', '30'))
+)
+
+metrics_port = int(os.getenv('METRICS_PORT', '0'))
+metrics_server = MetricsServer(
+    host=os.getenv('METRICS_HOST', '127.0.0.1'),
+    port=metrics_port + SHARD_INDEX if metrics_port else 0
+)
+background_tasks = set()
+running_application = None
+profiler = SamplingProfiler()
+cb = router.encode
 
 # Conversation states
 WAITING_TICKET_SUBJECT, WAITING_TICKET_MESSAGE = range(2)
 WAITING_DOMAIN, WAITING_EMAIL = range(2, 4)
 WAITING_PAYMENT = 4
 WAITING_DB_NAME, WAITING_DB_USER, WAITING_DB_PASS = range(5, 8)
+WAITING_BROADCAST_MESSAGE = 8
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Send a message when the command /start is issued."""
-    user = update.effective_user
-    user_manager.register_user(user.id, user.username, user.first_name, user.last_name)
+# Rows of the list views, see render_handler.py. Every block ends with a
+# newline and blocks are joined with another, leaving a blank line between.
+TICKET_ROW = Template("{status} شماره تیکت: {ticket_id}\n📌 موضوع: {subject}\n📅 تاریخ: {created_at:jalali}\n")
+TICKET_HEADER = Template(
+    "🎫 تیکت #{ticket_id}\n📌 موضوع: {subject}\n📅 تاریخ: {created_at:jalali}\n📊 وضعیت: {status}\n\n💬 پیام‌ها:\n"
+)
+TICKET_MESSAGE = Template("{sender}\n{message}\n⏰ {timestamp:jalali}\n")
+ACCOUNT_ROW = Template(
+    "{status} {domain}\n👤 نام کاربری: {username}\n📦 پلن: {package}\n📅 تاریخ انقضا: {expiry_date:jalali_date}\n"
+)
+USER_ROW = Template(
+    "{status} {first_name}{handle}\nتاریخ عضویت: {registered_at:jalali_date}\nتعداد هاست‌ها: {accounts}\n"
+)
+WAITING_TICKET_ROW = Template(
+    "🔹 تیکت #{ticket_id}{badges}\n👤 کاربر: {name}{handle}\n📌 موضوع: {subject}\n"
+    "⏰ در انتظار: {hours} ساعت و {minutes} دقیقه\n"
+)
 
+async def edit_long_message(query, blocks, reply_markup=None):
+    """Show a list view, continuing in new messages past Telegram's length limit."""
+    messages = pack_messages(blocks)
+    if len(messages) == 1:
+        await query.edit_message_text(messages[0], reply_markup=reply_markup)
+        return
+    await query.edit_message_text(messages[0])
+    for text in messages[1:-1]:
+        await query.message.reply_text(text)
+    # The buttons go under the end of the list
+    await query.message.reply_text(messages[-1], reply_markup=reply_markup)
+
+# Cross-shard queries. Admin views gather these from every shard; with a
+# single shard they run locally.
+
+def merge_counts(results):
+    """Sum dicts of counts, recursing into nested dicts"""
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, dict):
+                merged[key] = merge_counts([merged.get(key, {}), value])
+            elif value is not None:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+def ticket_view(ticket):
+    """A ticket together with what admin screens show about its owner"""
+    return {
+        'ticket': ticket,
+        'user': user_manager.get_user(ticket['user_id']) or {},
+        'paying': hosting_manager.has_active_account(ticket['user_id']),
+        'waiting_since': triage.waiting_since(ticket)
+    }
+
+@cluster.register('user_stats')
+def shard_user_stats():
+    return {'users': user_manager.get_stats(), 'accounts': hosting_manager.get_account_stats()}
+
+@cluster.register('ticket_stats')
+def shard_ticket_stats():
+    stats = ticket_system.get_stats()
+    # Totals rather than an average so shards can be summed
+    stats['response_time_total'] = (stats.pop('avg_first_response') or 0) * stats['responded']
+    stats['claimed'] = triage.get_stats()['claimed']
+    return stats
+
+@cluster.register('list_users')
+def shard_list_users():
+    return user_manager.get_all_users()
+
+@cluster.register('set_user_active')
+async def shard_set_user_active(user_id, active):
+    """Block or unblock a user together with their hosting accounts"""
+    if active:
+        await async_users.activate_user(user_id)
+    else:
+        await async_users.deactivate_user(user_id)
+    for account in hosting_manager.get_user_accounts(int(user_id)):
+        if active:
+            await async_hosting.unsuspend_account(account['username'])
+        else:
+            await async_hosting.suspend_account(account['username'])
+
+@cluster.register('triage_top')
+def shard_triage_top(n):
+    return [(key, ticket_view(ticket)) for key, ticket in triage.top(n)]
+
+@cluster.register('claim_ticket')
+def shard_claim_ticket(ticket_id, admin_id):
+    """Return ``(status, view)``, status being claimed, busy or missing"""
+    ticket = ticket_system.get_ticket(ticket_id)
+    if not ticket:
+        return 'missing', None
+    if not triage.claim(ticket_id, admin_id):
+        return 'busy', None
+    return 'claimed', ticket_view(ticket)
+
+@cluster.register('release_ticket')
+def shard_release_ticket(ticket_id, admin_id):
+    if triage.claimed_by(ticket_id) == admin_id:
+        triage.release(ticket_id)
+
+@cluster.register('reply_ticket')
+async def shard_reply_ticket(ticket_id, admin_id, text):
+    """Add a staff reply; returns the ticket owner's id"""
+    ticket = await async_tickets.add_message(ticket_id=ticket_id, user_id=admin_id, message=text, is_admin=True)
+    return ticket['user_id'] if ticket else None
+
+@cluster.register('bulk_select')
+def shard_bulk_select(filters):
+    """Usernames of this shard's accounts matching a bulk operation's filters"""
+    # Every account lives on the DirectAdmin server the bot talks to unless it records another
+    default_server = urlparse(da_handler.url).hostname
+    return list(select_accounts(hosting_manager.get_all_accounts(), default_server=default_server, **filters))
+
+@cluster.register('bulk_update')
+async def shard_bulk_update(usernames, action, params):
+    return await async_hosting.bulk_update(usernames, action, max_concurrent=BULK_MAX_CONCURRENT, **params)
+
+async def apply_bulk_chunk(targets, action, params):
+    """Apply a bulk action to ``[shard, username]`` targets, one batch per shard"""
+    by_shard = {}
+    for shard, username in targets:
+        by_shard.setdefault(shard, []).append(username)
+    results = await asyncio.gather(*(
+        cluster.call(shard, 'bulk_update', usernames, action, params, timeout=300)
+        for shard, usernames in by_shard.items()
+    ))
+    merged = {'changed': [], 'skipped': [], 'errors': {}}
+    for result in results:
+        merged['changed'] += result['changed']
+        merged['skipped'] += result['skipped']
+        merged['errors'].update(result['errors'])
+    return merged
+
+BULK_MAX_CONCURRENT = int(os.getenv('BULK_MAX_CONCURRENT', '4'))
+bulk_manager = BulkOperationManager(
+    apply_bulk_chunk,
+    db_file=data_file('bulk_operations.json'),
+    chunk_size=int(os.getenv('BULK_CHUNK_SIZE', '20')),
+    cancel_callback=lambda operation_id: cb('cancel_bulk', operation_id),
+    confirm_callback=lambda operation_id: cb('confirm_bulk', operation_id)
+)
+# Job stores are written by background tasks, their checkpoints only need deferring
+async_bulk = AsyncStore(bulk_manager, writes=('cancel_operation',), blocking_writes=('create_operation',))
+async_stores += [async_bulk] + [AsyncStore(store) for store in (broadcast_manager, reminder_scheduler, quota_monitor)]
+
+@cluster.register('domain_owner')
+def shard_domain_owner(domain):
+    """User id of the account serving `domain` on this shard, or None"""
+    account = domain_registry.owner(domain)
+    return account['user_id'] if account else None
+
+@cluster.register('reserve_domain')
+def shard_reserve_domain(domain, user_id):
+    return domain_registry.reserve(domain, user_id)
+
+@cluster.register('release_domain')
+def shard_release_domain(domain, user_id):
+    domain_registry.release(domain, user_id)
+
+async def reserve_domain(domain, user_id):
+    """Hold `domain` for an order; returns None or the reason it is unavailable.
+
+    Accounts are indexed on their owner's shard and reservations on the
+    domain's shard, so a domain can only be held once across the cluster.
+    """
+    owners = [owner for owner in await cluster.gather('domain_owner', domain) if owner is not None]
+    if owners:
+        return 'own' if user_id in owners else 'registered'
+    if not await cluster.call(cluster.shard_of_domain(domain), 'reserve_domain', domain, user_id):
+        return 'reserved'
+    return None
+
+DOMAIN_UNAVAILABLE = {
+    'own': "❌ شما قبلاً برای این دامنه هاست خریده‌اید!\nبرای تمدید از پنل کاربری اقدام کنید.",
+    'registered': "❌ این دامنه قبلاً روی هاست دیگری ثبت شده است!\nلطفاً دامنه دیگری وارد کنید.",
+    'reserved': "⏳ این دامنه در حال خرید توسط کاربر دیگری است!\nلطفاً دامنه دیگری وارد کنید.",
+}
+
+@cluster.register('search_tickets')
+def shard_search_tickets(search, limit):
+    total, results = ticket_system.search(
+        search['query'],
+        status=search.get('status'),
+        user_id=search.get('user_id'),
+        date_from=search.get('date_from'),
+        date_to=search.get('date_to'),
+        limit=limit,
+        with_scores=True
+    )
+    return total, [(score, ticket_view(ticket)) for score, ticket in results]
+
+@cluster.register('start_broadcast')
+def shard_start_broadcast(admin_id, text):
+    broadcast = broadcast_manager.create_broadcast(admin_id, text)
+    broadcast_manager.start(running_application.bot, broadcast['broadcast_id'])
+    return broadcast['broadcast_id']
+
+@cluster.register('cancel_broadcast')
+def shard_cancel_broadcast(broadcast_id):
+    return broadcast_manager.cancel_broadcast(broadcast_id) is not None
+
+@cluster.register('export_part')
+async def shard_export_part(kind, path, fmt, header, filters):
+    """Write this shard's records of an export to `path`; returns the row count"""
+    # The lists only ever grow, so they can be read from a thread while handlers append
+    rows = {
+        'payments': lambda: payment_rows(payment_db.db['payments']),
+        'accounts': lambda: account_rows(hosting_manager.db['accounts']),
+        'tickets': lambda: ticket_rows(ticket_system.db['tickets']),
+    }[kind]()
+    return await asyncio.to_thread(export_rows, rows, kind, path, fmt, header, **filters)
+
+def state_files():
+    """JSON files holding this shard's state"""
+    stores = (payment_db, ticket_system, user_manager, hosting_manager, broadcast_manager, reminder_scheduler,
+              quota_monitor)
+    files = [store.db_file for store in stores]
+    files += [payment_db.events_file, payment_db.checkpoint_file, payment_db.dead_letters_file]
+    if SHARD_INDEX == 0:
+        files += [admin_panel.db_file, bulk_manager.db_file]
+    return files
+
+@cluster.register('state_snapshot')
+async def shard_state_snapshot(snapshot_id):
+    """Freeze this shard's files, then chunk them off the event loop"""
+    frozen = state_backup.freeze(state_files(), snapshot_id)
+    return await asyncio.to_thread(state_backup.store, frozen)
+
+async def create_state_snapshot():
+    """Snapshot every shard's state into one manifest and apply retention."""
+    snapshot_id = datetime.now().strftime('%Y%m%d-%H%M%S')
+    entries = {}
+    stats = {}
+    for shard_entries, shard_stats in await cluster.gather('state_snapshot', snapshot_id):
+        entries.update(shard_entries)
+        stats = merge_counts([stats, shard_stats])
+    manifest = await asyncio.to_thread(state_backup.write_manifest, snapshot_id, entries, stats)
+    pruned = await asyncio.to_thread(state_backup.prune)
+    logging.info(
+        f"State snapshot {snapshot_id}: {stats['files']} files, {stats['new_chunks']}/{stats['chunks']} "
+        f"new chunks, {stats['new_bytes'] / 1024:.0f} KB stored; pruned {pruned['snapshots']} snapshots"
+    )
+    return manifest, pruned
+
+@cluster.register('rebuild_backups')
+def shard_rebuild_backups():
+    admin_panel.reload_if_changed()
+    backup_scheduler.rebuild()
+
+async def claim_next_ticket(admin_id, attempts=3):
+    """Claim the most urgent ticket across shards; retries if another admin wins"""
+    for _ in range(attempts):
+        candidates = [item for items in await cluster.gather('triage_top', 1) for item in items]
+        if not candidates:
+            return None
+        _, view = min(candidates, key=lambda item: item[0])
+        ticket_id = view['ticket']['ticket_id']
+        status, view = await cluster.call(cluster.shard_of_ticket(ticket_id), 'claim_ticket', ticket_id, admin_id)
+        if status == 'claimed':
+            return view
+    return None
+
+async def active_user_count():
+    return merge_counts(await cluster.gather('user_stats'))['users']['active']
+
+def main_menu_keyboard(user_id):
     keyboard = [
-        [InlineKeyboardButton("🌐 مشاهده پلن های هاستینگ", callback_data='show_plans')],
-        [InlineKeyboardButton("📞 پشتیبانی", callback_data='support')],
-        [InlineKeyboardButton("👤 پنل کاربری", callback_data='user_panel')],
+        [InlineKeyboardButton("🌐 مشاهده پلن های هاستینگ", callback_data=cb('show_plans'))],
+        [InlineKeyboardButton("📞 پشتیبانی", callback_data=cb('support'))],
+        [InlineKeyboardButton("👤 پنل کاربری", callback_data=cb('user_panel'))],
     ]
 
-    if admin_panel.is_admin(user.id):
-        keyboard.append([InlineKeyboardButton("⚙️ پنل مدیریت", callback_data='admin_panel')])
+    if admin_panel.is_admin(user_id):
+        keyboard.append([InlineKeyboardButton("⚙️ پنل مدیریت", callback_data=cb('admin_panel'))])
+    return InlineKeyboardMarkup(keyboard)
+
+def admin_menu_keyboard(back=True):
+    keyboard = [
+        [InlineKeyboardButton("👥 مدیریت کاربران", callback_data=cb('manage_users'))],
+        [InlineKeyboardButton("📦 مدیریت پلن‌ها", callback_data=cb('manage_plans'))],
+        [InlineKeyboardButton("🎫 مدیریت تیکت‌ها", callback_data=cb('manage_tickets'))],
+        [InlineKeyboardButton("📢 ارسال پیام همگانی", callback_data=cb('broadcast'))],
+        [InlineKeyboardButton("🛡 آمار محدودیت درخواست", callback_data=cb('flood_stats'))],
+        [InlineKeyboardButton("⏱ آمار سرعت پاسخ", callback_data=cb('route_stats'))],
+        [InlineKeyboardButton("⚙️ تنظیمات", callback_data=cb('admin_settings'))],
+    ]
+    if back:
+        keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))])
+    return InlineKeyboardMarkup(keyboard)
+
+@command_duration.time('start')
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a message when the command /start is issued."""
+    user = update.effective_user
+    await async_users.register_user(user.id, user.username, user.first_name, user.last_name)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         'به ربات فروش هاستینگ خوش آمدید! 👋\n'
         'لطفاً یکی از گزینه های زیر را انتخاب کنید:',
-        reply_markup=reply_markup
+        reply_markup=main_menu_keyboard(user.id)
     )
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button presses."""
+@router.route('main_menu', code='mm')
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the main menu."""
+    await update.callback_query.edit_message_text(
+        'لطفاً یکی از گزینه های زیر را انتخاب کنید:',
+        reply_markup=main_menu_keyboard(update.effective_user.id)
+    )
+
+@router.route('show_plans', code='sp')
+async def show_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List hosting plans."""
     query = update.callback_query
-    await query.answer()
-    user_id = update.effective_user.id
+    plans = admin_panel.get_plans()
+    keyboard = []
+    for plan_id, plan in plans.items():
+        keyboard.append([InlineKeyboardButton(
+            f"🌟 {plan['name']} - {plan['price']:,} تومان",
+            callback_data=cb('select_plan', plan_key(plan_id))
+        )])
+    keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))])
 
-    if query.data == 'show_plans':
-        plans = admin_panel.get_plans()
-        keyboard = []
-        for plan_id, plan in plans.items():
-            keyboard.append([InlineKeyboardButton(
-                f"🌟 {plan['name']} - {plan['price']:,} تومان",
-                callback_data=f'select_plan_{plan_id}'
-            )])
-        keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        message = "📌 پلن های هاستینگ ما:\n\n"
-        for plan_id, plan in plans.items():
-            message += f"🔹 {plan['name']}:\n"
-            message += f"💾 فضا: {plan['quota']//1024}GB\n"
-            message += f"🌐 پهنای باند: {plan['bandwidth']//1024}GB\n"
-            message += f"💰 قیمت: {plan['price']:,} تومان\n\n"
-        
-        await query.edit_message_text(text=message, reply_markup=reply_markup)
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    message = "📌 پلن های هاستینگ ما:\n\n"
+    for plan_id, plan in plans.items():
+        message += f"🔹 {plan['name']}:\n"
+        message += f"💾 فضا: {plan['quota']//1024}GB\n"
+        message += f"🌐 پهنای باند: {plan['bandwidth']//1024}GB\n"
+        message += f"💰 قیمت: {plan['price']:,} تومان\n\n"
+
+    await query.edit_message_text(text=message, reply_markup=reply_markup)
+
+@router.route('select_plan', code='pl', legacy='select_plan_')
+async def select_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, key):
+    """Start the purchase flow for a plan."""
+    plan_id = admin_panel.find_plan(key)
+    if plan_id is None:
+        await update.callback_query.edit_message_text("پلن مورد نظر یافت نشد!")
+        return
+    context.user_data['selected_plan'] = plan_id
+    context.user_data['state'] = WAITING_DOMAIN
 
-    elif query.data.startswith('select_plan_'):
-        plan_id = query.data.replace('select_plan_', '')
-        context.user_data['selected_plan'] = plan_id
-        context.user_data['state'] = WAITING_DOMAIN
-        
-        await query.edit_message_text(
-            "🌐 لطفاً دامنه خود را وارد کنید\n"
-            "مثال: example.com"
-        )
+    await update.callback_query.edit_message_text(
+        "🌐 لطفاً دامنه خود را وارد کنید\n"
+        "مثال: example.com"
+    )
 
-    elif query.data == 'support':
-        keyboard = [
-            [InlineKeyboardButton("📝 ایجاد تیکت جدید", callback_data='new_ticket')],
-            [InlineKeyboardButton("📋 تیکت های من", callback_data='my_tickets')],
-            [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')]
-        ]
+@router.route('support', code='su')
+async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the support menu."""
+    keyboard = [
+        [InlineKeyboardButton("📝 ایجاد تیکت جدید", callback_data=cb('new_ticket'))],
+        [InlineKeyboardButton("📋 تیکت های من", callback_data=cb('my_tickets'))],
+        [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(
+        "📮 سیستم پشتیبانی\n"
+        "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
+        reply_markup=reply_markup
+    )
+
+@router.route('new_ticket', code='nt')
+async def new_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start the new ticket flow."""
+    context.user_data['state'] = WAITING_TICKET_SUBJECT
+    await update.callback_query.edit_message_text(
+        "📝 لطفاً موضوع تیکت خود را وارد کنید:"
+    )
+
+@router.route('my_tickets', code='mt')
+async def my_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List the user's tickets."""
+    query = update.callback_query
+    tickets = ticket_system.get_user_tickets(update.effective_user.id)
+    if not tickets:
+        keyboard = [[InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
-            "📮 سیستم پشتیبانی\n"
-            "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
+            "شما هیچ تیکتی ندارید!",
             reply_markup=reply_markup
         )
+        return
 
-    elif query.data == 'new_ticket':
-        context.user_data['state'] = WAITING_TICKET_SUBJECT
-        await query.edit_message_text(
-            "📝 لطفاً موضوع تیکت خود را وارد کنید:"
+    blocks = ["📋 تیکت‌های شما:\n"]
+    keyboard = []
+    for ticket in tickets:
+        blocks.append(TICKET_ROW.render(ticket, status="🟢" if ticket['status'] == 'open' else "🔴"))
+        keyboard.append([InlineKeyboardButton(
+            f"مشاهده تیکت #{ticket['ticket_id']}",
+            callback_data=cb('view_ticket', ticket['ticket_id'])
+        )])
+
+    keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_long_message(query, blocks, reply_markup)
+
+@router.route('view_ticket', code='vt', legacy='view_ticket_')
+async def view_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, ticket_id):
+    """Show a ticket with its messages."""
+    query = update.callback_query
+    ticket_id = int(ticket_id)
+    ticket = ticket_system.get_ticket(ticket_id)
+    if not ticket:
+        await query.edit_message_text("تیکت مورد نظر یافت نشد!")
+        return
+
+    blocks = [TICKET_HEADER.render(ticket, status='باز' if ticket['status'] == 'open' else 'بسته')]
+    for msg in ticket['messages']:
+        blocks.append(TICKET_MESSAGE.render(msg, sender="👤 شما:" if not msg['is_admin'] else "👨‍💼 پشتیبان:"))
+
+    keyboard = []
+    if ticket['status'] == 'open':
+        keyboard.append([InlineKeyboardButton("✍️ پاسخ به تیکت", callback_data=cb('reply_ticket', ticket_id))])
+        keyboard.append([InlineKeyboardButton("🔒 بستن تیکت", callback_data=cb('close_ticket', ticket_id))])
+    else:
+        keyboard.append([InlineKeyboardButton("🔓 بازگشایی تیکت", callback_data=cb('reopen_ticket', ticket_id))])
+
+    keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_long_message(query, blocks, reply_markup)
+
+@router.route('user_panel', code='up')
+async def user_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the user's hosting accounts."""
+    accounts = hosting_manager.get_user_accounts(update.effective_user.id)
+    blocks = ["👤 پنل کاربری\n"]
+    if accounts:
+        blocks.append("🌐 هاست‌های شما:\n")
+        blocks.extend(
+            ACCOUNT_ROW.render(account, status="🟢" if account['status'] == 'active' else "🔴")
+            for account in accounts
         )
 
-    elif query.data == 'my_tickets':
-        tickets = ticket_system.get_user_tickets(user_id)
-        if not tickets:
-            keyboard = [[InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "شما هیچ تیکتی ندارید!",
-                reply_markup=reply_markup
-            )
+    keyboard = [
+        [InlineKeyboardButton("💾 مدیریت دیتابیس‌ها", callback_data=cb('manage_databases'))],
+        [InlineKeyboardButton("🔄 تمدید هاست", callback_data=cb('renew_hosting'))],
+        [InlineKeyboardButton("📊 آمار مصرف", callback_data=cb('resource_usage'))],
+        [InlineKeyboardButton("💾 بکاپ‌گیری", callback_data=cb('create_backup'))],
+        [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_long_message(update.callback_query, blocks, reply_markup)
+
+@router.route('create_backup', code='cb')
+async def create_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Back up all active accounts of the user."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    async with flood_control.single_flight(user_id, 'create_backup') as acquired:
+        if not acquired:
             return
 
-        message = "📋 تیکت‌های شما:\n\n"
-        keyboard = []
-        for ticket in tickets:
-            status = "🟢" if ticket['status'] == 'open' else "🔴"
-            message += f"{status} شماره تیکت: {ticket['ticket_id']}\n"
-            message += f"📌 موضوع: {ticket['subject']}\n"
-            message += f"📅 تاریخ: {jdatetime.datetime.fromtimestamp(ticket['created_at']).strftime('%Y/%m/%d %H:%M')}\n\n"
-            keyboard.append([InlineKeyboardButton(
-                f"مشاهده تیکت #{ticket['ticket_id']}",
-                callback_data=f'view_ticket_{ticket["ticket_id"]}'
-            )])
-        
-        keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')])
+        accounts = [acc for acc in hosting_manager.get_user_accounts(user_id) if acc['status'] == 'active']
+        keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('user_panel'))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
+        if not accounts:
+            await query.edit_message_text("شما هیچ هاست فعالی ندارید!", reply_markup=reply_markup)
+            return
+
+        await query.edit_message_text("⏳ در حال ایجاد بکاپ...")
+        message = "💾 نتیجه بکاپ‌گیری:\n\n"
+        for account in accounts:
+            result = await async_hosting.create_backup(account['username'])
+            if result['status'] == 'success':
+                backup_scheduler.watch(result['backup'])
+                message += f"⏳ {account['domain']}: در صف ایجاد بکاپ\n"
+            else:
+                message += f"❌ {account['domain']}: خطا در ایجاد بکاپ\n"
         await query.edit_message_text(message, reply_markup=reply_markup)
 
-    elif query.data.startswith('view_ticket_'):
-        ticket_id = int(query.data.replace('view_ticket_', ''))
-        ticket = ticket_system.get_ticket(ticket_id)
-        if not ticket:
-            await query.edit_message_text("تیکت مورد نظر یافت نشد!")
+@router.route('resource_usage', code='ru')
+async def resource_usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show disk and bandwidth usage of the user's accounts."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    async with flood_control.single_flight(user_id, 'resource_usage') as acquired:
+        if not acquired:
             return
 
-        message = f"🎫 تیکت #{ticket_id}\n"
-        message += f"📌 موضوع: {ticket['subject']}\n"
-        message += f"📅 تاریخ: {jdatetime.datetime.fromtimestamp(ticket['created_at']).strftime('%Y/%m/%d %H:%M')}\n"
-        message += f"📊 وضعیت: {'باز' if ticket['status'] == 'open' else 'بسته'}\n\n"
-        message += "💬 پیام‌ها:\n"
-        
-        for msg in ticket['messages']:
-            sender = "👤 شما:" if not msg['is_admin'] else "👨‍💼 پشتیبان:"
-            message += f"\n{sender}\n{msg['message']}\n"
-            message += f"⏰ {jdatetime.datetime.fromtimestamp(msg['timestamp']).strftime('%Y/%m/%d %H:%M')}\n"
-
-        keyboard = []
-        if ticket['status'] == 'open':
-            keyboard.append([InlineKeyboardButton("✍️ پاسخ به تیکت", callback_data=f'reply_ticket_{ticket_id}')])
-            keyboard.append([InlineKeyboardButton("🔒 بستن تیکت", callback_data=f'close_ticket_{ticket_id}')])
-        else:
-            keyboard.append([InlineKeyboardButton("🔓 بازگشایی تیکت", callback_data=f'reopen_ticket_{ticket_id}')])
-        
-        keyboard.append([InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')])
+        accounts = hosting_manager.get_user_accounts(user_id)
+        keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('user_panel'))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
+        if not accounts:
+            await query.edit_message_text("شما هیچ هاستی ندارید!", reply_markup=reply_markup)
+            return
+
+        message = "📊 آمار مصرف:\n\n"
+        for account in accounts:
+            result = await async_hosting.get_resource_usage(account['username'])
+            message += f"🌐 {account['domain']}\n"
+            if result['status'] == 'success':
+                usage = parse_qs(result['usage'])
+                message += f"💾 فضا: {usage.get('quota', ['-'])[0]} MB\n"
+                message += f"🌐 پهنای باند: {usage.get('bandwidth', ['-'])[0]} MB\n\n"
+            else:
+                message += "❌ خطا در دریافت اطلاعات\n\n"
         await query.edit_message_text(message, reply_markup=reply_markup)
 
-    elif query.data == 'user_panel':
-        accounts = hosting_manager.get_user_accounts(user_id)
-        message = "👤 پنل کاربری\n\n"
-        
-        if accounts:
-            message += "🌐 هاست‌های شما:\n\n"
-            for account in accounts:
-                status_emoji = "🟢" if account['status'] == 'active' else "🔴"
-                message += f"{status_emoji} {account['domain']}\n"
-                message += f"👤 نام کاربری: {account['username']}\n"
-                message += f"📦 پلن: {account['package']}\n"
-                message += f"📅 تاریخ انقضا: {jdatetime.datetime.fromtimestamp(account['expiry_date']).strftime('%Y/%m/%d')}\n\n"
+@router.route('renew_hosting', code='rh')
+async def renew_hosting(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List the user's accounts that can be renewed."""
+    accounts = [acc for acc in hosting_manager.get_user_accounts(update.effective_user.id)
+                if acc['status'] in ('active', 'suspended')]
+    keyboard = [[InlineKeyboardButton(
+        f"🔄 تمدید {account['domain']}",
+        callback_data=cb('renew', account['username'])
+    )] for account in accounts]
+    keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('user_panel'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        keyboard = [
-            [InlineKeyboardButton("💾 مدیریت دیتابیس‌ها", callback_data='manage_databases')],
-            [InlineKeyboardButton("🔄 تمدید هاست", callback_data='renew_hosting')],
-            [InlineKeyboardButton("📊 آمار مصرف", callback_data='resource_usage')],
-            [InlineKeyboardButton("💾 بکاپ‌گیری", callback_data='create_backup')],
-            [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    if not accounts:
+        await update.callback_query.edit_message_text("شما هیچ هاستی برای تمدید ندارید!", reply_markup=reply_markup)
+        return
+    await update.callback_query.edit_message_text(
+        "🔄 هاست مورد نظر برای تمدید را انتخاب کنید:",
+        reply_markup=reply_markup
+    )
+
+@router.route('renew', code='rn')
+async def renew(update: Update, context: ContextTypes.DEFAULT_TYPE, username):
+    """Create a renewal payment for one account."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    account = hosting_manager.get_account(username)
+    if not account or account['user_id'] != user_id:
+        await query.edit_message_text("هاست مورد نظر یافت نشد!")
+        return
+
+    plan = admin_panel.get_plans().get(account['package'])
+    if not plan:
+        await query.edit_message_text(
+            "❌ پلن این هاست دیگر موجود نیست!\n"
+            "لطفاً برای تمدید با پشتیبانی تماس بگیرید."
+        )
+        return
 
-    elif query.data == 'admin_panel':
-        if not admin_panel.is_admin(user_id):
-            await query.edit_message_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+    await account_payment(
+        query, account, plan['price'], f"تمدید هاست {account['domain']}",
+        {'type': 'renewal', 'username': username, 'plan': account['package']}
+    )
+
+async def account_payment(query, account, amount, description, metadata):
+    """Create a payment for an existing account and show its link."""
+    user_id = account['user_id']
+    async with flood_control.single_flight(user_id, 'payment') as acquired:
+        if not acquired:
             return
 
+        payment = await run_blocking(
+            payment_handler.request_payment,
+            amount=amount,
+            description=description,
+            callback_url=f"https://your-domain.com/verify?user_id={user_id}",
+            email=account['email']
+        )
+        if payment['status'] != 'success':
+            await query.edit_message_text(
+                "❌ خطا در ایجاد لینک پرداخت!\n"
+                "لطفاً بعداً تلاش کنید یا با پشتیبانی تماس بگیرید."
+            )
+            return
+
+        await async_payments.create_payment(
+            user_id=user_id,
+            amount=amount,
+            description=description,
+            authority=payment['authority'],
+            metadata=metadata
+        )
         keyboard = [
-            [InlineKeyboardButton("👥 مدیریت کاربران", callback_data='manage_users')],
-            [InlineKeyboardButton("📦 مدیریت پلن‌ها", callback_data='manage_plans')],
-            [InlineKeyboardButton("🎫 مدیریت تیکت‌ها", callback_data='manage_tickets')],
-            [InlineKeyboardButton("⚙️ تنظیمات", callback_data='admin_settings')],
-            [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')]
+            [InlineKeyboardButton("💳 پرداخت", url=payment['payment_url'])],
+            [InlineKeyboardButton("✅ پرداخت کردم", callback_data=cb('verify_payment', payment['authority']))],
+            [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
-            "⚙️ پنل مدیریت\n"
-            "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
-            reply_markup=reply_markup
+            f"🔄 {description}\n"
+            f"مبلغ قابل پرداخت: {amount:,} تومان",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
+        await async_payments.mark_redirected(payment['authority'])
 
-async def admin_panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle admin panel actions."""
+@router.route('verify_payment', code='vp', answer=False)
+async def verify_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, authority):
+    """Ask Zarinpal whether a payment went through and log the outcome."""
     query = update.callback_query
     user_id = update.effective_user.id
+    payment = payment_db.get_payment(authority)
+    if not payment or payment['user_id'] != user_id:
+        await query.answer("پرداخت مورد نظر یافت نشد!")
+        return
+    if payment['status'] not in ('pending', 'redirected'):
+        await query.answer("این پرداخت قبلاً بررسی شده است.")
+        return
 
-    if not admin_panel.is_admin(user_id):
-        await query.edit_message_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+    async with flood_control.single_flight(user_id, 'verify_payment') as acquired:
+        if not acquired:
+            await query.answer("⏳ در حال بررسی پرداخت...")
+            return
+        result = await run_blocking(payment_handler.verify_payment, authority, payment['amount'])
+        if result['status'] == 'success':
+            # The payment_notifications consumer tells the user
+            await async_payments.update_payment(authority, 'verified', ref_id=result['ref_id'])
+            await query.answer("✅ پرداخت شما تایید شد!")
+            return
+        # Unpaid once the domain reservation is over: the order is given up and its domain released
+        age = time.time() - parse_datetime(payment['created_at']).timestamp()
+        if age > domain_registry.reservation_ttl:
+            await async_payments.update_payment(authority, 'failed')
+            await query.answer("❌ پرداخت انجام نشد و مهلت آن به پایان رسیده است.", show_alert=True)
+        else:
+            await query.answer("⏳ پرداخت هنوز تایید نشده است. پس از پرداخت دوباره امتحان کنید.", show_alert=True)
+
+@router.route('upgrade', code='ug')
+async def upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE, username):
+    """Offer the plans with more disk or bandwidth than the account's current plan."""
+    query = update.callback_query
+    account = hosting_manager.get_account(username)
+    if not account or account['user_id'] != update.effective_user.id:
+        await query.edit_message_text("هاست مورد نظر یافت نشد!")
         return
 
-    if query.data == 'manage_users':
-        users = user_manager.get_all_users()
-        message = "👥 لیست کاربران:\n\n"
-        keyboard = []
-        
-        for uid, user in users.items():
-            status = "🟢" if user.get('active', True) else "🔴"
-            message += f"{status} {user['first_name']}"
-            if user.get('username'):
-                message += f" (@{user['username']})"
-            message += f"\nتاریخ عضویت: {jdatetime.datetime.fromisoformat(user['registered_at']).strftime('%Y/%m/%d')}\n"
-            message += f"تعداد هاست‌ها: {len(user.get('hosting_accounts', []))}\n\n"
-            
-            keyboard.append([InlineKeyboardButton(
-                f"{'🔴 مسدود' if user.get('active', True) else '🟢 فعال'} کردن {user['first_name']}",
-                callback_data=f"{'deactivate' if user.get('active', True) else 'activate'}_user_{uid}"
-            )])
-
-        keyboard.append([InlineKeyboardButton("📊 گزارش کاربران", callback_data='users_report')])
-        keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data='admin_panel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    plans = admin_panel.get_plans()
+    current = plans.get(account['package'], {})
+    upgrades = [
+        (plan_id, plan) for plan_id, plan in plans.items()
+        if plan_id != account['package']
+        and plan['quota'] >= current.get('quota', 0) and plan['bandwidth'] >= current.get('bandwidth', 0)
+    ]
+    keyboard = [[InlineKeyboardButton(
+        f"⬆️ {plan['name']} - {plan['price']:,} تومان",
+        callback_data=cb('upgrade_plan', username, plan_key(plan_id))
+    )] for plan_id, plan in sorted(upgrades, key=lambda item: item[1]['price'])]
+    keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('user_panel'))])
+    if not upgrades:
+        await query.edit_message_text(
+            "❌ پلن بزرگ‌تری برای این هاست موجود نیست!\n"
+            "لطفاً با پشتیبانی تماس بگیرید.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    await query.edit_message_text(
+        f"⬆️ ارتقای هاست {account['domain']}\n"
+        "پلن جدید را انتخاب کنید:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    elif query.data == 'manage_plans':
-        plans = admin_panel.get_plans()
-        message = "📦 پلن‌های هاستینگ:\n\n"
-        keyboard = []
-        
-        for plan_id, plan in plans.items():
-            message += f"🔹 {plan['name']}\n"
-            message += f"💾 فضا: {plan['quota']//1024}GB\n"
-            message += f"🌐 پهنای باند: {plan['bandwidth']//1024}GB\n"
-            message += f"💰 قیمت: {plan['price']:,} تومان\n\n"
-            
-            keyboard.append([
-                InlineKeyboardButton(f"✏️ ویرایش {plan['name']}", callback_data=f'edit_plan_{plan_id}'),
-                InlineKeyboardButton(f"❌ حذف {plan['name']}", callback_data=f'delete_plan_{plan_id}')
-            ])
-
-        keyboard.append([InlineKeyboardButton("➕ افزودن پلن جدید", callback_data='add_plan')])
-        keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data='admin_panel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+@router.route('upgrade_plan', code='uq')
+async def upgrade_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, username, key):
+    """Create a payment moving an account to a larger plan."""
+    query = update.callback_query
+    account = hosting_manager.get_account(username)
+    plan_id = admin_panel.find_plan(key)
+    plan = admin_panel.get_plans().get(plan_id)
+    if not account or account['user_id'] != update.effective_user.id or not plan:
+        await query.edit_message_text("هاست یا پلن مورد نظر یافت نشد!")
+        return
+    await account_payment(
+        query, account, plan['price'], f"ارتقای هاست {account['domain']} به {plan['name']}",
+        {'type': 'upgrade', 'username': username, 'plan': plan_id, 'previous_plan': account['package']}
+    )
 
-    elif query.data == 'manage_tickets':
-        open_tickets = ticket_system.get_open_tickets()
-        message = "🎫 تیکت‌های باز:\n\n"
-        keyboard = []
-        
-        for ticket in open_tickets:
-            user = user_manager.get_user(ticket['user_id'])
-            message += f"🔹 تیکت #{ticket['ticket_id']}\n"
-            message += f"👤 کاربر: {user['first_name']}"
-            if user.get('username'):
-                message += f" (@{user['username']})"
-            message += f"\n📌 موضوع: {ticket['subject']}\n"
-            message += f"⏰ تاریخ: {jdatetime.datetime.fromisoformat(ticket['created_at']).strftime('%Y/%m/%d %H:%M')}\n\n"
-            
-            keyboard.append([InlineKeyboardButton(
-                f"پاسخ به تیکت #{ticket['ticket_id']}",
-                callback_data=f'reply_admin_ticket_{ticket["ticket_id"]}'
-            )])
-
-        keyboard.append([InlineKeyboardButton("📊 گزارش تیکت‌ها", callback_data='tickets_report')])
-        keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data='admin_panel')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+@router.route('admin_panel', code='ap', admin=True)
+async def admin_panel_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the admin panel."""
+    await update.callback_query.edit_message_text(
+        "⚙️ پنل مدیریت\n"
+        "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
+        reply_markup=admin_menu_keyboard()
+    )
 
-    elif query.data == 'admin_settings':
-        settings = admin_panel.get_settings()
-        message = "⚙️ تنظیمات سیستم:\n\n"
-        
-        message += f"👥 ثبت‌نام: {'فعال' if settings['allow_registration'] else 'غیرفعال'}\n"
-        message += f"🔧 حالت تعمیر: {'فعال' if settings['maintenance_mode'] else 'غیرفعال'}\n"
-        message += f"💾 بکاپ خودکار: {'فعال' if settings['backup_enabled'] else 'غیرفعال'}\n"
-        message += f"🔄 دوره بکاپ: {settings['backup_frequency']}\n"
-        
-        keyboard = [
-            [InlineKeyboardButton(
-                f"{'🔴 غیرفعال' if settings['allow_registration'] else '🟢 فعال'} کردن ثبت‌نام",
-                callback_data='toggle_registration'
-            )],
-            [InlineKeyboardButton(
-                f"{'🔴 غیرفعال' if settings['maintenance_mode'] else '🟢 فعال'} کردن حالت تعمیر",
-                callback_data='toggle_maintenance'
-            )],
-            [InlineKeyboardButton(
-                f"{'🔴 غیرفعال' if settings['backup_enabled'] else '🟢 فعال'} کردن بکاپ خودکار",
-                callback_data='toggle_backup'
-            )],
-            [InlineKeyboardButton("🔄 تغییر دوره بکاپ", callback_data='change_backup_frequency')],
-            [InlineKeyboardButton("⬅️ بازگشت", callback_data='admin_panel')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+@router.route('manage_users', code='mu', admin=True)
+async def manage_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List users with activate/deactivate buttons."""
+    users = {}
+    for shard_users in await cluster.gather('list_users'):
+        users.update(shard_users)
+    blocks = ["👥 لیست کاربران:\n"]
+    keyboard = []
+
+    for uid, user in users.items():
+        blocks.append(USER_ROW.render(
+            user,
+            status="🟢" if user.get('active', True) else "🔴",
+            handle=f" (@{user['username']})" if user.get('username') else '',
+            accounts=len(user.get('hosting_accounts', []))
+        ))
+
+        keyboard.append([InlineKeyboardButton(
+            f"{'🔴 مسدود' if user.get('active', True) else '🟢 فعال'} کردن {user['first_name']}",
+            callback_data=cb('deactivate_user' if user.get('active', True) else 'activate_user', uid)
+        )])
+
+    keyboard.append([InlineKeyboardButton("📊 گزارش کاربران", callback_data=cb('users_report'))])
+    keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('admin_panel'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_long_message(update.callback_query, blocks, reply_markup)
+
+@router.route('manage_plans', code='mp', admin=True)
+async def manage_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List plans for editing."""
+    plans = admin_panel.get_plans()
+    message = "📦 پلن‌های هاستینگ:\n\n"
+    keyboard = []
+
+    for plan_id, plan in plans.items():
+        message += f"🔹 {plan['name']}\n"
+        message += f"💾 فضا: {plan['quota']//1024}GB\n"
+        message += f"🌐 پهنای باند: {plan['bandwidth']//1024}GB\n"
+        message += f"💰 قیمت: {plan['price']:,} تومان\n\n"
+
+        keyboard.append([
+            InlineKeyboardButton(f"✏️ ویرایش {plan['name']}", callback_data=cb('edit_plan', plan_key(plan_id))),
+            InlineKeyboardButton(f"❌ حذف {plan['name']}", callback_data=cb('delete_plan', plan_key(plan_id)))
+        ])
+
+    keyboard.append([InlineKeyboardButton("➕ افزودن پلن جدید", callback_data=cb('add_plan'))])
+    keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('admin_panel'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+
+@router.route('manage_tickets', code='mk', admin=True)
+async def manage_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List open tickets waiting on staff, most urgent first."""
+    stats = merge_counts(await cluster.gather('ticket_stats'))
+    open_count = stats.get('by_status', {}).get('open', 0)
+    blocks = [
+        "🎫 تیکت‌های باز:\n"
+        f"⏳ در انتظار پشتیبانی: {stats['awaiting_reply']} (🔒 {stats['claimed']} در دست بررسی)\n"
+        f"💬 در انتظار مشتری: {open_count - stats['awaiting_reply']}\n"
+    ]
+    keyboard = []
+
+    top = sorted((item for items in await cluster.gather('triage_top', 10) for item in items),
+                 key=lambda item: item[0])[:10]
+    for _, view in top:
+        ticket, user = view['ticket'], view['user']
+        waited = int((time.time() - view['waiting_since']) // 60)
+        badges = " 💎" if view['paying'] else ''
+        if ticket.get('reopen_count'):
+            badges += f" 🔁{ticket['reopen_count']}"
+        blocks.append(WAITING_TICKET_ROW.render(
+            ticket,
+            badges=badges,
+            name=user.get('first_name', ticket['user_id']),
+            handle=f" (@{user['username']})" if user.get('username') else '',
+            hours=waited // 60,
+            minutes=waited % 60
+        ))
+
+        keyboard.append([InlineKeyboardButton(
+            f"پاسخ به تیکت #{ticket['ticket_id']}",
+            callback_data=cb('reply_admin_ticket', ticket['ticket_id'])
+        )])
+
+    keyboard.insert(0, [InlineKeyboardButton("⏭ تیکت بعدی", callback_data=cb('next_ticket'))])
+    keyboard.append([InlineKeyboardButton("📊 گزارش تیکت‌ها", callback_data=cb('tickets_report'))])
+    keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('admin_panel'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await edit_long_message(update.callback_query, blocks, reply_markup)
+
+SEARCH_PAGE_SIZE = 5
+
+def parse_search_date(value):
+    """Accept Jalali (1403/05/01) or Gregorian (2024-07-22) dates, return ISO"""
+    parts = [int(part) for part in value.replace('-', '/').split('/')]
+    if parts[0] < 1700:
+        return jdatetime.date(*parts).togregorian().isoformat()
+    return datetime(*parts).date().isoformat()
+
+def ticket_snippet(ticket, query, length=80):
+    """First message mentioning a query word, shortened around the match"""
+    words = tokenize(query)
+    for message in ticket['messages']:
+        text, offsets = normalize_with_offsets(message['message'])
+        for word in words:
+            position = text.find(word)
+            if position != -1:
+                start = max(0, offsets[position] - length // 2)
+                snippet = message['message'][start:start + length].replace('\n', ' ')
+                return ('…' if start else '') + snippet + ('…' if start + length < len(message['message']) else '')
+    return ''
+
+async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
+    """Render one page of the admin's last ticket search."""
+    search = context.user_data.get('ticket_search')
+    if not search:
+        await update.effective_message.reply_text("❌ جستجویی یافت نشد! از دستور /search استفاده کنید.")
+        return
 
-    elif query.data.startswith('deactivate_user_'):
-        user_id = query.data.replace('deactivate_user_', '')
-        user_manager.deactivate_user(user_id)
-        # Suspend all user's hosting accounts
-        accounts = hosting_manager.get_user_accounts(user_id)
-        for account in accounts:
-            hosting_manager.suspend_account(account['username'])
-        await query.answer("✅ کاربر با موفقیت مسدود شد!")
-        await admin_panel_handler(update, context)
-
-    elif query.data.startswith('activate_user_'):
-        user_id = query.data.replace('activate_user_', '')
-        user_manager.activate_user(user_id)
-        # Reactivate all user's hosting accounts
-        accounts = hosting_manager.get_user_accounts(user_id)
-        for account in accounts:
-            hosting_manager.unsuspend_account(account['username'])
-        await query.answer("✅ کاربر با موفقیت فعال شد!")
-        await admin_panel_handler(update, context)
-
-    elif query.data == 'users_report':
-        users = user_manager.get_all_users()
-        active_users = len(user_manager.get_active_users())
-        total_accounts = sum(len(user.get('hosting_accounts', [])) for user in users.values())
-        
-        message = "📊 گزارش کاربران:\n\n"
-        message += f"👥 کل کاربران: {len(users)}\n"
-        message += f"🟢 کاربران فعال: {active_users}\n"
-        message += f"🔴 کاربران غیرفعال: {len(users) - active_users}\n"
-        message += f"🌐 کل هاست‌ها: {total_accounts}\n"
-        
-        keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data='manage_users')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    offset = page * SEARCH_PAGE_SIZE
+    results = await cluster.gather('search_tickets', search, offset + SEARCH_PAGE_SIZE)
+    total = sum(shard_total for shard_total, _ in results)
+    matches = sorted((match for _, shard_matches in results for match in shard_matches),
+                     key=lambda match: (match[0], match[1]['ticket']['ticket_id']), reverse=True)
+
+    if not total:
+        message = f"🔍 نتیجه‌ای برای «{search['query']}» یافت نشد."
+    else:
+        pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        message = f"🔍 نتایج «{search['query']}» ({total} تیکت، صفحه {page + 1} از {pages}):\n\n"
+    keyboard = []
+    for _, view in matches[offset:offset + SEARCH_PAGE_SIZE]:
+        ticket, user = view['ticket'], view['user']
+        status = "🟢" if ticket['status'] == 'open' else "🔴"
+        message += f"{status} تیکت #{ticket['ticket_id']} - {ticket['subject']}\n"
+        message += f"👤 {user.get('first_name', ticket['user_id'])} | ⏰ {format_jalali(ticket['created_at'])}\n"
+        snippet = ticket_snippet(ticket, search['query'])
+        if snippet:
+            message += f"💬 {snippet}\n"
+        message += "\n"
+        keyboard.append([InlineKeyboardButton(
+            f"پاسخ به تیکت #{ticket['ticket_id']}",
+            callback_data=cb('reply_admin_ticket', ticket['ticket_id'])
+        )])
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ قبلی", callback_data=cb('search_tickets', page - 1)))
+    if (page + 1) * SEARCH_PAGE_SIZE < total:
+        navigation.append(InlineKeyboardButton("بعدی ▶️", callback_data=cb('search_tickets', page + 1)))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('manage_tickets'))])
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    elif query.data == 'tickets_report':
-        open_tickets = ticket_system.get_open_tickets()
-        closed_tickets = ticket_system.get_closed_tickets()
-        
-        message = "📊 گزارش تیکت‌ها:\n\n"
-        message += f"📬 کل تیکت‌ها: {len(open_tickets) + len(closed_tickets)}\n"
-        message += f"📨 تیکت‌های باز: {len(open_tickets)}\n"
-        message += f"📪 تیکت‌های بسته: {len(closed_tickets)}\n"
-        
-        keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data='manage_tickets')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message, reply_markup=reply_markup)
 
-    elif query.data.startswith('reply_admin_ticket_'):
-        ticket_id = int(query.data.replace('reply_admin_ticket_', ''))
-        context.user_data['replying_to_ticket'] = ticket_id
-        await query.edit_message_text(
-            "✍️ لطفاً پاسخ خود را وارد کنید:\n"
-            "برای لغو، دستور /cancel را وارد کنید."
+@router.route('search_tickets', code='st', admin=True)
+async def search_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    """Show another page of search results."""
+    await show_search_results(update, context, int(page))
+
+@router.route('admin_settings', code='as', admin=True)
+async def admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show system settings."""
+    settings = admin_panel.get_settings()
+    message = "⚙️ تنظیمات سیستم:\n\n"
+
+    message += f"👥 ثبت‌نام: {'فعال' if settings['allow_registration'] else 'غیرفعال'}\n"
+    message += f"🔧 حالت تعمیر: {'فعال' if settings['maintenance_mode'] else 'غیرفعال'}\n"
+    message += f"💾 بکاپ خودکار: {'فعال' if settings['backup_enabled'] else 'غیرفعال'}\n"
+    message += f"🔄 دوره بکاپ: {settings['backup_frequency']}\n"
+
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{'🔴 غیرفعال' if settings['allow_registration'] else '🟢 فعال'} کردن ثبت‌نام",
+            callback_data=cb('toggle', 'registration')
+        )],
+        [InlineKeyboardButton(
+            f"{'🔴 غیرفعال' if settings['maintenance_mode'] else '🟢 فعال'} کردن حالت تعمیر",
+            callback_data=cb('toggle', 'maintenance')
+        )],
+        [InlineKeyboardButton(
+            f"{'🔴 غیرفعال' if settings['backup_enabled'] else '🟢 فعال'} کردن بکاپ خودکار",
+            callback_data=cb('toggle', 'backup')
+        )],
+        [InlineKeyboardButton("🔄 تغییر دوره بکاپ", callback_data=cb('change_backup_frequency'))],
+        [InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('admin_panel'))]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+
+@router.route('deactivate_user', code='du', legacy='deactivate_user_', admin=True, answer=False)
+async def deactivate_user(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Block a user and suspend their hosting accounts."""
+    await cluster.call(cluster.shard_of_user(int(user_id)), 'set_user_active', user_id, False)
+    await update.callback_query.answer("✅ کاربر با موفقیت مسدود شد!")
+    await manage_users(update, context)
+
+@router.route('activate_user', code='au', legacy='activate_user_', admin=True, answer=False)
+async def activate_user(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Unblock a user and unsuspend their hosting accounts."""
+    await cluster.call(cluster.shard_of_user(int(user_id)), 'set_user_active', user_id, True)
+    await update.callback_query.answer("✅ کاربر با موفقیت فعال شد!")
+    await manage_users(update, context)
+
+@router.route('users_report', code='ur', admin=True)
+async def users_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show user statistics."""
+    stats = merge_counts(await cluster.gather('user_stats'))
+    users, accounts = stats['users'], stats['accounts']
+    plans = admin_panel.get_plans()
+    status_names = {'active': '🟢 فعال', 'suspended': '🟡 معلق', 'deleted': '🔴 حذف شده'}
+
+    message = "📊 گزارش کاربران:\n\n"
+    message += f"👥 کل کاربران: {users['total']}\n"
+    message += f"🟢 کاربران فعال: {users['active']}\n"
+    message += f"🔴 کاربران غیرفعال: {users['inactive']}\n"
+    message += f"\n🌐 کل هاست‌ها: {accounts['total']}\n"
+    for status, count in accounts.get('by_status', {}).items():
+        message += f"{status_names.get(status, status)}: {count}\n"
+    if accounts.get('by_plan'):
+        message += "\n📦 هاست‌ها بر اساس پلن:\n"
+        for plan_id, count in sorted(accounts['by_plan'].items(), key=lambda item: -item[1]):
+            message += f"🔹 {plans.get(plan_id, {}).get('name', plan_id)}: {count}\n"
+
+    keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('manage_users'))]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+
+@router.route('tickets_report', code='tr', admin=True)
+async def tickets_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show ticket statistics."""
+    stats = merge_counts(await cluster.gather('ticket_stats'))
+    by_status = stats.get('by_status', {})
+
+    message = "📊 گزارش تیکت‌ها:\n\n"
+    message += f"📬 کل تیکت‌ها: {stats['total']}\n"
+    message += f"📨 تیکت‌های باز: {by_status.get('open', 0)}\n"
+    message += f"📪 تیکت‌های بسته: {by_status.get('closed', 0)}\n"
+    message += f"⏳ در انتظار پاسخ پشتیبانی: {stats['awaiting_reply']}\n"
+    if stats['responded']:
+        minutes = int(stats['response_time_total'] / stats['responded'] // 60)
+        message += f"⏱ میانگین زمان اولین پاسخ: {minutes // 60} ساعت و {minutes % 60} دقیقه\n"
+
+    keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('manage_tickets'))]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+
+@router.route('next_ticket', code='nx', admin=True)
+async def next_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Claim the most urgent ticket and show it to the admin."""
+    view = await claim_next_ticket(update.effective_user.id)
+    if not view:
+        keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('manage_tickets'))]]
+        await update.callback_query.edit_message_text(
+            "✅ تیکتی در انتظار پاسخ نیست!",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
+        return
+    await show_claimed_ticket(update, context, view)
+
+async def show_claimed_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, view):
+    """Show a claimed ticket with its recent messages and start the reply."""
+    ticket, user = view['ticket'], view['user']
+    context.user_data['replying_to_ticket'] = ticket['ticket_id']
+    message = f"🎫 تیکت #{ticket['ticket_id']} (🔒 در دست شما)\n"
+    message += f"👤 کاربر: {user.get('first_name', ticket['user_id'])}\n"
+    message += f"📌 موضوع: {ticket['subject']}\n"
+    for msg in ticket['messages'][-5:]:
+        sender = "👨‍💼 پشتیبان:" if msg['is_admin'] else "👤 کاربر:"
+        message += f"\n{sender}\n{msg['message']}\n⏰ {format_jalali(msg['timestamp'])}\n"
+    message += "\n✍️ لطفاً پاسخ خود را وارد کنید:\nبرای لغو، دستور /cancel را وارد کنید."
 
-    elif query.data.startswith('toggle_'):
-        setting = query.data.replace('toggle_', '')
-        current_settings = admin_panel.get_settings()
-        
-        if setting == 'registration':
-            current_settings['allow_registration'] = not current_settings['allow_registration']
-        elif setting == 'maintenance':
-            current_settings['maintenance_mode'] = not current_settings['maintenance_mode']
-        elif setting == 'backup':
-            current_settings['backup_enabled'] = not current_settings['backup_enabled']
-        
-        admin_panel.update_settings(current_settings)
-        await query.answer("✅ تنظیمات با موفقیت بروزرسانی شد!")
-        await admin_panel_handler(update, context)
+    keyboard = [
+        [InlineKeyboardButton("🔓 آزاد کردن تیکت", callback_data=cb('release_ticket', ticket['ticket_id']))],
+        [InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('manage_tickets'))]
+    ]
+    await update.callback_query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@router.route('release_ticket', code='rl', admin=True)
+async def release_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, ticket_id):
+    """Give a claimed ticket back to the queue."""
+    ticket_id = int(ticket_id)
+    await cluster.call(cluster.shard_of_ticket(ticket_id), 'release_ticket', ticket_id, update.effective_user.id)
+    if context.user_data.get('replying_to_ticket') == ticket_id:
+        del context.user_data['replying_to_ticket']
+    await manage_tickets(update, context)
+
+@router.route('reply_admin_ticket', code='ra', legacy='reply_admin_ticket_', admin=True, answer=False)
+async def reply_admin_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, ticket_id):
+    """Claim a ticket and start an admin reply to it."""
+    query = update.callback_query
+    ticket_id = int(ticket_id)
+    status, view = await cluster.call(
+        cluster.shard_of_ticket(ticket_id), 'claim_ticket', ticket_id, update.effective_user.id
+    )
+    if status == 'missing':
+        await query.answer("تیکت مورد نظر یافت نشد!", show_alert=True)
+        return
+    if status == 'busy':
+        await query.answer("🔒 این تیکت در دست بررسی ادمین دیگری است!", show_alert=True)
+        return
+    await query.answer()
+    await show_claimed_ticket(update, context, view)
+
+@router.route('toggle', code='tg', legacy='toggle_', admin=True, answer=False)
+async def toggle_setting(update: Update, context: ContextTypes.DEFAULT_TYPE, setting):
+    """Flip a boolean setting."""
+    current_settings = admin_panel.get_settings()
+
+    if setting == 'registration':
+        current_settings['allow_registration'] = not current_settings['allow_registration']
+    elif setting == 'maintenance':
+        current_settings['maintenance_mode'] = not current_settings['maintenance_mode']
+    elif setting == 'backup':
+        current_settings['backup_enabled'] = not current_settings['backup_enabled']
+
+    await async_admin.update_settings(current_settings)
+    await update.callback_query.answer("✅ تنظیمات با موفقیت بروزرسانی شد!")
+    await admin_settings(update, context)
+
+@router.route('flood_stats', code='fs', admin=True)
+async def flood_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show flood control counters."""
+    stats = flood_control.get_stats()
+    message = "🛡 آمار محدودیت درخواست:\n\n"
+    message += f"📥 کل درخواست‌ها: {stats['updates']}\n"
+    message += f"⛔️ درخواست‌های محدود شده: {stats['throttled']}\n"
+    message += f"🔁 کلیک‌های تکراری: {stats['debounced']}\n"
+    message += f"⏳ عملیات تکراری رد شده: {stats['single_flight_rejected']}\n"
+    message += f"⚙️ عملیات در حال اجرا: {stats['in_flight']}\n"
+    offenders = flood_control.top_offenders()
+    if offenders:
+        message += "\n🚨 بیشترین محدودیت:\n"
+        for uid, count in offenders:
+            message += f"👤 {uid}: {count}\n"
+
+    keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('admin_panel'))]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+
+@router.route('route_stats', code='rs', admin=True)
+async def route_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show per-route latency."""
+    stats = sorted(router.get_stats().items(), key=lambda item: item[1].total_time, reverse=True)
+    message = "⏱ آمار سرعت پاسخ:\n\n"
+    for name, route in stats:
+        if not route.count:
+            continue
+        message += f"🔹 {name}: {route.count} بار\n"
+        message += f"   میانگین {route.avg_time * 1000:.1f}ms - بیشینه {route.max_time * 1000:.1f}ms"
+        if route.errors:
+            message += f" - {route.errors} خطا"
+        message += "\n"
+
+    keyboard = [[InlineKeyboardButton("⬅️ بازگشت", callback_data=cb('admin_panel'))]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+
+@router.route('change_backup_frequency', code='bf', admin=True, answer=False)
+async def change_backup_frequency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cycle the automated backup frequency."""
+    frequencies = ['daily', 'weekly', 'monthly']
+    current = admin_panel.get_settings()['backup_frequency']
+    next_frequency = frequencies[(frequencies.index(current) + 1) % len(frequencies)] if current in frequencies else 'daily'
+    await async_admin.update_settings({'backup_frequency': next_frequency})
+    await cluster.gather('rebuild_backups')
+    await update.callback_query.answer("✅ تنظیمات با موفقیت بروزرسانی شد!")
+    await admin_settings(update, context)
+
+@router.route('broadcast', code='bc', admin=True)
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ask for the broadcast text."""
+    context.user_data['state'] = WAITING_BROADCAST_MESSAGE
+    await update.callback_query.edit_message_text(
+        "📢 لطفاً متن پیام همگانی را وارد کنید:\n"
+        f"این پیام برای {await active_user_count()} کاربر فعال ارسال می‌شود.\n"
+        "برای لغو، دستور /cancel را وارد کنید."
+    )
+
+@router.route('cancel_broadcast', code='xb', legacy='cancel_broadcast_', admin=True, answer=False)
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id):
+    """Stop a running broadcast."""
+    query = update.callback_query
+    broadcast = broadcast_manager.cancel_broadcast(int(broadcast_id))
+    if broadcast:
+        for shard, shard_broadcast_id in broadcast.get('shard_broadcasts', {}).items():
+            await cluster.call(int(shard), 'cancel_broadcast', shard_broadcast_id)
+        await query.answer("⛔️ ارسال پیام همگانی لغو شد!")
+        await query.edit_message_text(broadcast_manager.format_progress(broadcast))
+    else:
+        await query.answer("این پیام همگانی در حال ارسال نیست!")
+
+@router.route('confirm_broadcast', code='bs', admin=True, answer=False)
+async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the previewed broadcast."""
+    query = update.callback_query
+    text = context.user_data.pop('pending_broadcast', None)
+    if text is None:
+        await query.answer("این پیام همگانی قبلاً ارسال یا لغو شده است!")
+        return
+    user_id = update.effective_user.id
+    broadcast = broadcast_manager.create_broadcast(user_id, text)
+    # The preview becomes the progress message
+    broadcast['status_chat_id'] = query.message.chat_id
+    broadcast['status_message_id'] = query.message.message_id
+    # Other shards send to their own users; progress shown here is this shard's
+    broadcast['shard_broadcasts'] = {
+        shard: await cluster.call(shard, 'start_broadcast', user_id, text)
+        for shard in range(SHARD_COUNT) if shard != SHARD_INDEX
+    }
+    broadcast_manager.start(context.bot, broadcast['broadcast_id'])
+    await query.answer("📢 ارسال پیام همگانی آغاز شد!")
+    await query.edit_message_text(broadcast_manager.format_progress(broadcast))
+
+@router.route('discard_broadcast', code='bx', admin=True, answer=False)
+async def discard_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop the previewed broadcast."""
+    query = update.callback_query
+    context.user_data.pop('pending_broadcast', None)
+    await query.answer("⛔️ پیام همگانی لغو شد!")
+    await query.edit_message_text("⛔️ پیام همگانی ارسال نشد.")
+
+@router.route('confirm_bulk', code='bk', admin=True, answer=False)
+async def confirm_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, operation_id):
+    """Start a bulk operation the admin has reviewed."""
+    query = update.callback_query
+    operation = bulk_manager.get_operation(int(operation_id))
+    if not operation or operation['status'] != 'pending':
+        await query.answer("این عملیات قبلاً اجرا یا لغو شده است!")
+        return
+    operation['status_chat_id'] = query.message.chat_id
+    operation['status_message_id'] = query.message.message_id
+    bulk_manager.start(context.bot, operation['operation_id'])
+    await query.answer("⏳ عملیات گروهی آغاز شد!")
+    await query.edit_message_text(
+        bulk_manager.format_progress(operation), reply_markup=bulk_manager.progress_markup(operation)
+    )
+
+@router.route('cancel_bulk', code='xk', admin=True, answer=False)
+async def cancel_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, operation_id):
+    """Drop a pending bulk operation or stop a running one after its current chunk."""
+    query = update.callback_query
+    operation = await async_bulk.cancel_operation(int(operation_id))
+    if operation:
+        await query.answer("⛔️ عملیات گروهی لغو شد!")
+        await query.edit_message_text(bulk_manager.format_progress(operation))
+    else:
+        await query.answer("این عملیات در حال اجرا نیست!")
 
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin messages."""
@@ -404,29 +1332,40 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
     if not admin_panel.is_admin(user_id):
         return
 
+    if context.user_data.get('state') == WAITING_BROADCAST_MESSAGE:
+        # Nothing is sent until the admin confirms the preview
+        context.user_data['pending_broadcast'] = update.message.text
+        del context.user_data['state']
+        keyboard = [[
+            InlineKeyboardButton("✅ تایید و ارسال", callback_data=cb('confirm_broadcast')),
+            InlineKeyboardButton("❌ انصراف", callback_data=cb('discard_broadcast'))
+        ]]
+        await update.message.reply_text(
+            f"📢 پیش‌نمایش پیام همگانی ({await active_user_count()} کاربر فعال):\n\n"
+            f"{update.message.text}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+
     if 'replying_to_ticket' in context.user_data:
         ticket_id = context.user_data['replying_to_ticket']
-        ticket_system.add_message(
-            ticket_id=ticket_id,
-            user_id=user_id,
-            message=update.message.text,
-            is_admin=True
+        owner_id = await cluster.call(
+            cluster.shard_of_ticket(ticket_id), 'reply_ticket', ticket_id, user_id, update.message.text
         )
-        
+
         # Send notification to ticket owner
-        ticket = ticket_system.get_ticket(ticket_id)
-        if ticket:
+        if owner_id:
             try:
                 await context.bot.send_message(
-                    chat_id=ticket['user_id'],
+                    chat_id=owner_id,
                     text=f"📨 پاسخ جدید به تیکت #{ticket_id}:\n\n"
                          f"{update.message.text}\n\n"
                          "برای مشاهده کامل تیکت، به ربات مراجعه کنید."
                 )
             except Exception as e:
-                print(f"Error sending notification to user: {e}")
+                logging.warning(f"Could not notify user {owner_id} of a reply to ticket #{ticket_id}: {e}")
 
-        keyboard = [[InlineKeyboardButton("⬅️ بازگشت به تیکت‌ها", callback_data='manage_tickets')]]
+        keyboard = [[InlineKeyboardButton("⬅️ بازگشت به تیکت‌ها", callback_data=cb('manage_tickets'))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text("✅ پاسخ شما با موفقیت ارسال شد!", reply_markup=reply_markup)
         del context.user_data['replying_to_ticket']
@@ -445,7 +1384,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     elif state == WAITING_TICKET_MESSAGE:
-        ticket = ticket_system.create_ticket(
+        ticket = await async_tickets.create_ticket(
             user_id=user_id,
             subject=context.user_data['ticket_subject'],
             message=message_text
@@ -462,7 +1401,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                      f"پیام: {message_text}"
             )
 
-        keyboard = [[InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')]]
+        keyboard = [[InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
             f"✅ تیکت شما با موفقیت ثبت شد!\n"
@@ -473,11 +1412,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.clear()
 
     elif state == WAITING_DOMAIN:
-        if not message_text.strip():
+        domain = normalize_domain(message_text)
+        if not domain:
             await update.message.reply_text("❌ لطفاً دامنه معتبر وارد کنید!")
             return
+        unavailable = await reserve_domain(domain, user_id)
+        if unavailable:
+            await update.message.reply_text(DOMAIN_UNAVAILABLE[unavailable])
+            return
 
-        context.user_data['domain'] = message_text
+        previous = context.user_data.get('domain')
+        if previous and previous != domain:
+            await cluster.call(cluster.shard_of_domain(previous), 'release_domain', previous, user_id)
+        context.user_data['domain'] = domain
         context.user_data['state'] = WAITING_EMAIL
         await update.message.reply_text("📧 لطفاً آدرس ایمیل خود را وارد کنید:")
 
@@ -486,43 +1433,63 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ لطفاً ایمیل معتبر وارد کنید!")
             return
 
-        plan = admin_panel.get_plans()[context.user_data['selected_plan']]
-        payment_amount = plan['price']
+        async with flood_control.single_flight(user_id, 'payment') as acquired:
+            if not acquired:
+                await update.message.reply_text("⏳ درخواست پرداخت شما در حال پردازش است...")
+                return
+
+            # The reservation may have lapsed while the user was away
+            domain = context.user_data['domain']
+            unavailable = await reserve_domain(domain, user_id)
+            if unavailable:
+                context.user_data['state'] = WAITING_DOMAIN
+                await update.message.reply_text(
+                    DOMAIN_UNAVAILABLE[unavailable] + "\n\n🌐 لطفاً دامنه خود را وارد کنید:"
+                )
+                return
 
-        # Create payment request
-        payment = payment_handler.request_payment(
-            amount=payment_amount,
-            description=f"خرید هاست {plan['name']}",
-            callback_url=f"https://your-domain.com/verify?user_id={user_id}",
-            email=message_text
-        )
+            plan = admin_panel.get_plans()[context.user_data['selected_plan']]
+            payment_amount = plan['price']
 
-        if payment['status'] == 'success':
-            payment_db.create_payment(
-                user_id=user_id,
+            # Create payment request
+            payment = await run_blocking(
+                payment_handler.request_payment,
                 amount=payment_amount,
                 description=f"خرید هاست {plan['name']}",
-                authority=payment['authority']
+                callback_url=f"https://your-domain.com/verify?user_id={user_id}",
+                email=message_text
             )
 
-            keyboard = [
-                [InlineKeyboardButton("💳 پرداخت", url=payment['payment_url'])],
-                [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data='main_menu')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(
-                "🔄 در حال انتقال به درگاه پرداخت...\n"
-                f"مبلغ قابل پرداخت: {payment_amount:,} تومان",
-                reply_markup=reply_markup
-            )
-        else:
-            await update.message.reply_text(
-                "❌ خطا در ایجاد لینک پرداخت!\n"
-                "لطفاً بعداً تلاش کنید یا با پشتیبانی تماس بگیرید."
-            )
-        
+            if payment['status'] == 'success':
+                await async_payments.create_payment(
+                    user_id=user_id,
+                    amount=payment_amount,
+                    description=f"خرید هاست {plan['name']}",
+                    authority=payment['authority'],
+                    metadata={'type': 'purchase', 'plan': context.user_data['selected_plan'], 'domain': domain}
+                )
+
+                keyboard = [
+                    [InlineKeyboardButton("💳 پرداخت", url=payment['payment_url'])],
+                    [InlineKeyboardButton("✅ پرداخت کردم", callback_data=cb('verify_payment', payment['authority']))],
+                    [InlineKeyboardButton("🏠 بازگشت به منو اصلی", callback_data=cb('main_menu'))]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await update.message.reply_text(
+                    "🔄 در حال انتقال به درگاه پرداخت...\n"
+                    f"مبلغ قابل پرداخت: {payment_amount:,} تومان",
+                    reply_markup=reply_markup
+                )
+                await async_payments.mark_redirected(payment['authority'])
+            else:
+                await update.message.reply_text(
+                    "❌ خطا در ایجاد لینک پرداخت!\n"
+                    "لطفاً بعداً تلاش کنید یا با پشتیبانی تماس بگیرید."
+                )
+
         context.user_data.clear()
 
+@command_duration.time('admin')
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /admin command."""
     user_id = update.effective_user.id
@@ -531,47 +1498,410 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
         return
 
-    keyboard = [
-        [InlineKeyboardButton("👥 مدیریت کاربران", callback_data='manage_users')],
-        [InlineKeyboardButton("📦 مدیریت پلن‌ها", callback_data='manage_plans')],
-        [InlineKeyboardButton("🎫 مدیریت تیکت‌ها", callback_data='manage_tickets')],
-        [InlineKeyboardButton("⚙️ تنظیمات", callback_data='admin_settings')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "🎛 به پنل مدیریت خوش آمدید!\n"
         "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
-        reply_markup=reply_markup
+        reply_markup=admin_menu_keyboard(back=False)
     )
 
-async def scheduled_tasks():
-    """Run scheduled tasks."""
-    while True:
-        # Check for expired accounts
-        accounts = hosting_manager.get_all_accounts()
-        for account in accounts:
-            if account['status'] == 'active':
-                expiry_date = datetime.fromisoformat(account['expiry_date'])
-                if expiry_date < datetime.now():
-                    hosting_manager.suspend_account(account['username'])
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /cancel outside the conversation: abandon a pending broadcast or ticket reply.
+
+    Runs ahead of the conversation, whose own /cancel fallback still shows
+    the menu afterwards.
+    """
+    state = context.user_data.pop('state', None)
+    cancelled = state == WAITING_BROADCAST_MESSAGE
+    cancelled |= context.user_data.pop('pending_broadcast', None) is not None
+    cancelled |= context.user_data.pop('replying_to_ticket', None) is not None
+    if cancelled:
+        await update.message.reply_text("⛔️ عملیات لغو شد.")
+
+@command_duration.time('broadcast')
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /broadcast command."""
+    if not admin_panel.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+        return
+
+    context.user_data['state'] = WAITING_BROADCAST_MESSAGE
+    await update.message.reply_text(
+        "📢 لطفاً متن پیام همگانی را وارد کنید:\n"
+        f"این پیام برای {await active_user_count()} کاربر فعال ارسال می‌شود.\n"
+        "برای لغو، دستور /cancel را وارد کنید."
+    )
 
-        # Create automated backups
-        if admin_panel.get_settings()['backup_enabled']:
-            accounts = hosting_manager.get_active_accounts()
-            for account in accounts:
-                hosting_manager.create_backup(account['username'])
+@command_duration.time('bulk')
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /bulk <action> [filters]: suspend, unsuspend, extend or repackage matching accounts."""
+    if not admin_panel.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+        return
 
-        # Clean up old backups
-        retention_days = int(admin_panel.get_settings()['backup_retention_days'])
-        hosting_manager.cleanup_old_backups(retention_days)
+    action, _, value = (context.args[0] if context.args else '').partition(':')
+    if action not in BULK_ACTIONS:
+        await update.message.reply_text(
+            "🛠 عملیات گروهی روی هاست‌ها:\n"
+            "/bulk suspend|unsuspend|extend:روز|package:شناسه‌پلن [plan:شناسه] "
+            "[status:active|suspended] [from:1403/05/01] [to:1403/05/30] [server:نام‌سرور]\n"
+            "بازه from و to روی تاریخ انقضا اعمال می‌شود."
+        )
+        return
 
-        await asyncio.sleep(86400)  # Run daily
+    params = {}
+    filters = {}
+    try:
+        if action == 'extend':
+            params['days'] = int(value)
+            if params['days'] <= 0:
+                raise ValueError(value)
+        elif action == 'package':
+            if value not in admin_panel.get_plans():
+                raise ValueError(value)
+            params['package'] = value
+        for arg in context.args[1:]:
+            key, _, value = arg.partition(':')
+            if key == 'from' and value:
+                filters['expires_from'] = parse_search_date(value)
+            elif key == 'to' and value:
+                filters['expires_to'] = parse_search_date(value)
+            elif key in ('plan', 'status', 'server') and value:
+                filters[key] = value
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ پارامتر نامعتبر است! تعداد روز، شناسه پلن و تاریخ (1403/05/01) را بررسی کنید."
+        )
+        return
 
-def main():
-    """Start the bot."""
+    selections = await cluster.gather('bulk_select', filters)
+    targets = [[shard, username] for shard, usernames in enumerate(selections) for username in usernames]
+    if not targets:
+        await update.message.reply_text("🔍 هیچ هاستی با این فیلترها پیدا نشد!")
+        return
+    operation = await async_bulk.create_operation(update.effective_user.id, action, params, filters, targets)
+    await update.message.reply_text(
+        bulk_manager.format_progress(operation), reply_markup=bulk_manager.progress_markup(operation)
+    )
+
+@command_duration.time('search')
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /search <words> [status:open|closed] [user:<id>] [from:<date>] [to:<date>]."""
+    if not admin_panel.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+        return
+
+    search = {}
+    words = []
+    try:
+        for arg in context.args:
+            key, _, value = arg.partition(':')
+            if key == 'status' and value in ('open', 'closed'):
+                search['status'] = value
+            elif key == 'user' and value:
+                search['user_id'] = int(value)
+            elif key == 'from' and value:
+                search['date_from'] = parse_search_date(value)
+            elif key == 'to' and value:
+                search['date_to'] = parse_search_date(value)
+            else:
+                words.append(arg)
+    except ValueError:
+        await update.message.reply_text("❌ فیلتر نامعتبر است! تاریخ را به شکل 1403/05/01 وارد کنید.")
+        return
+
+    if not words:
+        await update.message.reply_text(
+            "🔍 جستجوی تیکت‌ها:\n"
+            "/search کلمات [status:open] [user:شناسه] [from:1403/05/01] [to:1403/05/30]"
+        )
+        return
+
+    search['query'] = ' '.join(words)
+    context.user_data['ticket_search'] = search
+    await show_search_results(update, context)
+
+def concatenate_files(paths, destination):
+    with open(destination, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+
+@command_duration.time('export')
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /export payments|accounts|tickets [filters]: send the records as a gzip document."""
+    if not admin_panel.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+        return
+
+    if not context.args or context.args[0] not in EXPORT_FIELDS:
+        await update.message.reply_text(
+            "📤 خروجی گرفتن از داده‌ها:\n"
+            "/export payments|accounts|tickets [from:1403/05/01] [to:1403/05/30] "
+            "[status:verified] [plan:شناسه] [format:csv|jsonl]"
+        )
+        return
+
+    kind = context.args[0]
+    fmt = 'csv'
+    filters = {}
+    try:
+        for arg in context.args[1:]:
+            key, _, value = arg.partition(':')
+            if key == 'from' and value:
+                filters['date_from'] = parse_search_date(value)
+            elif key == 'to' and value:
+                filters['date_to'] = parse_search_date(value)
+            elif key in ('status', 'plan') and value:
+                filters[key] = value
+            elif key == 'format' and value in EXPORT_FORMATS:
+                fmt = value
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await update.message.reply_text("❌ فیلتر نامعتبر است! تاریخ را به شکل 1403/05/01 وارد کنید.")
+        return
+
+    if 'plan' in filters and kind == 'tickets':
+        await update.message.reply_text("❌ فیلتر پلن برای تیکت‌ها پشتیبانی نمی‌شود!")
+        return
+
+    status_message = await update.message.reply_text("⏳ در حال آماده‌سازی خروجی...")
+    with tempfile.TemporaryDirectory() as directory:
+        # Each shard writes its own gzip part, parts are concatenated in shard order
+        parts = [os.path.join(directory, f"part-{shard}.gz") for shard in range(SHARD_COUNT)]
+        counts = await asyncio.gather(*(
+            cluster.call(shard, 'export_part', kind, parts[shard], fmt, shard == 0, filters)
+            for shard in range(SHARD_COUNT)
+        ))
+        path = parts[0]
+        if len(parts) > 1:
+            path = os.path.join(directory, 'export.gz')
+            await asyncio.to_thread(concatenate_files, parts, path)
+
+        if os.path.getsize(path) > 50 * 1024 * 1024:
+            await status_message.edit_text("❌ حجم خروجی بیشتر از ۵۰ مگابایت است! بازه زمانی را کوتاه‌تر کنید.")
+            return
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}.gz",
+                caption=f"📤 خروجی {kind}: {sum(counts):,} رکورد"
+            )
+    await status_message.delete()
+
+@command_duration.time('statebackup')
+async def state_backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /statebackup: snapshot the bot's stores now and list recent snapshots."""
+    if not admin_panel.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+        return
+
+    status_message = await update.message.reply_text("⏳ در حال تهیه نسخه پشتیبان از داده‌های ربات...")
+    try:
+        manifest, pruned = await create_state_snapshot()
+    except Exception as e:
+        logging.error(f"State snapshot failed: {e}")
+        await status_message.edit_text("❌ خطا در تهیه نسخه پشتیبان!")
+        return
+
+    stats = manifest['stats']
+    message = f"✅ نسخه پشتیبان {manifest['snapshot_id']} ثبت شد.\n"
+    message += f"📁 {stats['files']} فایل، {stats['bytes'] / 1024 / 1024:.1f} مگابایت\n"
+    message += f"🧩 {stats['new_chunks']} از {stats['chunks']} بخش جدید ({stats['new_bytes'] / 1024:.0f} کیلوبایت)\n"
+    if pruned['snapshots']:
+        message += f"🗑 {pruned['snapshots']} نسخه قدیمی حذف شد\n"
+    snapshot_ids = await asyncio.to_thread(state_backup.list_snapshots)
+    message += "\n📋 آخرین نسخه‌ها:\n" + "\n".join(snapshot_ids[-5:])
+    await status_message.edit_text(message)
+
+@command_duration.time('profile')
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /profile [seconds]: sample the bot and send the profile, again to stop early."""
+    if not admin_panel.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ شما دسترسی به پنل مدیریت ندارید!")
+        return
+
+    if profiler.running:
+        for job in context.job_queue.get_jobs_by_name('profile'):
+            job.schedule_removal()
+        await finish_profile(context.bot, update.effective_chat.id)
+        return
+
+    try:
+        seconds = min(int(context.args[0]), 300) if context.args else 30
+    except ValueError:
+        await update.message.reply_text("❌ مدت زمان باید عدد (ثانیه) باشد!")
+        return
+
+    profiler.start()
+    context.job_queue.run_once(
+        lambda ctx: finish_profile(ctx.bot, ctx.job.chat_id),
+        seconds, chat_id=update.effective_chat.id, name='profile'
+    )
+    await update.message.reply_text(
+        f"🔬 پروفایل‌گیری به مدت {seconds} ثانیه شروع شد.\n"
+        "برای توقف زودتر دوباره /profile را بفرستید."
+    )
+
+async def finish_profile(bot, chat_id):
+    """Stop the profiler and send its report as a document."""
+    await asyncio.to_thread(profiler.stop)
+    report = await asyncio.to_thread(profiler.summary)
+    await bot.send_document(
+        chat_id=chat_id,
+        document=report.encode('utf-8'),
+        filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt",
+        caption=f"🔬 نتیجه پروفایل ({profiler.samples} نمونه)"
+    )
+
+PAYMENT_NOTICES = {
+    'verified': "✅ پرداخت شما به مبلغ {amount:,} تومان تایید شد.\nکد پیگیری: {ref_id}",
+    'failed': "❌ پرداخت شما به مبلغ {amount:,} تومان ناموفق بود.",
+    'refunded': "↩️ مبلغ {amount:,} تومان به حساب شما بازگردانده شد.",
+}
+
+async def notify_payment_event(event):
+    """Tell the customer when their payment is settled; consumer of the payment log."""
+    notice = PAYMENT_NOTICES.get(event['type'])
+    if not notice:
+        return
+    payment = payment_db.get_payment(event['authority'])
+    await running_application.bot.send_message(
+        chat_id=payment['user_id'],
+        text=notice.format(amount=payment['amount'], ref_id=event.get('ref_id', '-'))
+    )
+
+async def release_failed_domain(event):
+    """Free the domain of a purchase that will not complete; consumer of the payment log."""
+    if event['type'] not in ('failed', 'refunded'):
+        return
+    payment = payment_db.get_payment(event['authority'])
+    domain = payment['metadata'].get('domain')
+    if payment['metadata'].get('type') == 'purchase' and domain:
+        await cluster.call(cluster.shard_of_domain(domain), 'release_domain', domain, payment['user_id'])
+
+payment_consumers = []
+
+def wait_for_stores():
+    started = time.perf_counter()
+    for store in lazy_stores:
+        store.wait()
+    logging.info(f"Stores ready {time.perf_counter() - started:.2f}s after connecting")
+
+def save_snapshots():
+    """Snapshot the large stores so the next start skips parsing and indexing."""
+    for store in (payment_db, ticket_system, user_manager, hosting_manager):
+        try:
+            store.save_snapshot()
+        except Exception as e:
+            logging.error(f"Failed to snapshot {store.db_file}: {e}")
+
+async def reload_admin_panel(context: ContextTypes.DEFAULT_TYPE):
+    """Pick up plans and settings written by shard 0."""
+    admin_panel.reload_if_changed()
+
+async def post_init(application: Application):
+    """Resume work interrupted by the last shutdown."""
+    global running_application
+    running_application = application
+    telegram_sender.bot = application.bot
+    cluster.start()
+    await asyncio.to_thread(wait_for_stores)
+    # Blocking writes change accounts in worker threads; listeners must still run here
+    hosting_manager.set_listener_loop(asyncio.get_running_loop())
+    for store in async_stores:
+        store.start(offload)
+    broadcast_manager.resume_all(application.bot)
+    bulk_manager.resume_all(application.bot)
+    payment_consumers.append(PaymentConsumer(payment_db, 'payment_notifications', notify_payment_event))
+    payment_consumers.append(PaymentConsumer(payment_db, 'domain_reservations', release_failed_domain))
+    for consumer in payment_consumers:
+        consumer.start()
+    expiry_scheduler.start(application.job_queue)
+    backup_scheduler.start(application.job_queue)
+    reminder_scheduler.start(application.job_queue)
+    if QUOTA_CHECK_INTERVAL:
+        quota_monitor.start(application.job_queue, interval=QUOTA_CHECK_INTERVAL)
+    application.job_queue.run_repeating(daily_maintenance, interval=86400, first=60, name='daily_maintenance')
+    if SHARD_INDEX != 0:
+        application.job_queue.run_repeating(reload_admin_panel, interval=30, name='reload_admin_panel')
+    elif STATE_BACKUP_INTERVAL:
+        # Shard 0 snapshots every shard
+        application.job_queue.run_repeating(
+            state_snapshot_job, interval=STATE_BACKUP_INTERVAL, first=300, name='state_snapshot'
+        )
+    if metrics_server.port:
+        metrics_server.start()
+        # Not application.create_task: those are awaited on shutdown
+        background_tasks.add(asyncio.create_task(monitor_loop_lag()))
+
+async def post_stop(application: Application):
+    """Checkpoint background work before shutting down."""
+    await broadcast_manager.stop_all()
+    await bulk_manager.stop_all()
+    await backup_scheduler.stop_all()
+    for task in background_tasks:
+        task.cancel()
+    for consumer in payment_consumers:
+        consumer.stop()
+    if profiler.running:
+        profiler.stop()
+    for store in async_stores:
+        await store.stop()
+    await asyncio.to_thread(save_snapshots)
+    metrics_server.stop()
+    cluster.stop()
+
+async def state_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic snapshot of the bot's own stores."""
+    try:
+        await create_state_snapshot()
+    except Exception as e:
+        logging.error(f"State snapshot failed: {e}")
+
+async def daily_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """Run daily maintenance tasks. Expiry and backups have their own schedulers."""
+    # Clean up old backups, plans may keep theirs longer or shorter
+    retention_days = int(admin_panel.get_settings().get(
+        'backup_retention_days', os.getenv('BACKUP_RETENTION_DAYS', '30')
+    ))
+    plan_retention = {
+        plan_id: int(plan['backup_retention_days'])
+        for plan_id, plan in admin_panel.get_plans().items()
+        if 'backup_retention_days' in plan
+    }
+    result = await async_hosting.cleanup_old_backups(retention_days, plan_retention)
+    logging.info(f"Removed {result['deleted']} expired backups")
+    for error in result['errors']:
+        logging.error(f"Backup cleanup failed for {error}")
+
+def build_application(updater=True, request=None):
+    """Create the Application with all handlers registered.
+
+    `request` replaces the Bot API connection, e.g. with the fake one of
+    benchmarks/load_test.py.
+    """
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_TOKEN'))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .application_class(TracedApplication, kwargs={
+            'slow_threshold': float(os.getenv('TRACE_SLOW_MS', '1000')) / 1000
+        })
+        .request(request or TracedRequest())
+        .persistence(SQLitePersistence(
+            db_file=data_file(os.getenv('STATE_DB', 'state.db')),
+            ttl=int(os.getenv('CONVERSATION_TTL', '86400'))
+        ))
+    )
+    if not updater:
+        # Sharded workers get their updates from the front process
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Add conversation handler
     conv_handler = ConversationHandler(
@@ -585,18 +1915,87 @@ def main():
             WAITING_DOMAIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)],
             WAITING_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)],
         },
-        fallbacks=[CommandHandler('cancel', start)]
+        fallbacks=[CommandHandler('cancel', start)],
+        name='main_conversation',
+        persistent=True
     )
 
+    # Flood control runs before every other handler
+    application.add_handler(TypeHandler(Update, flood_control.guard), group=-2)
+    # Before the conversation and handle_admin_message, so /cancel always clears pending input
+    application.add_handler(CommandHandler('cancel', cancel_command), group=-1)
+
     # Add handlers
     application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(CallbackQueryHandler(admin_panel_handler))
+    application.add_handler(CommandHandler('broadcast', broadcast_command))
+    application.add_handler(CommandHandler('profile', profile_command))
+    application.add_handler(CommandHandler('export', export_command))
+    application.add_handler(CommandHandler('bulk', bulk_command))
+    application.add_handler(CommandHandler('statebackup', state_backup_command))
+    application.add_handler(CommandHandler('search', search_command))
+    application.add_handler(CallbackQueryHandler(router.dispatch))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_message))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Separate group, otherwise handle_admin_message swallows every text message
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message), group=1)
+    return application
+
+async def serve_shard(update_queue):
+    """Feed updates routed by the front into the application until None arrives."""
+    application = build_application(updater=False)
+    async with application:
+        # post_init/post_stop only run by themselves under run_polling/run_webhook
+        await post_init(application)
+        await application.start()
+        try:
+            while (data := await asyncio.to_thread(update_queue.get)) is not None:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            await application.stop()
+            await post_stop(application)
+
+async def serve_dry_run(update_queue, results):
+    """Consume routed updates without calling Telegram and report what arrived.
+
+    Used by ``shard_handler.py --synthetic`` to check routing, per-user
+    ordering and cross-shard queries.
+    """
+    cluster.start()
+    await asyncio.to_thread(wait_for_stores)
+    stats = {'updates': 0, 'out_of_order': 0}
+    last_update = {}
+    # Set once the front's report marker arrives, i.e. every update was consumed
+    drained = asyncio.Event()
+
+    @cluster.register('dry_run_stats')
+    async def dry_run_stats():
+        await drained.wait()
+        return dict(stats, shards=1, senders=len(last_update))
+
+    while (data := await asyncio.to_thread(update_queue.get)) is not None:
+        if data.get('control') == 'report':
+            drained.set()
+            if SHARD_INDEX == 0:
+                report = merge_counts(await cluster.gather('dry_run_stats'))
+                report['users'] = merge_counts(await cluster.gather('user_stats'))['users']
+                results.put(report)
+            continue
+        user_id = update_user_id(data)
+        if last_update.get(user_id, 0) > data['update_id']:
+            stats['out_of_order'] += 1
+        last_update[user_id] = data['update_id']
+        stats['updates'] += 1
+    cluster.stop()
+
+def run_shard_worker(update_queue, results=None, dry_run=False):
+    """Entry point of a worker process started by shard_handler.py."""
+    if dry_run:
+        asyncio.run(serve_dry_run(update_queue, results))
+    else:
+        asyncio.run(serve_shard(update_queue))
 
-    # Start scheduled tasks
-    asyncio.create_task(scheduled_tasks())
+def main():
+    """Start the bot."""
+    application = build_application()
 
     # Start the Bot
     application.run_polling(allowed_updates=Update.ALL_TYPES)
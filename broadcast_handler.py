@@ -0,0 +1,173 @@
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError, Forbidden, BadRequest
+
+from storage import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastManager:
+    def __init__(self, user_manager, sender, db_file='broadcasts.json',
+                 checkpoint_every=50, progress_interval=5):
+        """`sender` is the process-wide `RateLimitedSender`"""
+        self.user_manager = user_manager
+        self.sender = sender
+        self.db_file = db_file
+        self.checkpoint_every = checkpoint_every
+        self.progress_interval = progress_interval
+        self._tasks = {}
+        self._load_db()
+
+    def _load_db(self):
+        try:
+            with open(self.db_file, 'r') as f:
+                self.db = json.load(f)
+        except FileNotFoundError:
+            self.db = {
+                'broadcasts': [],
+                'last_broadcast_id': 0
+            }
+            self._save_db()
+
+    def _save_db(self):
+        save_json(self.db_file, self.db)
+
+    def create_broadcast(self, admin_id, text):
+        self.db['last_broadcast_id'] += 1
+        broadcast = {
+            'broadcast_id': self.db['last_broadcast_id'],
+            'admin_id': admin_id,
+            'text': text,
+            'status': 'running',
+            'cursor': None,
+            'sent': 0,
+            'failed': 0,
+            'total': len(self.user_manager.get_active_users()),
+            'status_chat_id': None,
+            'status_message_id': None,
+            'created_at': datetime.now().isoformat(),
+            'updated_at': datetime.now().isoformat()
+        }
+        self.db['broadcasts'].append(broadcast)
+        self._save_db()
+        return broadcast
+
+    def get_broadcast(self, broadcast_id):
+        for broadcast in self.db['broadcasts']:
+            if broadcast['broadcast_id'] == broadcast_id:
+                return broadcast
+        return None
+
+    def get_unfinished_broadcasts(self):
+        return [b for b in self.db['broadcasts'] if b['status'] == 'running']
+
+    def cancel_broadcast(self, broadcast_id):
+        broadcast = self.get_broadcast(broadcast_id)
+        if not broadcast or broadcast['status'] != 'running':
+            return None
+        broadcast['status'] = 'cancelled'
+        broadcast['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+        return broadcast
+
+    def _checkpoint(self, broadcast):
+        broadcast['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+
+    def _recipients(self, cursor):
+        """Active user ids in ascending order, starting after `cursor`"""
+        user_ids = sorted(int(uid) for uid in self.user_manager.get_active_users())
+        for user_id in user_ids:
+            if cursor is None or user_id > cursor:
+                yield user_id
+
+    def format_progress(self, broadcast):
+        status = {
+            'running': '⏳ در حال ارسال',
+            'completed': '✅ تکمیل شد',
+            'cancelled': '⛔️ لغو شد'
+        }.get(broadcast['status'], broadcast['status'])
+        done = broadcast['sent'] + broadcast['failed']
+        return (
+            f"📢 پیام همگانی #{broadcast['broadcast_id']}\n"
+            f"📊 وضعیت: {status}\n"
+            f"📬 پیشرفت: {done}/{broadcast['total']}\n"
+            f"✅ ارسال موفق: {broadcast['sent']}\n"
+            f"❌ ناموفق: {broadcast['failed']}"
+        )
+
+    async def _report_progress(self, bot, broadcast):
+        if not broadcast['status_message_id']:
+            return
+        reply_markup = None
+        if broadcast['status'] == 'running':
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+                "⛔️ لغو ارسال",
+                callback_data=f"cancel_broadcast_{broadcast['broadcast_id']}"
+            )]])
+        try:
+            await bot.edit_message_text(
+                chat_id=broadcast['status_chat_id'],
+                message_id=broadcast['status_message_id'],
+                text=self.format_progress(broadcast),
+                reply_markup=reply_markup
+            )
+        except TelegramError as e:
+            logger.debug(f"Could not update broadcast progress: {e}")
+
+    async def run(self, bot, broadcast_id):
+        broadcast = self.get_broadcast(broadcast_id)
+        since_checkpoint = 0
+        last_report = time.monotonic()
+
+        try:
+            for user_id in self._recipients(broadcast['cursor']):
+                if broadcast['status'] != 'running':
+                    break
+                try:
+                    await self.sender.send_message(user_id, broadcast['text'])
+                    broadcast['sent'] += 1
+                except (Forbidden, BadRequest):
+                    broadcast['failed'] += 1
+                except TelegramError as e:
+                    logger.warning(f"Broadcast #{broadcast_id} failed for {user_id}: {e}")
+                    broadcast['failed'] += 1
+                broadcast['cursor'] = user_id
+
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    self._checkpoint(broadcast)
+                    since_checkpoint = 0
+                if time.monotonic() - last_report >= self.progress_interval:
+                    await self._report_progress(bot, broadcast)
+                    last_report = time.monotonic()
+
+            if broadcast['status'] == 'running':
+                broadcast['status'] = 'completed'
+        finally:
+            self._checkpoint(broadcast)
+            self._tasks.pop(broadcast_id, None)
+        await self._report_progress(bot, broadcast)
+
+    def start(self, bot, broadcast_id):
+        # Plain asyncio task: the application must not wait for a long
+        # broadcast on shutdown, it is checkpointed and resumed instead.
+        task = asyncio.create_task(self.run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        return task
+
+    def resume_all(self, bot):
+        for broadcast in self.get_unfinished_broadcasts():
+            logger.info(f"Resuming broadcast #{broadcast['broadcast_id']} after user {broadcast['cursor']}")
+            self.start(bot, broadcast['broadcast_id'])
+
+    async def stop_all(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
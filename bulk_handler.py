@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+
+from storage import save_json
+
+logger = logging.getLogger(__name__)
+
+BULK_ACTIONS = {
+    'suspend': '⏸ تعلیق',
+    'unsuspend': '▶️ رفع تعلیق',
+    'extend': '📅 تمدید انقضا',
+    'package': '📦 تغییر پکیج',
+}
+
+
+def select_accounts(accounts, plan=None, status=None, expires_from=None, expires_to=None,
+                    server=None, default_server=None):
+    """Usernames of non-deleted accounts matching every given filter; dates are ISO, inclusive"""
+    for account in accounts:
+        if account['status'] == 'deleted':
+            continue
+        if plan and account['package'] != plan:
+            continue
+        if status and account['status'] != status:
+            continue
+        expires = account['expiry_date'][:10]
+        if (expires_from and expires < expires_from) or (expires_to and expires > expires_to):
+            continue
+        if server and account.get('server', default_server) != server:
+            continue
+        yield account['username']
+
+
+class BulkOperationManager:
+    """Admin jobs applying one action to a filtered set of hosting accounts.
+
+    The targets are fixed when the job is created and written once to
+    their own file under `targets_dir`; the store itself only keeps each
+    job's cursor and counts. `run` hands the targets to
+    `apply_chunk(targets, action, params)` `chunk_size` at a time,
+    checkpoints the cursor after every chunk and edits the admin's status
+    message, so a job can be cancelled between chunks and resumes after a
+    restart. Targets are ``[shard, username]`` pairs. Only the last
+    `keep_finished` finished jobs are kept.
+    """
+
+    max_errors = 50
+    keep_finished = 20
+
+    def __init__(self, apply_chunk, db_file='bulk_operations.json', chunk_size=20,
+                 progress_interval=3, cancel_callback=None, confirm_callback=None):
+        self.apply_chunk = apply_chunk
+        self.db_file = db_file
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.cancel_callback = cancel_callback
+        self.confirm_callback = confirm_callback
+        self.targets_dir = os.path.splitext(db_file)[0] + '_targets'
+        self._targets = {}
+        self._tasks = {}
+        self._load_db()
+
+    def _load_db(self):
+        try:
+            with open(self.db_file, 'r') as f:
+                self.db = json.load(f)
+        except FileNotFoundError:
+            self.db = {
+                'operations': [],
+                'last_operation_id': 0
+            }
+            self._save_db()
+
+    def _save_db(self):
+        save_json(self.db_file, self.db)
+
+    def _targets_file(self, operation_id):
+        return os.path.join(self.targets_dir, f"{operation_id}.json")
+
+    def _load_targets(self, operation_id):
+        with open(self._targets_file(operation_id), 'r') as f:
+            return json.load(f)
+
+    def create_operation(self, admin_id, action, params, filters, targets):
+        """A job awaiting confirmation by the admin; writes its targets to disk"""
+        self._prune()
+        operation_id = self.db['last_operation_id'] + 1
+        os.makedirs(self.targets_dir, exist_ok=True)
+        save_json(self._targets_file(operation_id), targets)
+        self._targets[operation_id] = targets
+        self.db['last_operation_id'] = operation_id
+        operation = {
+            'operation_id': operation_id,
+            'admin_id': admin_id,
+            'action': action,
+            'params': params,
+            'filters': filters,
+            'total': len(targets),
+            'status': 'pending',
+            'cursor': 0,
+            'changed': 0,
+            'skipped': 0,
+            'failed': 0,
+            'errors': {},
+            'status_chat_id': None,
+            'status_message_id': None,
+            'created_at': datetime.now().isoformat(),
+            'updated_at': datetime.now().isoformat()
+        }
+        self.db['operations'].append(operation)
+        self._save_db()
+        return operation
+
+    def get_operation(self, operation_id):
+        for operation in self.db['operations']:
+            if operation['operation_id'] == operation_id:
+                return operation
+        return None
+
+    def get_unfinished_operations(self):
+        return [o for o in self.db['operations'] if o['status'] == 'running']
+
+    def _prune(self):
+        """Drop target files of finished jobs and all but the newest finished jobs"""
+        finished = [o for o in self.db['operations'] if o['status'] in ('completed', 'cancelled')]
+        for operation in finished:
+            self._targets.pop(operation['operation_id'], None)
+            try:
+                os.remove(self._targets_file(operation['operation_id']))
+            except FileNotFoundError:
+                pass
+        stale = {o['operation_id'] for o in finished[:-self.keep_finished]}
+        if stale:
+            self.db['operations'] = [o for o in self.db['operations'] if o['operation_id'] not in stale]
+
+    def cancel_operation(self, operation_id):
+        operation = self.get_operation(operation_id)
+        if not operation or operation['status'] not in ('pending', 'running'):
+            return None
+        operation['status'] = 'cancelled'
+        self._checkpoint(operation)
+        return operation
+
+    def _checkpoint(self, operation):
+        operation['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+
+    def format_progress(self, operation):
+        status = {
+            'pending': '❓ در انتظار تایید',
+            'running': '⏳ در حال اجرا',
+            'completed': '✅ تکمیل شد',
+            'cancelled': '⛔️ لغو شد'
+        }.get(operation['status'], operation['status'])
+        action = BULK_ACTIONS[operation['action']]
+        if operation['action'] == 'extend':
+            action += f" ({operation['params']['days']} روز)"
+        elif operation['action'] == 'package':
+            action += f" ({operation['params']['package']})"
+        filters = ' '.join(f"{key}:{value}" for key, value in operation['filters'].items()) or 'همه هاست‌ها'
+        message = (
+            f"🛠 عملیات گروهی #{operation['operation_id']}: {action}\n"
+            f"🔎 فیلتر: {filters}\n"
+            f"📊 وضعیت: {status}\n"
+            f"📬 پیشرفت: {operation['cursor']}/{operation['total']}\n"
+            f"✅ انجام شد: {operation['changed']}\n"
+            f"⏭ بدون تغییر: {operation['skipped']}\n"
+            f"❌ ناموفق: {operation['failed']}"
+        )
+        for username, error in list(operation['errors'].items())[:5]:
+            message += f"\n• {username}: {error[:80]}"
+        return message
+
+    def progress_markup(self, operation):
+        operation_id = operation['operation_id']
+        if operation['status'] == 'pending' and self.confirm_callback:
+            return InlineKeyboardMarkup([[
+                InlineKeyboardButton("✅ تایید و اجرا", callback_data=self.confirm_callback(operation_id)),
+                InlineKeyboardButton("❌ انصراف", callback_data=self.cancel_callback(operation_id))
+            ]])
+        if operation['status'] == 'running' and self.cancel_callback:
+            return InlineKeyboardMarkup([[
+                InlineKeyboardButton("⛔️ توقف عملیات", callback_data=self.cancel_callback(operation_id))
+            ]])
+        return None
+
+    async def _report_progress(self, bot, operation):
+        if not operation['status_message_id']:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=operation['status_chat_id'],
+                message_id=operation['status_message_id'],
+                text=self.format_progress(operation),
+                reply_markup=self.progress_markup(operation)
+            )
+        except TelegramError as e:
+            logger.debug(f"Could not update bulk operation progress: {e}")
+
+    async def run(self, bot, operation_id):
+        operation = self.get_operation(operation_id)
+        last_report = time.monotonic()
+
+        try:
+            targets = self._targets.get(operation_id)
+            if targets is None:
+                targets = await asyncio.to_thread(self._load_targets, operation_id)
+            while operation['cursor'] < len(targets):
+                if operation['status'] != 'running':
+                    break
+                chunk = targets[operation['cursor']:operation['cursor'] + self.chunk_size]
+                try:
+                    result = await self.apply_chunk(chunk, operation['action'], operation['params'])
+                except Exception as e:
+                    logger.error(f"Bulk operation #{operation_id} chunk failed: {e}")
+                    result = {'changed': [], 'skipped': [], 'errors': {username: str(e) for _, username in chunk}}
+                operation['changed'] += len(result['changed'])
+                operation['skipped'] += len(result['skipped'])
+                operation['failed'] += len(result['errors'])
+                # A sample is enough to diagnose; a DirectAdmin outage fails every account
+                for username, error in result['errors'].items():
+                    if len(operation['errors']) < self.max_errors:
+                        operation['errors'][username] = error
+                operation['cursor'] += len(chunk)
+                self._checkpoint(operation)
+                if time.monotonic() - last_report >= self.progress_interval:
+                    await self._report_progress(bot, operation)
+                    last_report = time.monotonic()
+
+            if operation['status'] == 'running':
+                operation['status'] = 'completed'
+        finally:
+            self._checkpoint(operation)
+            self._targets.pop(operation_id, None)
+            self._tasks.pop(operation_id, None)
+        await self._report_progress(bot, operation)
+
+    def start(self, bot, operation_id):
+        operation = self.get_operation(operation_id)
+        if operation['status'] == 'pending':
+            operation['status'] = 'running'
+            self._checkpoint(operation)
+        # Plain asyncio task, checkpointed and resumed like broadcasts
+        task = asyncio.create_task(self.run(bot, operation_id))
+        self._tasks[operation_id] = task
+        return task
+
+    def resume_all(self, bot):
+        for operation in self.get_unfinished_operations():
+            logger.info(f"Resuming bulk operation #{operation['operation_id']} at {operation['cursor']}")
+            self.start(bot, operation['operation_id'])
+
+    async def stop_all(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
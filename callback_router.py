@@ -0,0 +1,165 @@
+import time
+import logging
+from telegram import Update
+
+from metrics_handler import render_histogram
+from tracing_handler import span
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_VERSION = '1'
+SEPARATOR = ':'
+MAX_CALLBACK_BYTES = 64
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+
+
+class RouteStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, elapsed, error=False):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        if error:
+            self.errors += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+
+    @property
+    def avg_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+
+class Route:
+    def __init__(self, name, code, handler, admin=False, answer=True):
+        self.name = name
+        self.code = code
+        self.handler = handler
+        self.admin = admin
+        self.answer = answer
+        self.stats = RouteStats()
+
+
+class CallbackRouter:
+    """Dispatch callback queries to handlers registered by route name.
+
+    callback_data is encoded as ``<version>:<code>[:<arg>...]`` where `code`
+    is a short, stable identifier of the route, so dispatch is a single
+    dict lookup. Buttons sent before the encoding existed carry plain
+    strings such as ``view_ticket_12``; those are matched against the
+    registered legacy prefixes with a character trie.
+    """
+
+    def __init__(self, is_admin=None, denied_text="⛔️ شما دسترسی به پنل مدیریت ندارید!"):
+        self.is_admin = is_admin or (lambda user_id: False)
+        self.denied_text = denied_text
+        self._routes = {}
+        self._codes = {}
+        self._legacy = {}
+
+    def route(self, name, code=None, legacy=None, admin=False, answer=True):
+        """Register a handler called as ``handler(update, context, *args)``.
+
+        `legacy` is the old plain callback_data: an exact value, or a prefix
+        ending in ``_`` whose remainder is passed as the single argument.
+        Set `answer=False` when the handler answers the query itself.
+        """
+        def decorator(handler):
+            route_code = code or name
+            if route_code in self._codes:
+                raise ValueError(f"Duplicate callback code: {route_code}")
+            route = Route(name, route_code, handler, admin=admin, answer=answer)
+            self._routes[name] = route
+            self._codes[route_code] = route
+            self._add_legacy(legacy or name, route)
+            return handler
+        return decorator
+
+    def _add_legacy(self, prefix, route):
+        node = self._legacy
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = route
+
+    def _match_legacy(self, data):
+        node = self._legacy
+        match = None
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            # Exact values must match fully, only prefixes ending in "_" take an argument
+            if None in node and (char == '_' or i + 1 == len(data)):
+                match = (node[None], i + 1)
+        if match is None:
+            return None, ()
+        route, length = match
+        rest = data[length:]
+        return route, ((rest,) if rest else ())
+
+    def encode(self, name, *args):
+        route = self._routes.get(name)
+        code = route.code if route else name
+        data = SEPARATOR.join([CALLBACK_VERSION, code, *(str(arg) for arg in args)])
+        if len(data.encode('utf-8')) > MAX_CALLBACK_BYTES:
+            raise ValueError(f"callback_data too long for route {name}: {data!r}")
+        return data
+
+    def decode(self, data):
+        """Return ``(route, args)``; route is None for unknown data"""
+        if data.startswith(CALLBACK_VERSION + SEPARATOR):
+            parts = data.split(SEPARATOR)
+            return self._codes.get(parts[1]), tuple(parts[2:])
+        return self._match_legacy(data)
+
+    async def dispatch(self, update: Update, context):
+        query = update.callback_query
+        route, args = self.decode(query.data or '')
+        if route is None:
+            logger.warning(f"Unhandled callback data: {query.data!r}")
+            await query.answer("این بخش در حال حاضر در دسترس نیست!")
+            return
+
+        if route.admin and not self.is_admin(update.effective_user.id):
+            await query.answer()
+            await query.edit_message_text(self.denied_text)
+            return
+
+        started = time.perf_counter()
+        error = False
+        try:
+            with span(f"route.{route.name}"):
+                if route.answer:
+                    await query.answer()
+                await route.handler(update, context, *args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            route.stats.observe(time.perf_counter() - started, error)
+
+    def get_stats(self):
+        return {name: route.stats for name, route in self._routes.items()}
+
+    def collect_metrics(self):
+        """Text-format lines for the metrics registry, built from RouteStats"""
+        name = 'bot_callback_duration_seconds'
+        lines = [f"# HELP {name} Callback query handler latency per route",
+                 f"# TYPE {name} histogram"]
+        routes = self._routes.items()
+        lines.extend(render_histogram(name, ('route',), LATENCY_BUCKETS, [
+            ((route_name,), route.stats.buckets, route.stats.total_time)
+            for route_name, route in routes if route.stats.count
+        ]))
+        lines += ["# HELP bot_callback_errors_total Callback handlers that raised",
+                  "# TYPE bot_callback_errors_total counter"]
+        lines.extend(f'bot_callback_errors_total{{route="{route_name}"}} {route.stats.errors}'
+                     for route_name, route in routes if route.stats.count)
+        return lines
@@ -0,0 +1,151 @@
+import abc
+import heapq
+import time
+import asyncio
+
+
+class DeadlineQueue:
+    """Min-heap of keys ordered by deadline with O(log n) updates.
+
+    Changing or removing a key does not touch the heap; outdated entries
+    are dropped lazily when they reach the top.
+    """
+
+    def __init__(self, items=None):
+        self._deadlines = dict(items or {})
+        self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def get(self, key):
+        return self._deadlines.get(key)
+
+    def push(self, key, deadline):
+        """Set the deadline of `key`; returns False if it was unchanged"""
+        if self._deadlines.get(key) == deadline:
+            return False
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        return True
+
+    def remove(self, key):
+        self._deadlines.pop(key, None)
+
+    def _pop_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def peek(self):
+        """Earliest deadline, or None when empty"""
+        self._pop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def peek_item(self):
+        """``(deadline, key)`` with the earliest deadline, or None"""
+        self._pop_stale()
+        return self._heap[0] if self._heap else None
+
+    def smallest(self, n):
+        """The `n` earliest ``(deadline, key)`` pairs without popping them.
+
+        Walks the heap from the top in order, with a second heap of the
+        positions whose parents were visited, so only the entries up to the
+        `n`-th live one are looked at.
+        """
+        heap = self._heap
+        result = []
+        seen = set()
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier and len(result) < n:
+            (deadline, key), i = heapq.heappop(frontier)
+            # A key removed and pushed again with the same deadline has two entries
+            if self._deadlines.get(key) == deadline and key not in seen:
+                seen.add(key)
+                result.append((deadline, key))
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+        return result
+
+    def pop_due(self, now=None):
+        now = now if now is not None else time.time()
+        due = []
+        while True:
+            self._pop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            deadline, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+
+
+class DeadlineScheduler(abc.ABC):
+    """Run `process_due` on the job queue whenever a deadline is reached.
+
+    A single run_once job sleeps until the earliest deadline in `queue`.
+    Subclasses push deadlines with `schedule` and implement `process_due`.
+    """
+
+    job_name = 'deadline_scheduler'
+
+    def __init__(self):
+        self.queue = DeadlineQueue()
+        self._job_queue = None
+        self._job = None
+        self._job_deadline = None
+        self._loop = None
+        self._running = False
+
+    def schedule(self, key, deadline):
+        if self.queue.push(key, deadline) and (self._job_deadline is None or deadline < self._job_deadline):
+            self._reschedule()
+
+    def unschedule(self, key):
+        self.queue.remove(key)
+
+    def start(self, job_queue):
+        self._job_queue = job_queue
+        self._loop = asyncio.get_running_loop()
+        self._reschedule()
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _reschedule(self):
+        # schedule() may also be called from worker threads while due keys
+        # are being processed; _run reschedules itself once it is done.
+        if self._job_queue is None or self._running or not self._in_loop():
+            return
+        if self._job:
+            self._job.schedule_removal()
+            self._job = None
+        deadline = self.queue.peek()
+        self._job_deadline = deadline
+        if deadline is None:
+            return
+        self._job = self._job_queue.run_once(
+            self._run, when=max(0, deadline - time.time()), name=self.job_name
+        )
+
+    @abc.abstractmethod
+    async def process_due(self, keys, context):
+        """Handle the keys whose deadline passed; they are already off the queue"""
+
+    async def _run(self, context):
+        self._running = True
+        self._job = None
+        try:
+            due = self.queue.pop_due()
+            if due:
+                await self.process_due(due, context)
+        finally:
+            self._running = False
+            self._reschedule()
@@ -1,6 +1,17 @@
 import os
 import requests
-from urllib.parse import urlencode
+import time
+from urllib.parse import urlencode, parse_qs
+
+from metrics_handler import REGISTRY
+from tracing_handler import span
+
+request_duration = REGISTRY.histogram(
+    'directadmin_request_duration_seconds', 'DirectAdmin API request latency', labels=('command',)
+)
+request_errors = REGISTRY.counter(
+    'directadmin_request_errors', 'Failed DirectAdmin API requests', labels=('command',)
+)
 
 class DirectAdminHandler:
     def __init__(self, url, username, password):
@@ -12,18 +23,25 @@ class DirectAdminHandler:
     def _make_request(self, command, method='POST', data=None):
         """Make a request to DirectAdmin API"""
         url = f"{self.url}/{command}"
+        # Query strings carry usernames, keep them out of the metric labels
+        label = command.split('?')[0]
+        started = time.perf_counter()
         try:
-            response = self.session.request(
-                method,
-                url,
-                auth=(self.username, self.password),
-                data=data,
-                verify=False  # Note: In production, should be set to True
-            )
+            with span(f"directadmin.{label}"):
+                response = self.session.request(
+                    method,
+                    url,
+                    auth=(self.username, self.password),
+                    data=data,
+                    verify=False  # Note: In production, should be set to True
+                )
             response.raise_for_status()
             return response.text
         except requests.exceptions.RequestException as e:
+            request_errors.inc(label)
             raise Exception(f"DirectAdmin API Error: {str(e)}")
+        finally:
+            request_duration.observe(time.perf_counter() - started, label)
 
     def create_reseller_package(self, name, quota, bandwidth, domains=1):
         """Create a new hosting package"""
@@ -75,6 +93,15 @@ class DirectAdminHandler:
         }
         return self._make_request('CMD_API_SELECT_USERS', data=data)
 
+    def change_package(self, username, package):
+        """Move a user account to another package"""
+        data = {
+            'action': 'package',
+            'user': username,
+            'package': package
+        }
+        return self._make_request('CMD_API_MODIFY_USER', data=data)
+
     def delete_user(self, username):
         """Delete a user account"""
         data = {
@@ -87,3 +114,15 @@ class DirectAdminHandler:
     def get_user_info(self, username):
         """Get information about a user account"""
         return self._make_request(f'CMD_API_SHOW_USER_CONFIG?user={username}', method='GET')
+
+    def list_user_backups(self, username):
+        """List backup files stored on the server for a user"""
+        result = self._make_request(f'CMD_API_USER_BACKUP?user={username}', method='GET')
+        return parse_qs(result).get('list[]', [])
+
+    def delete_user_backups(self, username, files):
+        """Delete several backup files of a user in one request"""
+        data = {'action': 'delete', 'user': username}
+        for i, filename in enumerate(files):
+            data[f'select{i}'] = filename
+        return self._make_request('CMD_API_USER_BACKUP', data=data)
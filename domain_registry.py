@@ -0,0 +1,101 @@
+import re
+import time
+
+from deadline_queue import DeadlineQueue
+
+LABEL = re.compile(r'^(?!-)[a-z0-9-]{1,63}(?<!-)$')
+
+
+def normalize_domain(domain):
+    """Canonical form of a domain, or None if it is not a valid name.
+
+    Case, a scheme, path or port, a trailing dot and a leading ``www.`` are
+    dropped and internationalized names are converted to punycode, so
+    ``WWW.Example.com`` and ``https://example.com/`` are the same domain
+    and so are ``مثال.ir`` and ``xn--mgbh0fb.ir``.
+    """
+    domain = domain.strip().lower()
+    domain = re.sub(r'^[a-z][a-z0-9+.-]*://', '', domain)
+    domain = re.split(r'[/?#:]', domain, maxsplit=1)[0].rstrip('.')
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        return None
+    labels = domain.split('.')
+    if len(labels) < 2 or len(domain) > 253 or labels[-1].isdigit():
+        return None
+    if not all(LABEL.match(label) for label in labels):
+        return None
+    return domain
+
+
+class DomainRegistry:
+    """Which account owns each domain, plus reservations for unpaid orders.
+
+    Built from the accounts in `HostingManager` and kept current through
+    its listeners, so a lookup is a dict access. A reservation holds a
+    domain for one user from the domain step until the payment settles or
+    `reservation_ttl` seconds pass.
+
+    Nothing here is locked: `track` relies on `HostingManager` running its
+    listeners on the event loop (`set_listener_loop`), even for accounts
+    changed by blocking writes in worker threads.
+    """
+
+    def __init__(self, hosting_manager, reservation_ttl=1800):
+        self.reservation_ttl = reservation_ttl
+        self._owners = {}
+        self._domains_by_username = {}
+        self._reservations = {}
+        self._expiry = DeadlineQueue()
+        hosting_manager.add_account_listener(self.track)
+        for account in hosting_manager.get_all_accounts():
+            self.track(account)
+
+    def track(self, account):
+        username = account['username']
+        for domain in self._domains_by_username.pop(username, ()):
+            if self._owners.get(domain, {}).get('username') == username:
+                del self._owners[domain]
+        if account['status'] == 'deleted':
+            return
+        domains = {normalize_domain(d) or d.lower() for d in [account['domain'], *account.get('domains', [])]}
+        for domain in domains:
+            self._owners[domain] = account
+            self._reservations.pop(domain, None)
+            self._expiry.remove(domain)
+        self._domains_by_username[username] = domains
+
+    def owner(self, domain):
+        """The account serving a normalized `domain`, or None"""
+        return self._owners.get(domain)
+
+    def _expire(self, now):
+        for domain in self._expiry.pop_due(now):
+            del self._reservations[domain]
+
+    def reserve(self, domain, user_id, now=None):
+        """Hold `domain` for `user_id`; False if it is registered or held by someone else.
+
+        Reserving again as the same user extends the reservation.
+        """
+        now = now if now is not None else time.time()
+        self._expire(now)
+        if domain in self._owners:
+            return False
+        if self._reservations.get(domain, user_id) != user_id:
+            return False
+        self._reservations[domain] = user_id
+        self._expiry.push(domain, now + self.reservation_ttl)
+        return True
+
+    def release(self, domain, user_id):
+        if self._reservations.get(domain) == user_id:
+            del self._reservations[domain]
+            self._expiry.remove(domain)
+
+    def reserved_by(self, domain):
+        self._expire(time.time())
+        return self._reservations.get(domain)
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import time
+
+from hosting_handler import parse_datetime
+from deadline_queue import DeadlineScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler(DeadlineScheduler):
+    """Suspend hosting accounts exactly when they expire.
+
+    Active accounts are kept in a min-heap keyed by expiry time and a single
+    job-queue job sleeps until the earliest deadline. Account changes reach
+    the scheduler through `HostingManager` listeners, so renewals and new
+    accounts update the heap without rescanning. Suspensions go through
+    `async_hosting`, the store's `AsyncStore` facade.
+    """
+
+    job_name = 'expiry_scheduler'
+
+    def __init__(self, hosting_manager, async_hosting, batch_size=20, batch_pause=1.0, retry_delay=600):
+        super().__init__()
+        self.hosting_manager = hosting_manager
+        self.async_hosting = async_hosting
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.retry_delay = retry_delay
+        hosting_manager.add_account_listener(self.track)
+        self.rebuild()
+
+    def rebuild(self):
+        for account in self.hosting_manager.get_active_accounts():
+            self.queue.push(account['username'], parse_datetime(account['expiry_date']).timestamp())
+
+    def track(self, account):
+        if account['status'] != 'active':
+            self.unschedule(account['username'])
+            return
+        self.schedule(account['username'], parse_datetime(account['expiry_date']).timestamp())
+
+    async def _suspend_batch(self, usernames):
+        # Queued together, so the facade saves the store once per batch
+        results = await asyncio.gather(
+            *(self.async_hosting.suspend_account(username) for username in usernames),
+            return_exceptions=True
+        )
+        failed = []
+        for username, result in zip(usernames, results):
+            if isinstance(result, Exception):
+                result = {'status': 'error', 'message': str(result)}
+            if result['status'] != 'success':
+                logger.error(f"Failed to suspend expired account {username}: {result['message']}")
+                failed.append(username)
+        return failed
+
+    async def process_due(self, usernames, context):
+        logger.info(f"Suspending {len(usernames)} expired accounts")
+        for i in range(0, len(usernames), self.batch_size):
+            failed = await self._suspend_batch(usernames[i:i + self.batch_size])
+            for username in failed:
+                self.queue.push(username, time.time() + self.retry_delay)
+            if i + self.batch_size < len(usernames):
+                await asyncio.sleep(self.batch_pause)
@@ -0,0 +1,117 @@
+import time
+import logging
+from contextlib import asynccontextmanager
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class FloodControl:
+    """Per-user flood control that runs before the regular handlers.
+
+    Every update from a user spends a token from that user's bucket; callback
+    queries repeating the same callback_data inside `debounce_window` seconds
+    are collapsed into the first one. Expensive actions additionally use
+    `single_flight` so only one instance per user runs at a time. Throttled
+    users are counted for `offender_window` seconds after their last
+    throttled update.
+    """
+
+    def __init__(self, rate=1.0, burst=5, debounce_window=1.5, is_exempt=None, offender_window=3600):
+        self.rate = rate
+        self.burst = burst
+        self.debounce_window = debounce_window
+        self.offender_window = offender_window
+        self.is_exempt = is_exempt or (lambda user_id: False)
+        self._buckets = {}
+        self._recent_callbacks = {}
+        self._in_flight = set()
+        self.stats = {
+            'updates': 0,
+            'throttled': 0,
+            'debounced': 0,
+            'single_flight_rejected': 0
+        }
+        self._throttled_users = {}
+
+    def _bucket(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._prune()
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for user_id in [u for u, b in self._buckets.items()
+                        if b.tokens + (now - b.updated_at) * b.rate >= b.capacity]:
+            del self._buckets[user_id]
+        for key in [k for k, t in self._recent_callbacks.items() if now - t > self.debounce_window]:
+            del self._recent_callbacks[key]
+        self._prune_offenders(now)
+
+    def _prune_offenders(self, now):
+        for user_id in [u for u, (_, last) in self._throttled_users.items() if now - last > self.offender_window]:
+            del self._throttled_users[user_id]
+
+    def is_duplicate_callback(self, user_id, data):
+        now = time.monotonic()
+        key = (user_id, data)
+        last = self._recent_callbacks.get(key)
+        self._recent_callbacks[key] = now
+        if len(self._recent_callbacks) > 10000:
+            self._prune()
+        return last is not None and now - last < self.debounce_window
+
+    def is_throttled(self, user_id):
+        return not self._bucket(user_id).try_acquire()
+
+    async def guard(self, update: Update, context):
+        """Drop the update when the user is flooding; meant for the first handler group."""
+        user = update.effective_user
+        if user is None or self.is_exempt(user.id):
+            return
+        self.stats['updates'] += 1
+        query = update.callback_query
+
+        if query is not None and self.is_duplicate_callback(user.id, query.data):
+            self.stats['debounced'] += 1
+            await query.answer()
+            raise ApplicationHandlerStop
+
+        if self.is_throttled(user.id):
+            self.stats['throttled'] += 1
+            count, _ = self._throttled_users.get(user.id, (0, None))
+            self._throttled_users[user.id] = (count + 1, time.monotonic())
+            if len(self._throttled_users) > 10000:
+                self._prune_offenders(time.monotonic())
+            if query is not None:
+                await query.answer("⏳ لطفاً کمی صبر کنید!")
+            raise ApplicationHandlerStop
+
+    @asynccontextmanager
+    async def single_flight(self, user_id, action):
+        """Yield True if this is the only running `action` for the user."""
+        key = (user_id, action)
+        if key in self._in_flight:
+            self.stats['single_flight_rejected'] += 1
+            yield False
+            return
+        self._in_flight.add(key)
+        try:
+            yield True
+        finally:
+            self._in_flight.discard(key)
+
+    def top_offenders(self, limit=5):
+        """``(user_id, count)`` of the users throttled most within `offender_window`"""
+        self._prune_offenders(time.monotonic())
+        offenders = [(user_id, count) for user_id, (count, _) in self._throttled_users.items()]
+        return sorted(offenders, key=lambda item: item[1], reverse=True)[:limit]
+
+    def get_stats(self):
+        return dict(self.stats, in_flight=len(self._in_flight), tracked_users=len(self._buckets))
@@ -1,14 +1,36 @@
 import os
+import re
 import json
-from datetime import datetime
+import random
+import secrets
+import string
+import asyncio
+from datetime import datetime, timedelta
 import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from directadmin_handler import DirectAdminHandler
+from deadline_queue import DeadlineQueue
+from storage import save_json, SnapshotStore
+
+
+def parse_datetime(value):
+    """Parse an ISO string or a unix timestamp into a datetime"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return datetime.fromisoformat(value)
+
+
+class HostingManager(SnapshotStore):
+    snapshot_exclude = ('da_handler', '_account_listeners', '_listener_loop')
 
-class HostingManager:
     def __init__(self, da_handler, db_file='hosting.json'):
         self.da_handler = da_handler
         self.db_file = db_file
-        self._load_db()
+        self._account_listeners = []
+        self._listener_loop = None
+        if not self._load_snapshot():
+            self._load_db()
 
     def _load_db(self):
         try:
@@ -17,16 +39,97 @@ class HostingManager:
         except FileNotFoundError:
             self.db = {
                 'accounts': [],
-                'backups': [],
+                'backups': {},
                 'databases': []
             }
             self._save_db()
+        self._index_backups()
+        self._rebuild_account_stats()
+
+    def _rebuild_account_stats(self):
+        self._accounts_by_status = Counter()
+        self._accounts_by_plan = Counter()
+        self._active_by_user = Counter()
+        for account in self.db['accounts']:
+            self._count_account(account, 1)
+
+    def _count_account(self, account, delta):
+        self._accounts_by_status[account['status']] += delta
+        if account['status'] == 'active':
+            self._active_by_user[account['user_id']] += delta
+        if account['status'] != 'deleted':
+            self._accounts_by_plan[account['package']] += delta
+
+    def _index_backups(self):
+        # Backups are stored per username, oldest first, so expired records
+        # are always at the front of each list
+        if isinstance(self.db['backups'], list):
+            by_user = {}
+            for backup in sorted(self.db['backups'], key=lambda b: b['created_at']):
+                by_user.setdefault(backup['username'], []).append(backup)
+            self.db['backups'] = by_user
+        self._backups_by_id = {}
+        for backups in self.db['backups'].values():
+            for backup in backups:
+                if 'backup_id' in backup:
+                    self._backups_by_id[backup['backup_id']] = backup
+        # Users keyed by the creation time of their oldest backup
+        self._oldest_backup = DeadlineQueue({
+            username: parse_datetime(backups[0]['created_at']).timestamp()
+            for username, backups in self.db['backups'].items() if backups
+        })
 
     def _save_db(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.db, f, indent=2)
+        save_json(self.db_file, self.db)
+
+    def add_account_listener(self, listener):
+        """Call `listener(account)` whenever an account is created or changed"""
+        self._account_listeners.append(listener)
+
+    def set_listener_loop(self, loop):
+        """Run listeners on `loop` from now on, even for changes made in worker threads"""
+        self._listener_loop = loop
+
+    def _notify_account_change(self, account):
+        loop = self._listener_loop
+        if loop is not None:
+            try:
+                on_loop = asyncio.get_running_loop() is loop
+            except RuntimeError:
+                on_loop = False
+            if not on_loop:
+                try:
+                    loop.call_soon_threadsafe(self._call_listeners, account)
+                    return
+                except RuntimeError:
+                    # The loop is closed, nothing else runs on it any more
+                    pass
+        self._call_listeners(account)
 
-    def create_hosting_account(self, user_id, package, domain, email):
+    def _call_listeners(self, account):
+        for listener in self._account_listeners:
+            listener(account)
+
+    def _generate_username(self, domain):
+        # DirectAdmin usernames: lowercase, start with a letter, at most 10 chars
+        base = re.sub(r'[^a-z0-9]', '', domain.split('.')[0].lower())
+        if not base or not base[0].isalpha():
+            base = 'u' + base
+        base = base[:7]
+        existing = {acc['username'] for acc in self.db['accounts']}
+        while True:
+            username = f"{base}{random.randint(100, 999)}"
+            if username not in existing:
+                return username
+
+    def _generate_password(self, length=14):
+        alphabet = string.ascii_letters + string.digits
+        return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+    def _calculate_expiry_date(self, days=30, start=None):
+        return ((start or datetime.now()) + timedelta(days=days)).isoformat()
+
+    def create_hosting_account(self, user_id, package, domain, email, duration_days=30):
         try:
             username = self._generate_username(domain)
             password = self._generate_password()
@@ -49,10 +152,12 @@ class HostingManager:
                 'package': package,
                 'created_at': datetime.now().isoformat(),
                 'status': 'active',
-                'expiry_date': self._calculate_expiry_date()
+                'expiry_date': self._calculate_expiry_date(duration_days)
             }
             self.db['accounts'].append(account_data)
+            self._count_account(account_data, 1)
             self._save_db()
+            self._notify_account_change(account_data)
             
             return {
                 'status': 'success',
@@ -78,6 +183,11 @@ class HostingManager:
                     'cgi': 'ON'
                 }
             )
+            account = self.get_account(username)
+            if account:
+                account.setdefault('domains', []).append(domain)
+                self._save_db()
+                self._notify_account_change(account)
             return {'status': 'success', 'message': 'Domain added successfully'}
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
@@ -112,6 +222,9 @@ class HostingManager:
 
     def create_backup(self, username):
         try:
+            # Files already on the server, a new one means the backup finished
+            known_files = self.da_handler.list_user_backups(username)
+
             # Request backup through DirectAdmin
             result = self.da_handler._make_request(
                 'CMD_API_USER_BACKUP',
@@ -123,19 +236,105 @@ class HostingManager:
             )
             
             # Store backup info
+            self.db['last_backup_id'] = self.db.get('last_backup_id', 0) + 1
             backup_data = {
+                'backup_id': self.db['last_backup_id'],
                 'username': username,
                 'created_at': datetime.now().isoformat(),
                 'type': 'full',
-                'status': 'completed'
+                'status': 'queued',
+                'known_files': known_files
             }
-            self.db['backups'].append(backup_data)
+            backups = self.db['backups'].setdefault(username, [])
+            backups.append(backup_data)
+            self._backups_by_id[backup_data['backup_id']] = backup_data
+            if len(backups) == 1:
+                self._oldest_backup.push(username, parse_datetime(backup_data['created_at']).timestamp())
             self._save_db()
             
             return {'status': 'success', 'backup': backup_data}
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
 
+    def check_backup(self, backup_id):
+        """Mark a queued backup completed once its file shows up on the server"""
+        backup = self.get_backup(backup_id)
+        if not backup or backup['status'] != 'queued':
+            return backup
+        try:
+            files = self.da_handler.list_user_backups(backup['username'])
+        except Exception:
+            return backup
+        new_files = [f for f in files if f not in backup['known_files']]
+        if new_files:
+            self.update_backup(backup_id, status='completed', file=new_files[-1],
+                               completed_at=datetime.now().isoformat())
+        return backup
+
+    def update_backup(self, backup_id, **fields):
+        backup = self.get_backup(backup_id)
+        if backup:
+            backup.update(fields)
+            if backup['status'] != 'queued':
+                backup.pop('known_files', None)
+            self._save_db()
+        return backup
+
+    def get_backup(self, backup_id):
+        return self._backups_by_id.get(backup_id)
+
+    def get_pending_backups(self):
+        return [backup for backup in self._backups_by_id.values() if backup['status'] == 'queued']
+
+    def cleanup_old_backups(self, retention_days, plan_retention=None, batch_size=50):
+        """Drop backups older than their retention and delete their files on the server.
+
+        `plan_retention` maps a package to its own retention in days. Only
+        users whose oldest backup is past the shortest retention are visited.
+        Records of files that could not be deleted are kept and retried on
+        the next run.
+        """
+        plan_retention = plan_retention or {}
+        packages = {acc['username']: acc['package'] for acc in self.db['accounts']}
+        now = datetime.now()
+        shortest = min([retention_days, *plan_retention.values()])
+        due = self._oldest_backup.pop_due((now - timedelta(days=shortest)).timestamp())
+
+        deleted = 0
+        errors = []
+        for username in due:
+            days = plan_retention.get(packages.get(username), retention_days)
+            cutoff = (now - timedelta(days=days)).isoformat()
+            backups = self.db['backups'][username]
+            expired = 0
+            while expired < len(backups) and backups[expired]['created_at'] < cutoff:
+                expired += 1
+            files = [b['file'] for b in backups[:expired] if b.get('file')]
+            # Records of files the server failed to delete are kept for the next run
+            failed = set()
+            for i in range(0, len(files), batch_size):
+                try:
+                    self.da_handler.delete_user_backups(username, files[i:i + batch_size])
+                except Exception as e:
+                    errors.append(f"{username}: {e}")
+                    failed.update(files[i:i + batch_size])
+            kept = []
+            for backup in backups[:expired]:
+                if backup.get('file') in failed:
+                    kept.append(backup)
+                else:
+                    self._backups_by_id.pop(backup.get('backup_id'), None)
+            backups[:expired] = kept
+            deleted += expired - len(kept)
+            if backups:
+                self._oldest_backup.push(username, parse_datetime(backups[0]['created_at']).timestamp())
+            else:
+                del self.db['backups'][username]
+
+        if deleted:
+            self._save_db()
+        return {'status': 'error' if errors else 'success', 'deleted': deleted, 'errors': errors}
+
     def get_resource_usage(self, username):
         try:
             result = self.da_handler._make_request(
@@ -177,19 +376,121 @@ class HostingManager:
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
 
+    def renew_account(self, username, days=30):
+        """Extend the expiry date, counting from now if already expired"""
+        account = self.get_account(username)
+        if not account:
+            return {'status': 'error', 'message': 'Account not found'}
+        current = parse_datetime(account['expiry_date'])
+        account['expiry_date'] = self._calculate_expiry_date(days, start=max(current, datetime.now()))
+        account['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+        self._notify_account_change(account)
+        if account['status'] == 'suspended':
+            return self.unsuspend_account(username)
+        return {'status': 'success', 'message': 'Account renewed'}
+
     def _update_account_status(self, username, status):
         for account in self.db['accounts']:
             if account['username'] == username:
-                account['status'] = status
-                account['updated_at'] = datetime.now().isoformat()
+                self._change_account(account, status=status)
                 self._save_db()
                 break
 
+    def _change_account(self, account, **changes):
+        self._count_account(account, -1)
+        account.update(changes)
+        self._count_account(account, 1)
+        account['updated_at'] = datetime.now().isoformat()
+        self._notify_account_change(account)
+
+    def bulk_update(self, usernames, action, days=0, package=None, max_concurrent=4):
+        """Suspend, unsuspend, extend or change the package of several accounts.
+
+        At most `max_concurrent` DirectAdmin requests run at once and the
+        store is saved once for the whole batch. Accounts the action would
+        not change are skipped. Returns the usernames changed and skipped
+        and an error message per failed username.
+        """
+        accounts = [account for account in map(self.get_account, usernames) if account]
+        if action == 'suspend':
+            pending = [account for account in accounts if account['status'] == 'active']
+            request, changes = self.da_handler.suspend_user, {'status': 'suspended'}
+        elif action == 'unsuspend':
+            pending = [account for account in accounts if account['status'] == 'suspended']
+            request, changes = self.da_handler.unsuspend_user, {'status': 'active'}
+        elif action == 'package':
+            pending = [account for account in accounts
+                       if account['status'] != 'deleted' and account['package'] != package]
+            request, changes = lambda username: self.da_handler.change_package(username, package), {'package': package}
+        elif action == 'extend':
+            pending = [account for account in accounts if account['status'] != 'deleted']
+            request, changes = None, None
+        else:
+            raise ValueError(f"Unknown bulk action {action}")
+
+        errors = {}
+        if request:
+            def call(account):
+                try:
+                    request(account['username'])
+                    return None
+                except Exception as e:
+                    return str(e)
+            with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
+                for account, error in zip(pending, pool.map(call, pending)):
+                    if error:
+                        errors[account['username']] = error
+
+        changed = []
+        for account in pending:
+            if account['username'] in errors:
+                continue
+            if action == 'extend':
+                expiry = parse_datetime(account['expiry_date']) + timedelta(days=days)
+                self._change_account(account, expiry_date=expiry.isoformat())
+            else:
+                self._change_account(account, **changes)
+            changed.append(account['username'])
+        if changed:
+            self._save_db()
+        pending_names = {account['username'] for account in pending}
+        return {
+            'status': 'error' if errors else 'success',
+            'changed': changed,
+            'skipped': [username for username in usernames if username not in pending_names],
+            'errors': errors
+        }
+
+    def get_account(self, username):
+        for account in self.db['accounts']:
+            if account['username'] == username:
+                return account
+        return None
+
+    def has_active_account(self, user_id):
+        return self._active_by_user[user_id] > 0
+
+    def get_account_stats(self):
+        """Account counts by status and, excluding deleted accounts, by plan"""
+        return {
+            'total': len(self.db['accounts']),
+            'by_status': {status: count for status, count in self._accounts_by_status.items() if count},
+            'by_plan': {plan: count for plan, count in self._accounts_by_plan.items() if count}
+        }
+
+    def get_all_accounts(self):
+        return self.db['accounts']
+
+    def get_active_accounts(self):
+        return [acc for acc in self.db['accounts'] if acc['status'] == 'active']
+
     def get_user_accounts(self, user_id):
         return [acc for acc in self.db['accounts'] if acc['user_id'] == user_id]
 
     def get_account_backups(self, username):
-        return [backup for backup in self.db['backups'] if backup['username'] == username]
+        return [backup for backup in self.db['backups'].get(username, [])
+                if backup['status'] in ('queued', 'completed')]
 
     def get_account_databases(self, username):
         return [db for db in self.db['databases'] if db['username'] == username]
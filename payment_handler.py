@@ -1,6 +1,22 @@
+import os
 import json
+import asyncio
+import logging
+import threading
 import requests
 from datetime import datetime
+from metrics_handler import REGISTRY
+from storage import save_json, SnapshotStore
+from tracing_handler import span
+
+logger = logging.getLogger(__name__)
+
+gateway_duration = REGISTRY.histogram(
+    'zarinpal_request_duration_seconds', 'Zarinpal API latency', labels=('operation',)
+)
+gateway_errors = REGISTRY.counter(
+    'zarinpal_request_errors', 'Failed or rejected Zarinpal API calls', labels=('operation',)
+)
 
 class ZarinpalPayment:
     def __init__(self, merchant_id, sandbox=False):
@@ -22,7 +38,8 @@ class ZarinpalPayment:
         }
         
         try:
-            response = requests.post(f"{self.api_url}request", json=data)
+            with gateway_duration.time('request'), span('zarinpal.request'):
+                response = requests.post(f"{self.api_url}request", json=data)
             if response.status_code == 200:
                 result = response.json()['data']
                 if result['code'] == 100:
@@ -31,11 +48,13 @@ class ZarinpalPayment:
                         'authority': result['authority'],
                         'payment_url': f"{self.payment_url}{result['authority']}"
                     }
+            gateway_errors.inc('request')
             return {
                 'status': 'error',
                 'message': 'Payment request failed'
             }
         except Exception as e:
+            gateway_errors.inc('request')
             return {
                 'status': 'error',
                 'message': str(e)
@@ -49,7 +68,8 @@ class ZarinpalPayment:
         }
         
         try:
-            response = requests.post(f"{self.api_url}verify", json=data)
+            with gateway_duration.time('verify'), span('zarinpal.verify'):
+                response = requests.post(f"{self.api_url}verify", json=data)
             if response.status_code == 200:
                 result = response.json()['data']
                 if result['code'] == 100:
@@ -57,20 +77,65 @@ class ZarinpalPayment:
                         'status': 'success',
                         'ref_id': result['ref_id']
                     }
+            gateway_errors.inc('verify')
             return {
                 'status': 'error',
                 'message': 'Payment verification failed'
             }
         except Exception as e:
+            gateway_errors.inc('verify')
             return {
                 'status': 'error',
                 'message': str(e)
             }
 
-class PaymentDatabase:
+# Event type -> payment status it leads to
+PAYMENT_EVENTS = {
+    'requested': 'pending',
+    'redirected': 'redirected',
+    'verified': 'verified',
+    'failed': 'failed',
+    'refunded': 'refunded',
+}
+# Status -> event that sets it; 'pending' only comes from create_payment
+STATUS_EVENTS = {status: event for event, status in PAYMENT_EVENTS.items() if event != 'requested'}
+
+
+class PaymentDatabase(SnapshotStore):
+    """Payments as an append-only event log with a materialized view.
+
+    Every change is appended to ``<name>_events.jsonl`` as one event line;
+    event `n` is line `n`, so its offset is its line number. ``db`` holds
+    the current state of each payment built from the events, and
+    ``db['offset']`` is the last event it includes. The view is written to
+    ``payments.json`` when checkpointed (`_save_db`), every
+    `checkpoint_events` events and at snapshot time; on load, the events
+    after its offset are replayed. Behind an `AsyncStore` a checkpoint only
+    marks the view dirty and the facade writes it off the event loop.
+
+    Consumers (`PaymentConsumer`) read the log from their own checkpoint,
+    so they only see new events and a crash re-delivers from there. Events
+    a consumer keeps failing on are set aside in ``<name>_dead_letters.jsonl``.
+    """
+    snapshot_exclude = ('_waiters', '_checkpoint_lock')
+    # Events kept in memory for consumers that are caught up
+    recent_events = 1000
+    # Bounds the replay after a crash
+    checkpoint_events = 500
+
     def __init__(self, db_file='payments.json'):
         self.db_file = db_file
-        self._load_db()
+        base = os.path.splitext(db_file)[0]
+        self.events_file = base + '_events.jsonl'
+        self.checkpoint_file = base + '_checkpoints.json'
+        self.dead_letters_file = base + '_dead_letters.jsonl'
+        self._waiters = []
+        # Consumers commit from worker threads
+        self._checkpoint_lock = threading.Lock()
+        if not self._load_snapshot():
+            self._load_db()
+        self._replay()
+        self._load_checkpoints()
 
     def _load_db(self):
         try:
@@ -78,38 +143,213 @@ class PaymentDatabase:
                 self.db = json.load(f)
         except FileNotFoundError:
             self.db = {'payments': []}
-            self._save_db()
+        # Stores written before the event log have no offset
+        self.db.setdefault('offset', 0)
+        self._by_authority = {payment['authority']: payment for payment in self.db['payments']}
+        self._recent = []
+
+    def _replay(self):
+        """Apply logged events newer than the view, dropping a torn last line"""
+        try:
+            f = open(self.events_file, 'rb+')
+        except FileNotFoundError:
+            return
+        with f:
+            offset = 0
+            good_size = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += 1
+                good_size += len(line)
+                if offset > self.db['offset']:
+                    self._apply(json.loads(line))
+            # A crash mid-append leaves a partial line; the event never happened
+            f.truncate(good_size)
 
     def _save_db(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.db, f, indent=2)
+        save_json(self.db_file, self.db)
 
-    def create_payment(self, user_id, amount, description, authority):
-        payment = {
-            'user_id': user_id,
-            'amount': amount,
-            'description': description,
-            'authority': authority,
-            'status': 'pending',
-            'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
-        self.db['payments'].append(payment)
+    def save_snapshot(self):
+        # Checkpoint the view first so the next start replays only new events
         self._save_db()
+        super().save_snapshot()
+
+    def _apply(self, event):
+        authority = event['authority']
+        if event['type'] == 'requested':
+            payment = {
+                'user_id': event['user_id'],
+                'amount': event['amount'],
+                'description': event['description'],
+                'authority': authority,
+                'metadata': event.get('metadata') or {},
+                'status': 'pending',
+                'created_at': event['at'],
+                'updated_at': event['at']
+            }
+            self.db['payments'].append(payment)
+            self._by_authority[authority] = payment
+        else:
+            payment = self._by_authority[authority]
+            payment['status'] = PAYMENT_EVENTS[event['type']]
+            if 'ref_id' in event:
+                payment['ref_id'] = event['ref_id']
+            payment['updated_at'] = event['at']
+        self.db['offset'] = event['offset']
+        self._recent.append(event)
+        if len(self._recent) > self.recent_events:
+            del self._recent[:-self.recent_events]
+        return payment
+
+    def append(self, event_type, authority, **data):
+        """Log an event and apply it to the view; returns the payment"""
+        if event_type not in PAYMENT_EVENTS:
+            raise ValueError(f"Unknown payment event {event_type}")
+        if (event_type == 'requested') == (authority in self._by_authority):
+            if event_type == 'requested':
+                raise ValueError(f"Payment {authority} already exists")
+            return None
+        event = {'offset': self.db['offset'] + 1, 'type': event_type, 'authority': authority,
+                 'at': datetime.now().isoformat(), **data}
+        with span('store.payments.append'):
+            with open(self.events_file, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+        payment = self._apply(event)
+        if event['offset'] % self.checkpoint_events == 0:
+            self._save_db()
+        self._wake()
         return payment
 
+    def create_payment(self, user_id, amount, description, authority, metadata=None):
+        return self.append('requested', authority, user_id=user_id, amount=amount,
+                           description=description, metadata=metadata or {})
+
+    def mark_redirected(self, authority):
+        """The payment link was handed to the user"""
+        return self.append('redirected', authority)
+
     def update_payment(self, authority, status, ref_id=None):
-        for payment in self.db['payments']:
-            if payment['authority'] == authority:
-                payment['status'] = status
-                payment['ref_id'] = ref_id
-                payment['updated_at'] = datetime.now().isoformat()
-                self._save_db()
-                return payment
-        return None
+        if status not in STATUS_EVENTS:
+            raise ValueError(f"Cannot set payment {authority} to {status!r}, expected one of {sorted(STATUS_EVENTS)}")
+        event_type = STATUS_EVENTS[status]
+        if ref_id is not None:
+            return self.append(event_type, authority, ref_id=ref_id)
+        return self.append(event_type, authority)
 
     def get_payment(self, authority):
-        for payment in self.db['payments']:
-            if payment['authority'] == authority:
-                return payment
-        return None
+        return self._by_authority.get(authority)
+
+    def read_events(self, after, limit=100):
+        """Up to `limit` events with offsets greater than `after`"""
+        if self._recent and self._recent[0]['offset'] <= after + 1:
+            start = after + 1 - self._recent[0]['offset']
+            return self._recent[start:start + limit]
+        events = []
+        with open(self.events_file, 'rb') as f:
+            for offset, line in enumerate(f, 1):
+                # An append still being written, like in _replay
+                if not line.endswith(b'\n'):
+                    break
+                if offset > after:
+                    events.append(json.loads(line))
+                    if len(events) == limit:
+                        break
+        return events
+
+    async def wait_for_events(self, after):
+        """Return once an event with an offset greater than `after` exists"""
+        if self.db['offset'] > after:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        await future
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            if not future.done():
+                future.get_loop().call_soon_threadsafe(future.set_result, None)
+
+    def _load_checkpoints(self):
+        try:
+            with open(self.checkpoint_file, 'r') as f:
+                self.checkpoints = json.load(f)
+        except FileNotFoundError:
+            self.checkpoints = {}
+
+    def commit(self, consumer, offset):
+        with self._checkpoint_lock:
+            self.checkpoints[consumer] = offset
+            save_json(self.checkpoint_file, self.checkpoints)
+
+    def dead_letter(self, consumer, event, error):
+        """Record an event `consumer` gave up on, for an admin to look into"""
+        entry = {'consumer': consumer, 'event': event, 'error': error, 'at': datetime.now().isoformat()}
+        with open(self.dead_letters_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+class PaymentConsumer:
+    """Deliver payment events to `handler` (sync or async) in order.
+
+    The position is checkpointed after each batch, so delivery is at least
+    once: after a crash, events since the last checkpoint are handled again
+    and handlers should tolerate seeing an event twice. A failing event
+    holds the consumer back and is retried with exponential backoff; after
+    `max_attempts` it goes to the dead-letter log and the consumer moves on.
+    """
+
+    def __init__(self, payment_db, name, handler, batch=100, max_attempts=5, retry_delay=1, max_retry_delay=60):
+        self.payment_db = payment_db
+        self.name = name
+        self.handler = handler
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.offset = payment_db.checkpoints.get(name, 0)
+        self._task = None
+
+    async def _deliver(self, event):
+        delay = self.retry_delay
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                result = self.handler(event)
+                if asyncio.iscoroutine(result):
+                    await result
+                return
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Payment consumer {self.name} failed on event {event['offset']} "
+                             f"(attempt {attempt}/{self.max_attempts}): {e}")
+            if attempt == 1:
+                # Keep the events handled so far if we are stopped while backing off
+                await asyncio.to_thread(self.payment_db.commit, self.name, self.offset)
+            if attempt < self.max_attempts:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        await asyncio.to_thread(self.payment_db.dead_letter, self.name, event, error)
+
+    async def run(self):
+        while True:
+            try:
+                await self.payment_db.wait_for_events(self.offset)
+                events = await asyncio.to_thread(self.payment_db.read_events, self.offset, self.batch)
+                for event in events:
+                    await self._deliver(event)
+                    self.offset = event['offset']
+                if events:
+                    await asyncio.to_thread(self.payment_db.commit, self.name, self.offset)
+            except Exception as e:
+                # e.g. an unreadable log or checkpoint; resume from the last handled event
+                logger.error(f"Payment consumer {self.name} stopped at offset {self.offset}: {e}")
+                await asyncio.sleep(self.max_retry_delay)
+
+    def start(self):
+        # Plain task, not application.create_task: those are awaited on shutdown
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
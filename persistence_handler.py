@@ -0,0 +1,143 @@
+import json
+import time
+import sqlite3
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """Keyed persistence for user, chat, bot and conversation data.
+
+    Every user/chat is one row, written only when its serialized value
+    changed since the last write. Empty entries are deleted instead of
+    stored, so at startup only users that are in the middle of a flow are
+    loaded. Entries not touched for `ttl` seconds are treated as abandoned:
+    they are skipped on load and cleared the next time the user shows up.
+    """
+
+    def __init__(self, db_file='state.db', ttl=86400, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval
+        )
+        self.db_file = db_file
+        self.ttl = ttl
+        self._written = {}
+        self._touched = {}
+        self._connect()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'updated_at REAL NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS state_updated_at ON state (namespace, updated_at)')
+
+    def _expired(self, updated_at, now=None):
+        return self.ttl and updated_at < (now or time.time()) - self.ttl
+
+    def _load(self, namespace, expires=True):
+        now = time.time()
+        if expires and self.ttl:
+            self.conn.execute(
+                'DELETE FROM state WHERE namespace = ? AND updated_at < ?',
+                (namespace, now - self.ttl)
+            )
+        rows = self.conn.execute(
+            'SELECT key, value, updated_at FROM state WHERE namespace = ?',
+            (namespace,)
+        )
+        result = {}
+        for key, value, updated_at in rows:
+            self._written[(namespace, key)] = value
+            self._touched[(namespace, key)] = updated_at
+            result[key] = json.loads(value)
+        return result
+
+    def _write(self, namespace, key, data):
+        key = str(key)
+        if not data:
+            self._delete(namespace, key)
+            return
+        value = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        now = time.time()
+        if self._written.get((namespace, key)) == value:
+            return
+        self.conn.execute(
+            'INSERT INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+            (namespace, key, value, now)
+        )
+        self._written[(namespace, key)] = value
+        self._touched[(namespace, key)] = now
+
+    def _delete(self, namespace, key):
+        key = str(key)
+        if self._written.pop((namespace, key), None) is not None:
+            self.conn.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+        self._touched.pop((namespace, key), None)
+
+    def _refresh(self, namespace, key, data):
+        updated_at = self._touched.get((namespace, str(key)))
+        if updated_at is not None and self._expired(updated_at):
+            logger.info(f"Expiring abandoned {namespace} data for {key}")
+            data.clear()
+            self._delete(namespace, key)
+
+    async def get_user_data(self):
+        return {int(k): v for k, v in self._load('user').items()}
+
+    async def get_chat_data(self):
+        return {int(k): v for k, v in self._load('chat').items()}
+
+    async def get_bot_data(self):
+        return self._load('bot', expires=False).get('bot', {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(k)): v for k, v in self._load(f'conversation:{name}').items()}
+
+    async def update_conversation(self, name, key, new_state):
+        namespace = f'conversation:{name}'
+        if new_state is None:
+            self._delete(namespace, json.dumps(list(key)))
+        else:
+            self._write(namespace, json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._write('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._write('chat', chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._write('bot', 'bot', data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        self._delete('chat', chat_id)
+
+    async def drop_user_data(self, user_id):
+        self._delete('user', user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        self._refresh('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        self.conn.close()
@@ -0,0 +1,185 @@
+import json
+import asyncio
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from urllib.parse import parse_qs
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+
+from metrics_handler import REGISTRY
+from storage import save_json
+
+logger = logging.getLogger(__name__)
+
+RESOURCES = {'quota': '💾 فضا', 'bandwidth': '🌐 پهنای باند'}
+LEVEL_NAMES = {1: '🟡', 2: '🟠', 3: '🔴'}
+
+quota_alerts = REGISTRY.counter(
+    'bot_quota_alerts', 'Accounts that crossed a quota threshold', labels=('resource',)
+)
+
+
+def parse_usage(raw):
+    """Disk and bandwidth use in MB from a CMD_API_SHOW_USER_USAGE reply"""
+    values = parse_qs(raw)
+    return {resource: float(values[resource][0]) for resource in RESOURCES if resource in values}
+
+
+def evaluate_levels(ratios, previous, thresholds, hysteresis):
+    """Alert level of every ratio at once: the number of thresholds reached.
+
+    A level goes up as soon as its threshold is reached but only comes
+    down once the ratio is `hysteresis` below it, so usage hovering around
+    a threshold does not alert on every check.
+    """
+    raised = [bisect_right(thresholds, ratio) for ratio in ratios]
+    lowered = [bisect_right(thresholds, ratio + hysteresis) for ratio in ratios]
+    return [max(up, min(prev, down)) for up, down, prev in zip(raised, lowered, previous)]
+
+
+class QuotaMonitor:
+    """Collect disk and bandwidth usage of active accounts and alert near plan limits.
+
+    Every `interval` seconds the latest usage of each account is fetched
+    with `fetch_usage(username)`, at most `max_concurrent` at a time, and
+    stored in `quota_alerts.json`. Usage is compared with the `quota` and
+    `bandwidth` of the account's plan for all accounts in one pass.
+    Accounts that reach a higher level than at the last check are
+    reported: one message per customer with an upgrade button per account,
+    and one digest per admin.
+    """
+
+    job_name = 'quota_monitor'
+
+    def __init__(self, hosting_manager, admin_panel, sender, fetch_usage, upgrade_callback,
+                 db_file='quota_alerts.json', thresholds=(0.8, 0.95, 1.0), hysteresis=0.05,
+                 max_concurrent=4):
+        self.hosting_manager = hosting_manager
+        self.admin_panel = admin_panel
+        self.fetch_usage = fetch_usage
+        self.upgrade_callback = upgrade_callback
+        self.db_file = db_file
+        self.thresholds = sorted(thresholds)
+        self.hysteresis = hysteresis
+        self.max_concurrent = max_concurrent
+        self.sender = sender
+        self._load_db()
+
+    def _load_db(self):
+        try:
+            with open(self.db_file, 'r') as f:
+                self.db = json.load(f)
+        except FileNotFoundError:
+            self.db = {'usage': {}, 'levels': {}}
+            self._save_db()
+
+    def _save_db(self):
+        save_json(self.db_file, self.db)
+
+    def start(self, job_queue, interval=3600, first=120):
+        job_queue.run_repeating(self.check, interval=interval, first=first, name=self.job_name)
+
+    async def collect(self, accounts):
+        """Fetch and store the current usage of `accounts`"""
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        async def fetch(account):
+            async with semaphore:
+                result = await self.fetch_usage(account['username'])
+            if result['status'] != 'success':
+                logger.warning(f"Could not fetch usage of {account['username']}: {result['message']}")
+                return
+            try:
+                usage = parse_usage(result['usage'])
+            except ValueError:
+                logger.warning(f"Unexpected usage reply for {account['username']}: {result['usage']!r}")
+                return
+            self.db['usage'][account['username']] = dict(usage, at=datetime.now().isoformat())
+
+        await asyncio.gather(*(fetch(account) for account in accounts))
+
+    def evaluate(self, accounts):
+        """Update alert levels; returns ``(account, resource, ratio, level)`` for levels that went up"""
+        plans = self.admin_panel.get_plans()
+        alerts = []
+        for resource in RESOURCES:
+            # Columns of the accounts that have both a usage sample and a limit
+            rows, ratios, previous = [], [], []
+            for account in accounts:
+                used = self.db['usage'].get(account['username'], {}).get(resource)
+                limit = plans.get(account['package'], {}).get(resource)
+                if used is None or not limit:
+                    continue
+                rows.append(account)
+                ratios.append(used / limit)
+                previous.append(self.db['levels'].get(account['username'], {}).get(resource, 0))
+
+            levels = evaluate_levels(ratios, previous, self.thresholds, self.hysteresis)
+            for account, ratio, prev, level in zip(rows, ratios, previous, levels):
+                if level == prev:
+                    continue
+                self.db['levels'].setdefault(account['username'], {})[resource] = level
+                if level > prev:
+                    alerts.append((account, resource, ratio, level))
+                    quota_alerts.inc(resource)
+        return alerts
+
+    def format_alert(self, items):
+        lines = ["⚠️ هشدار مصرف منابع هاست\n"]
+        for account, resource, ratio, level in items:
+            lines.append(f"{LEVEL_NAMES.get(level, '🔴')} {account['domain']}")
+            lines.append(f"{RESOURCES[resource]}: {ratio:.0%} از سقف پلن\n")
+        lines.append("با رسیدن به سقف، سایت شما از دسترس خارج می‌شود. برای جلوگیری، پلن هاست خود را ارتقا دهید.")
+        return "\n".join(lines)
+
+    def format_digest(self, alerts):
+        lines = [f"📊 گزارش مصرف منابع: {len(alerts)} هشدار جدید\n"]
+        for account, resource, ratio, level in sorted(alerts, key=lambda alert: -alert[2])[:50]:
+            lines.append(
+                f"{LEVEL_NAMES.get(level, '🔴')} {account['domain']} ({account['package']}) "
+                f"{RESOURCES[resource]}: {ratio:.0%}"
+            )
+        if len(alerts) > 50:
+            lines.append(f"\n... و {len(alerts) - 50} مورد دیگر")
+        return "\n".join(lines)
+
+    async def notify(self, bot, alerts):
+        by_user = {}
+        for alert in alerts:
+            by_user.setdefault(alert[0]['user_id'], []).append(alert)
+        for user_id, items in by_user.items():
+            accounts = {account['username']: account for account, *_ in items}
+            keyboard = [[InlineKeyboardButton(
+                f"⬆️ ارتقای {account['domain']}",
+                callback_data=self.upgrade_callback(username)
+            )] for username, account in accounts.items()]
+            try:
+                await self.sender.send_message(
+                    user_id,
+                    self.format_alert(items),
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+            except TelegramError as e:
+                logger.warning(f"Could not send quota alert to {user_id}: {e}")
+
+        digest = self.format_digest(alerts)
+        for admin_id in self.admin_panel.db['admins']:
+            try:
+                await self.sender.send_message(int(admin_id), digest)
+            except TelegramError as e:
+                logger.warning(f"Could not send quota digest to admin {admin_id}: {e}")
+
+    async def check(self, context):
+        accounts = self.hosting_manager.get_active_accounts()
+        await self.collect(accounts)
+        alerts = self.evaluate(accounts)
+        # Forget accounts that are no longer active
+        active = {account['username'] for account in accounts}
+        for key in ('usage', 'levels'):
+            for username in [username for username in self.db[key] if username not in active]:
+                del self.db[key][username]
+        self._save_db()
+        if alerts:
+            logger.info(f"{len(alerts)} quota alerts")
+            await self.notify(context.bot, alerts)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """Allow `rate` operations per second with bursts up to `capacity`"""
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """Seconds until `tokens` would be available"""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    def pause(self, seconds):
+        """Drain the bucket so nothing is allowed for `seconds`"""
+        self._refill()
+        self.tokens = -seconds * self.rate
+
+
+class RateLimitedSender:
+    """Send messages under Telegram's global and per-chat flood limits.
+
+    A single global bucket bounds the overall rate; each chat additionally
+    gets at most one message per `per_chat_interval` seconds. `RetryAfter`
+    responses pause the whole sender for the requested time and retry.
+
+    The limit is per bot, so a process keeps one sender shared by every
+    feature that sends in bulk. `bot` may be set once the application is
+    built.
+    """
+
+    def __init__(self, bot=None, rate=25, per_chat_interval=1.0, max_retries=3):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._last_sent = {}
+
+    async def _wait_for_chat(self, chat_id):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            wait = self.per_chat_interval - (time.monotonic() - last)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def _forget_idle_chats(self):
+        cutoff = time.monotonic() - self.per_chat_interval
+        for chat_id in [c for c, t in self._last_sent.items() if t < cutoff]:
+            del self._last_sent[chat_id]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self._last_sent[chat_id] = time.monotonic()
+                if len(self._last_sent) > 10000:
+                    self._forget_idle_chats()
+                return message
+            except RetryAfter as e:
+                logger.warning(f"Flood limit hit, retrying in {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+                if attempt == self.max_retries:
+                    raise
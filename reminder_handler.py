@@ -0,0 +1,164 @@
+import json
+import time
+import logging
+from datetime import datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+
+from deadline_queue import DeadlineScheduler
+from hosting_handler import parse_datetime
+from storage import save_json
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+
+class ReminderScheduler(DeadlineScheduler):
+    """Remind customers 7, 3 and 1 days before their hosting expires.
+
+    Accounts are ordered by the time of their next reminder, which is
+    derived from the expiry date, so each run only touches accounts that
+    are actually due. Reminders for the same customer are grouped into a
+    single message. Stages already sent for the current expiry date are
+    recorded in `reminders.json` and dropped when the account is renewed
+    or deleted. Changes are saved once per run rather than per account;
+    entries dropped in between are only stale, and are swept again at
+    startup if the bot stops first.
+    """
+
+    job_name = 'reminder_scheduler'
+
+    def __init__(self, hosting_manager, sender, renew_callback, db_file='reminders.json',
+                 stages=(7, 3, 1)):
+        super().__init__()
+        self.hosting_manager = hosting_manager
+        self.renew_callback = renew_callback
+        self.db_file = db_file
+        self.stages = sorted(stages, reverse=True)
+        self.sender = sender
+        self._dirty = False
+        self._load_db()
+        hosting_manager.add_account_listener(self.track)
+        for account in hosting_manager.get_active_accounts():
+            self.track(account)
+        # Entries left by renewals and deletions while the bot was down
+        accounts = {account['username']: account for account in hosting_manager.get_all_accounts()}
+        stale = [username for username, state in self.db['reminders'].items()
+                 if self._is_stale(state, accounts.get(username))]
+        for username in stale:
+            del self.db['reminders'][username]
+        if stale or self._dirty:
+            self._flush()
+
+    def _load_db(self):
+        try:
+            with open(self.db_file, 'r') as f:
+                self.db = json.load(f)
+        except FileNotFoundError:
+            self.db = {'reminders': {}}
+            self._save_db()
+
+    def _save_db(self):
+        save_json(self.db_file, self.db)
+
+    def _flush(self):
+        self._dirty = False
+        self._save_db()
+
+    def _is_stale(self, state, account):
+        return not account or account['status'] == 'deleted' or state['expiry_date'] != account['expiry_date']
+
+    def _sent_stages(self, account):
+        state = self.db['reminders'].get(account['username'])
+        if not state or state['expiry_date'] != account['expiry_date']:
+            return []
+        return state['sent']
+
+    def next_reminder(self, account, now=None):
+        """Return ``(stage, when)`` of the next reminder, or None"""
+        now = now or time.time()
+        expiry = parse_datetime(account['expiry_date']).timestamp()
+        if expiry <= now:
+            return None
+        sent = self._sent_stages(account)
+        pending = [stage for stage in self.stages if stage not in sent]
+        for i, stage in enumerate(pending):
+            when = expiry - stage * DAY
+            # A stage is superseded when the next, closer stage is already due
+            if i + 1 < len(pending) and expiry - pending[i + 1] * DAY <= now:
+                continue
+            if sent and stage > min(sent):
+                continue
+            return stage, when
+        return None
+
+    def track(self, account):
+        state = self.db['reminders'].get(account['username'])
+        if state and self._is_stale(state, account):
+            del self.db['reminders'][account['username']]
+            self._dirty = True
+        if account['status'] != 'active':
+            self.unschedule(account['username'])
+            return
+        reminder = self.next_reminder(account)
+        if reminder is None:
+            self.unschedule(account['username'])
+        else:
+            self.schedule(account['username'], reminder[1])
+
+    def _mark_sent(self, account, stage):
+        state = self.db['reminders'].get(account['username'])
+        if not state or state['expiry_date'] != account['expiry_date']:
+            state = self.db['reminders'][account['username']] = {
+                'expiry_date': account['expiry_date'],
+                'sent': []
+            }
+        state['sent'].append(stage)
+        state['updated_at'] = datetime.now().isoformat()
+        self._dirty = True
+
+    def format_reminder(self, items):
+        lines = ["⏰ یادآوری تمدید هاست\n"]
+        for account, stage in items:
+            days_left = max(0, int((parse_datetime(account['expiry_date']).timestamp() - time.time()) // DAY))
+            lines.append(f"🌐 {account['domain']}")
+            lines.append(f"📅 {days_left or 'کمتر از یک'} روز تا پایان اعتبار\n")
+        lines.append("برای جلوگیری از تعلیق سرویس، لطفاً هاست خود را تمدید کنید.")
+        return "\n".join(lines)
+
+    async def process_due(self, usernames, context):
+        by_user = {}
+        now = time.time()
+        for username in usernames:
+            account = self.hosting_manager.get_account(username)
+            if not account or account['status'] != 'active':
+                continue
+            reminder = self.next_reminder(account, now)
+            if reminder is None:
+                continue
+            stage, when = reminder
+            if when > now:
+                self.queue.push(username, when)
+                continue
+            by_user.setdefault(account['user_id'], []).append((account, stage))
+
+        for user_id, items in by_user.items():
+            keyboard = [[InlineKeyboardButton(
+                f"🔄 تمدید {account['domain']}",
+                callback_data=self.renew_callback(account['username'])
+            )] for account, stage in items]
+            try:
+                await self.sender.send_message(
+                    user_id,
+                    self.format_reminder(items),
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+            except TelegramError as e:
+                logger.warning(f"Could not send renewal reminder to {user_id}: {e}")
+            # Marked even on failure so a blocked user is not retried every run
+            for account, stage in items:
+                self._mark_sent(account, stage)
+                self.track(account)
+        if self._dirty:
+            self._flush()
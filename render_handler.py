@@ -0,0 +1,113 @@
+"""Message templates for list views.
+
+A `Template` is parsed once into literal text and fields; rendering a row
+only looks fields up and joins the pieces. Jalali dates are memoized, so a
+timestamp shown on every refresh of a list is converted once.
+"""
+from string import Formatter
+from functools import lru_cache
+
+import jdatetime
+
+from hosting_handler import parse_datetime
+from tracing_handler import span
+
+# Telegram's limit, counted in UTF-16 code units like the Bot API does
+MESSAGE_LIMIT = 4096
+
+DATE_FORMATS = {
+    'jalali': '%Y/%m/%d %H:%M',
+    'jalali_date': '%Y/%m/%d',
+}
+
+
+@lru_cache(maxsize=8192)
+def format_jalali(value, fmt='%Y/%m/%d %H:%M'):
+    """Format an ISO string or timestamp as a Jalali date"""
+    with span('jdatetime'):
+        return jdatetime.datetime.fromgregorian(datetime=parse_datetime(value)).strftime(fmt)
+
+
+class Template:
+    """A ``str.format`` style template compiled once.
+
+    Fields name keys of the row being rendered or keyword arguments of
+    `render`, which take precedence. The ``jalali`` and ``jalali_date``
+    specs format a date; other specs go to `format`.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._parts = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if conversion:
+                raise ValueError(f"Conversions are not supported: {text!r}")
+            if literal:
+                self._parts.append((literal, None, None))
+            if field is not None:
+                if not field:
+                    raise ValueError(f"Fields must be named: {text!r}")
+                self._parts.append((None, field, spec))
+
+    def render(self, row=None, **values):
+        pieces = []
+        for literal, field, spec in self._parts:
+            if field is None:
+                pieces.append(literal)
+                continue
+            value = values[field] if field in values else row[field]
+            if spec in DATE_FORMATS:
+                pieces.append(format_jalali(value, DATE_FORMATS[spec]))
+            elif spec:
+                pieces.append(format(value, spec))
+            else:
+                pieces.append(str(value))
+        return ''.join(pieces)
+
+
+def message_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_block(block, limit):
+    """Cut a block longer than `limit` at line ends, or anywhere for a single long line"""
+    lines = []
+    for line in block.splitlines(keepends=True):
+        # limit // 2 characters always fit, even if every one is an emoji
+        while message_length(line) > limit:
+            lines.append(line[:limit // 2])
+            line = line[limit // 2:]
+        lines.append(line)
+    pieces, current, size = [], [], 0
+    for line in lines:
+        length = message_length(line)
+        if current and size + length > limit:
+            pieces.append(''.join(current))
+            current, size = [], 0
+        current.append(line)
+        size += length
+    if current:
+        pieces.append(''.join(current))
+    return pieces
+
+
+def pack_messages(blocks, limit=MESSAGE_LIMIT, separator='\n'):
+    """Join blocks into as few messages as fit Telegram's limit.
+
+    Blocks (a header, one per record, a footer) are never split across
+    messages unless a single block is itself too long.
+    """
+    messages, current, size = [], [], 0
+    separator_length = message_length(separator)
+    for block in blocks:
+        pieces = split_block(block, limit) if message_length(block) > limit else [block]
+        for piece in pieces:
+            length = message_length(piece)
+            if current and size + separator_length + length > limit:
+                messages.append(separator.join(current))
+                current, size = [], 0
+            size += length + (separator_length if current else 0)
+            current.append(piece)
+    if current:
+        messages.append(separator.join(current))
+    return messages
@@ -0,0 +1,76 @@
+import re
+from collections import Counter
+
+# Arabic code points that Persian keyboards and pasted text mix in
+_CHAR_MAP = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی',  # yeh
+    'ك': 'ک',  # kaf
+    'ة': 'ه', 'ۀ': 'ه',  # teh marbuta, heh with yeh
+    'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',  # alef with hamza
+    'ؤ': 'و',  # waw with hamza
+    '\u200c': '', '\u200d': '', '\u0640': '',  # ZWNJ, ZWJ, tatweel
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+_DIACRITICS = re.compile('[\u064b-\u065f\u0670]')
+_TOKEN = re.compile(r'\w+')
+
+
+def normalize(text):
+    """Unify Persian/Arabic letter variants, digits, ZWNJ and case"""
+    return _DIACRITICS.sub('', text.translate(_CHAR_MAP)).lower()
+
+
+def normalize_with_offsets(text):
+    """`normalize(text)` and, for each of its characters, its index in `text`
+
+    Normalizing drops characters such as ZWNJ and diacritics, so positions
+    found in the normalized text have to be mapped back before slicing the
+    original.
+    """
+    pieces = []
+    offsets = []
+    for i, char in enumerate(text):
+        normalized = normalize(char)
+        pieces.append(normalized)
+        offsets.extend([i] * len(normalized))
+    return ''.join(pieces), offsets
+
+
+def tokenize(text):
+    return _TOKEN.findall(normalize(text))
+
+
+class InvertedIndex:
+    """Map each token to the documents containing it, with term counts.
+
+    Documents are only ever added to, matching how tickets grow, so there
+    is no removal. A query matches documents containing every token and is
+    evaluated starting from the rarest token.
+    """
+
+    def __init__(self):
+        self._postings = {}
+
+    def add(self, doc_id, text):
+        for token, count in Counter(tokenize(text)).items():
+            postings = self._postings.setdefault(token, {})
+            postings[doc_id] = postings.get(doc_id, 0) + count
+
+    def search(self, query):
+        """Return {doc_id: score} for documents matching every query token"""
+        tokens = set(tokenize(query))
+        if not tokens:
+            return {}
+        postings = sorted((self._postings.get(token, {}) for token in tokens), key=len)
+        if not postings[0]:
+            return {}
+        scores = dict(postings[0])
+        for other in postings[1:]:
+            scores = {doc_id: score + other[doc_id] for doc_id, score in scores.items() if doc_id in other}
+            if not scores:
+                break
+        return scores
+
+    def __len__(self):
+        return len(self._postings)
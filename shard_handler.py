@@ -0,0 +1,384 @@
+"""Run the bot as a front process and N worker processes sharded by user_id.
+
+The front receives Telegram webhook updates and hands each one to the
+worker that owns its user, so all updates of a user are handled by the
+same process in order. Workers keep their per-user stores under
+``shards/<index>/``; admins, plans and settings live in the shared
+``admin.json``, which only shard 0 writes. Admins are homed on shard 0:
+all their updates go there, including purchases and tickets of their own,
+and `ShardCluster.shard_of_user` points there for them, so shard 0 answers
+cross-shard views by querying every worker. Someone made admin after
+using the bot as a customer leaves that earlier data on their hash shard.
+
+The front serves one request at a time and only queues the update before
+answering, so updates reach each worker in the order they arrived.
+
+At startup the front registers ``WEBHOOK_URL`` (the public HTTPS address
+that reaches it) with Telegram's setWebhook, passing ``WEBHOOK_SECRET`` as
+the secret token it then checks on every update. Without ``WEBHOOK_URL``
+the webhook has to be set by hand with the same secret.
+
+    python shard_handler.py --workers 4 --port 8443
+    python shard_handler.py --workers 4 --synthetic 20000
+"""
+import os
+import json
+import time
+import zlib
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+import threading
+import multiprocessing
+import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Update types that carry the acting user in a "from" field
+USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query',
+               'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+               'my_chat_member', 'chat_member', 'chat_join_request', 'poll_answer')
+
+
+def shard_for(user_id, shard_count):
+    """Stable shard of a user; crc32 spreads sequential ids evenly"""
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+
+def home_shard(user_id, shard_count, is_admin):
+    """Shard holding a user's data; admins live on shard 0 next to the admin panel"""
+    if user_id is None or is_admin(user_id):
+        return 0
+    return shard_for(user_id, shard_count)
+
+
+def update_user_id(data):
+    """The user behind a raw update, or None for channel posts and polls"""
+    for field in USER_FIELDS:
+        if field in data:
+            user = data[field].get('from') or data[field].get('user')
+            return user['id'] if user else None
+    return None
+
+
+class ShardCluster:
+    """Query handlers registered on every shard, callable from any shard.
+
+    With a single shard, calls run locally and no queues are involved, so
+    code written against the cluster works unchanged in the normal
+    single-process mode.
+    """
+
+    def __init__(self, index=0, count=1, timeout=10, is_admin=None):
+        self.index = index
+        self.count = count
+        self.timeout = timeout
+        self.is_admin = is_admin or (lambda user_id: False)
+        self._handlers = {}
+        self._requests = None
+        self._replies = None
+        self._pending = {}
+        self._ids = itertools.count()
+        self._loop = None
+        self._threads = []
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def register(self, name):
+        """Expose ``handler(*args)`` (sync or async) to the other shards"""
+        def decorator(handler):
+            self._handlers[name] = handler
+            return handler
+        return decorator
+
+    def shard_of_user(self, user_id):
+        return home_shard(user_id, self.count, self.is_admin) if self.sharded else self.index
+
+    def shard_of_domain(self, domain):
+        """Shard holding reservations for a normalized domain"""
+        return shard_for(domain, self.count) if self.sharded else self.index
+
+    def shard_of_ticket(self, ticket_id):
+        return (int(ticket_id) - 1) % self.count
+
+    def attach(self, requests, replies):
+        """Use one request and one reply queue per shard for cross-process calls"""
+        self._requests = requests
+        self._replies = replies
+
+    async def _execute(self, name, args):
+        result = self._handlers[name](*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def call(self, shard, name, *args, timeout=None):
+        if shard == self.index or self._requests is None:
+            return await self._execute(name, args)
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._requests[shard].put((request_id, self.index, name, args))
+        try:
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def gather(self, name, *args):
+        """Call `name` on every shard; results are in shard order"""
+        return await asyncio.gather(*(self.call(shard, name, *args) for shard in range(self.count)))
+
+    def start(self):
+        if self._requests is None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._threads = [
+            threading.Thread(target=self._serve_requests, name='shard-requests', daemon=True),
+            threading.Thread(target=self._read_replies, name='shard-replies', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5):
+        if self._requests is None:
+            return
+        self._requests[self.index].put(None)
+        self._replies[self.index].put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    async def _respond(self, request_id, caller, name, args):
+        try:
+            reply = (request_id, True, await self._execute(name, args))
+        except Exception as e:
+            logger.exception(f"Shard query {name} failed")
+            reply = (request_id, False, f"{type(e).__name__}: {e}")
+        self._replies[caller].put(reply)
+
+    def _serve_requests(self):
+        while True:
+            request = self._requests[self.index].get()
+            if request is None:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._respond(*request), self._loop)
+            except RuntimeError:
+                # The loop closed before stop() reached this thread
+                return
+
+    def _resolve(self, request_id, ok, value):
+        future = self._pending.get(request_id)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(RuntimeError(value))
+
+    def _read_replies(self):
+        while True:
+            reply = self._replies[self.index].get()
+            if reply is None:
+                return
+            try:
+                self._loop.call_soon_threadsafe(self._resolve, *reply)
+            except RuntimeError:
+                return
+
+
+class WebhookFront:
+    """Accept webhook POSTs and queue each update on its user's worker"""
+
+    def __init__(self, update_queues, is_admin, secret_token=None, host='0.0.0.0', port=8443, path='/webhook'):
+        self.update_queues = update_queues
+        self.is_admin = is_admin
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.routed = [0] * len(update_queues)
+        self._server = None
+
+    def route(self, data):
+        shard = home_shard(update_user_id(data), len(self.update_queues), self.is_admin)
+        self.routed[shard] += 1
+        self.update_queues[shard].put(data)
+        return shard
+
+    def serve_forever(self):
+        front = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Requests are handled one by one, a stalled client must not hold the rest up
+            timeout = 10
+
+            def do_POST(self):
+                if self.path != front.path:
+                    self.send_error(404)
+                    return
+                if front.secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != front.secret_token:
+                    self.send_error(403)
+                    return
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                except ValueError:
+                    self.send_error(400)
+                    return
+                front.route(data)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        # Not threaded: concurrent handlers could queue a user's updates out of order
+        self._server = HTTPServer((self.host, self.port), Handler)
+        logger.info(f"Front listening on {self.host}:{self.port}{self.path}")
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+
+
+def set_webhook(token, url, secret_token=None):
+    """Have Telegram deliver updates to `url`, signed with `secret_token`"""
+    data = {'url': url}
+    if secret_token:
+        data['secret_token'] = secret_token
+    response = requests.post(f"https://api.telegram.org/bot{token}/setWebhook", json=data, timeout=10)
+    result = response.json()
+    if not result.get('ok'):
+        raise RuntimeError(f"setWebhook failed: {result.get('description', response.status_code)}")
+    logger.info(f"Webhook set to {url}")
+
+
+def run_worker(index, count, update_queue, requests, replies, results=None, dry_run=False):
+    os.environ['SHARD_INDEX'] = str(index)
+    os.environ['SHARD_COUNT'] = str(count)
+    import bot
+    bot.cluster.attach(requests, replies)
+    bot.run_shard_worker(update_queue, results, dry_run=dry_run)
+
+
+def start_workers(count, dry_run=False):
+    """Spawn `count` workers and return them with every queue they share.
+
+    The caller has to keep the queues referenced until the workers have
+    started, or they are freed before a worker can unpickle them.
+    """
+    context = multiprocessing.get_context('spawn')
+    update_queues = [context.Queue() for _ in range(count)]
+    requests = [context.Queue() for _ in range(count)]
+    replies = [context.Queue() for _ in range(count)]
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(i, count, update_queues[i], requests, replies, results, dry_run),
+                        name=f'shard-{i}')
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers, update_queues, requests, replies, results
+
+
+def stop_workers(workers, update_queues):
+    for update_queue in update_queues:
+        update_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+
+def synthetic_updates(total, users=1000, admin_id=None, seed=1):
+    """Yield raw updates resembling real traffic: /start, menu taps and text"""
+    rng = random.Random(seed)
+    callbacks = ['1:mm', '1:sp', '1:su', '1:mt', '1:up']
+    for update_id in range(1, total + 1):
+        user_id = admin_id if admin_id and rng.random() < 0.01 else 100000 + rng.randrange(users)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+        chat = {'id': user_id, 'type': 'private'}
+        kind = rng.random()
+        if kind < 0.2:
+            yield {'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user,
+                'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+            }}
+        elif kind < 0.8:
+            yield {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+                'data': rng.choice(callbacks),
+                'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': 'menu'}
+            }}
+        else:
+            yield {'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user,
+                'text': 'سلام، مشکل در اتصال به هاست دارم'
+            }}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot sharded over worker processes')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--host', default=os.getenv('WEBHOOK_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('WEBHOOK_PORT', '8443')))
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help='route N generated updates to dry-run workers instead of serving Telegram')
+    parser.add_argument('--users', type=int, default=1000, help='distinct users in synthetic traffic')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s', level=logging.INFO)
+    from dotenv import load_dotenv
+    from admin_handler import AdminPanel
+    load_dotenv()
+    admin_panel = AdminPanel(read_only=True)
+
+    def is_admin(user_id):
+        admin_panel.reload_if_changed()
+        return admin_panel.is_admin(user_id)
+
+    if not args.synthetic:
+        if os.getenv('WEBHOOK_URL'):
+            set_webhook(os.getenv('TELEGRAM_TOKEN'), os.getenv('WEBHOOK_URL'), os.getenv('WEBHOOK_SECRET'))
+        else:
+            logger.warning("WEBHOOK_URL is not set, register the webhook with setWebhook yourself")
+
+    workers, update_queues, requests, replies, results = start_workers(args.workers, dry_run=bool(args.synthetic))
+    front = WebhookFront(
+        update_queues,
+        is_admin=is_admin,
+        secret_token=os.getenv('WEBHOOK_SECRET'),
+        host=args.host,
+        port=args.port
+    )
+
+    try:
+        if args.synthetic:
+            admins = admin_panel.db['admins']
+            started = time.perf_counter()
+            for data in synthetic_updates(args.synthetic, args.users, int(admins[0]) if admins else None):
+                front.route(data)
+            logger.info(f"Routed {args.synthetic} updates in {time.perf_counter() - started:.2f}s: {front.routed}")
+            # Queues are FIFO, so the marker reaches each worker after its updates
+            for update_queue in update_queues:
+                update_queue.put({'control': 'report'})
+            report = results.get()
+            logger.info(f"Handled {report['updates']} updates from {report['senders']} users on "
+                        f"{report['shards']} shards in {time.perf_counter() - started:.2f}s, "
+                        f"{report['out_of_order']} out of order")
+        else:
+            front.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(workers, update_queues)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""Incremental, deduplicated backups of the bot's own JSON stores.
+
+Files are cut into content-defined chunks: a chunk ends after a line
+whose crc32 matches a mask, so inserting a record only changes the
+chunks around it and every other chunk keeps its hash. Chunks are stored
+once, zlib-compressed, under their sha256; a snapshot is a manifest
+listing the chunks of each file.
+
+    python state_backup.py list
+    python state_backup.py verify 20240801-030000
+    python state_backup.py restore 20240801-030000 --target restored/
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics_handler import REGISTRY
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+# A boundary every 2048 lines on average, about 64KB of indented JSON
+BOUNDARY_MASK = 0x7FF
+
+backup_duration = REGISTRY.histogram(
+    'bot_state_backup_duration_seconds', 'Time spent chunking and storing a state snapshot'
+)
+backup_bytes = REGISTRY.counter(
+    'bot_state_backup_stored_bytes', 'Compressed bytes of new chunks written by state snapshots'
+)
+
+
+def split_chunks(data, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=BOUNDARY_MASK):
+    """Yield memoryview chunks of `data`, cut at content-defined line ends"""
+    view = memoryview(data)
+    start = line_start = 0
+    while True:
+        end = data.find(b'\n', line_start) + 1
+        if not end:
+            break
+        # Lines longer than a chunk, e.g. compact JSON, are cut at fixed sizes
+        while end - start > max_size:
+            yield view[start:start + max_size]
+            start += max_size
+        if end - start >= min_size and zlib.crc32(view[line_start:end]) & mask == 0:
+            yield view[start:end]
+            start = end
+        line_start = end
+    while start < len(data):
+        yield view[start:start + max_size]
+        start += max_size
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class StateBackup:
+    """Chunk repository plus snapshot manifests in `directory`"""
+
+    def __init__(self, directory='state_backups', retention_days=30):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.chunk_dir = os.path.join(directory, 'chunks')
+        self.snapshot_dir = os.path.join(directory, 'snapshots')
+        # Snapshots and pruning both touch chunks; never run them concurrently
+        self._lock = threading.Lock()
+        # path -> (inode, size, mtime, entry) from the last snapshot; files
+        # are replaced on every save, so an unchanged stat means unchanged data
+        self._last_entries = {}
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def _manifest_path(self, snapshot_id):
+        return os.path.join(self.snapshot_dir, f"{snapshot_id}.json")
+
+    def freeze(self, files, tag):
+        """Pin the current version of each file with a hard link.
+
+        Stores replace their files atomically, so a link keeps the exact
+        version it was taken from; for append-only logs the size at freeze
+        time is recorded and later appends are ignored. Linking is a few
+        syscalls per file, which makes this cheap enough to call on the
+        event loop, and all files are frozen at the same point between two
+        handler steps.
+        """
+        frozen = {}
+        for path in files:
+            link = f"{path}.{tag}.frozen"
+            if os.path.exists(link):
+                # Left over by a crash during an earlier snapshot
+                os.remove(link)
+            try:
+                os.link(path, link)
+            except FileNotFoundError:
+                continue
+            frozen[path] = (link, os.stat(link).st_size)
+        return frozen
+
+    def store(self, frozen):
+        """Chunk and store frozen files; returns their manifest entries and stats"""
+        started = time.perf_counter()
+        entries = {}
+        stats = {'files': 0, 'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'new_bytes': 0}
+        last_entries = {}
+        with self._lock:
+            try:
+                for path, (link, size) in frozen.items():
+                    stat = os.stat(link)
+                    key = (stat.st_ino, size, stat.st_mtime_ns)
+                    cached = self._last_entries.get(path)
+                    if cached and cached[0] == key:
+                        entries[path] = cached[1]
+                        last_entries[path] = cached
+                        stats['files'] += 1
+                        stats['bytes'] += cached[1]['size']
+                        stats['chunks'] += len(cached[1]['chunks'])
+                        continue
+                    with open(link, 'rb') as f:
+                        data = f.read(size)
+                    chunks = []
+                    for chunk in split_chunks(data):
+                        digest = hashlib.sha256(chunk).hexdigest()
+                        chunks.append(digest)
+                        chunk_path = self._chunk_path(digest)
+                        if not os.path.exists(chunk_path):
+                            written = self._write_chunk(chunk_path, zlib.compress(chunk, 6))
+                            stats['new_chunks'] += 1
+                            stats['new_bytes'] += written
+                    entries[path] = {
+                        'size': len(data),
+                        'sha256': hashlib.sha256(data).hexdigest(),
+                        'chunks': chunks
+                    }
+                    last_entries[path] = (key, entries[path])
+                    stats['files'] += 1
+                    stats['bytes'] += len(data)
+                    stats['chunks'] += len(chunks)
+            finally:
+                for link, _ in frozen.values():
+                    os.remove(link)
+            self._last_entries = last_entries
+        backup_duration.observe(time.perf_counter() - started)
+        backup_bytes.inc(amount=stats['new_bytes'])
+        return entries, stats
+
+    def _write_chunk(self, chunk_path, payload):
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        # Shards share the repository and may store the same chunk at once
+        tmp_file = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_file, chunk_path)
+        return len(payload)
+
+    def write_manifest(self, snapshot_id, entries, stats):
+        manifest = {
+            'snapshot_id': snapshot_id,
+            'created_at': datetime.now().isoformat(),
+            'files': entries,
+            'stats': stats
+        }
+        tmp_file = self._manifest_path(snapshot_id) + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_file, self._manifest_path(snapshot_id))
+        return manifest
+
+    def list_snapshots(self):
+        """Snapshot ids, oldest first"""
+        return sorted(name[:-5] for name in os.listdir(self.snapshot_dir) if name.endswith('.json'))
+
+    def load_manifest(self, snapshot_id):
+        with open(self._manifest_path(snapshot_id)) as f:
+            return json.load(f)
+
+    def prune(self, now=None):
+        """Drop snapshots past retention, keeping the newest, and their unused chunks"""
+        cutoff = (now or datetime.now()) - timedelta(days=self.retention_days)
+        with self._lock:
+            snapshot_ids = self.list_snapshots()
+            removed = 0
+            for snapshot_id in snapshot_ids[:-1]:
+                if datetime.fromisoformat(self.load_manifest(snapshot_id)['created_at']) < cutoff:
+                    os.remove(self._manifest_path(snapshot_id))
+                    removed += 1
+            if not removed:
+                return {'snapshots': 0, 'chunks': 0}
+
+            referenced = set()
+            for snapshot_id in self.list_snapshots():
+                for entry in self.load_manifest(snapshot_id)['files'].values():
+                    referenced.update(entry['chunks'])
+            deleted = 0
+            for prefix in os.listdir(self.chunk_dir):
+                for digest in os.listdir(os.path.join(self.chunk_dir, prefix)):
+                    if digest not in referenced:
+                        os.remove(os.path.join(self.chunk_dir, prefix, digest))
+                        deleted += 1
+            return {'snapshots': removed, 'chunks': deleted}
+
+    def _read_chunk(self, digest):
+        with open(self._chunk_path(digest), 'rb') as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise IntegrityError(f"chunk {digest} is corrupt")
+        return chunk
+
+    def restore(self, snapshot_id, target=None, workers=8):
+        """Verify a snapshot and, given a `target` directory, write its files there.
+
+        Chunks are read and checked in parallel (zlib and hashlib release
+        the GIL). Files are only put in place once every file has been
+        verified, so a failed restore leaves the target untouched.
+        """
+        manifest = self.load_manifest(snapshot_id)
+        staged = []
+        try:
+            with ThreadPoolExecutor(workers) as pool:
+                for path, entry in manifest['files'].items():
+                    digest = hashlib.sha256()
+                    out = None
+                    if target is not None:
+                        destination = os.path.join(target, path)
+                        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+                        out = open(destination + '.restoring', 'wb')
+                        staged.append(destination)
+                    try:
+                        for chunk in pool.map(self._read_chunk, entry['chunks']):
+                            digest.update(chunk)
+                            if out:
+                                out.write(chunk)
+                    finally:
+                        if out:
+                            out.close()
+                    if digest.hexdigest() != entry['sha256']:
+                        raise IntegrityError(f"{path} does not match its checksum")
+        except BaseException:
+            for destination in staged:
+                if os.path.exists(destination + '.restoring'):
+                    os.remove(destination + '.restoring')
+            raise
+        for destination in staged:
+            os.replace(destination + '.restoring', destination)
+        return {'files': len(manifest['files']), 'bytes': sum(e['size'] for e in manifest['files'].values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect, verify and restore state snapshots')
+    parser.add_argument('--directory', default=os.getenv('STATE_BACKUP_DIR', 'state_backups'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list')
+    verify = commands.add_parser('verify')
+    verify.add_argument('snapshot_id')
+    restore = commands.add_parser('restore', help='stop the bot first when restoring over its data')
+    restore.add_argument('snapshot_id')
+    restore.add_argument('--target', default='.')
+    args = parser.parse_args()
+
+    backup = StateBackup(args.directory)
+    if args.command == 'list':
+        for snapshot_id in backup.list_snapshots():
+            stats = backup.load_manifest(snapshot_id)['stats']
+            print(f"{snapshot_id}  {stats['files']} files  {stats['bytes'] / 1024 / 1024:.1f} MB  "
+                  f"+{stats['new_bytes'] / 1024:.0f} KB new")
+        return
+
+    started = time.perf_counter()
+    try:
+        result = backup.restore(args.snapshot_id, args.target if args.command == 'restore' else None)
+    except (IntegrityError, OSError, zlib.error) as e:
+        print(f"Snapshot {args.snapshot_id} is damaged: {e}")
+        sys.exit(1)
+    action = 'Restored' if args.command == 'restore' else 'Verified'
+    print(f"{action} {result['files']} files ({result['bytes'] / 1024 / 1024:.1f} MB) "
+          f"in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
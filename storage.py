@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import pickle
+import logging
+import threading
+
+from metrics_handler import REGISTRY
+from tracing_handler import span
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIX = '.snapshot'
+
+save_duration = REGISTRY.histogram(
+    'bot_store_save_duration_seconds', 'Time spent serializing and writing a JSON store',
+    labels=('store',)
+)
+save_bytes = REGISTRY.counter(
+    'bot_store_written_bytes', 'Bytes written by JSON store saves', labels=('store',)
+)
+
+
+def store_name(db_file):
+    return os.path.splitext(os.path.basename(db_file))[0]
+
+
+def save_json(db_file, data):
+    """Write a store to disk, recording duration and size per store.
+
+    The file is replaced atomically, so readers in other threads and
+    hard links taken by state backups always see a complete version.
+    """
+    store = store_name(db_file)
+    started = time.perf_counter()
+    with span(f"store.{store}.dumps"):
+        payload = json.dumps(data, indent=2)
+    with span(f"store.{store}.write"):
+        tmp_file = db_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(payload)
+        os.replace(tmp_file, db_file)
+    save_duration.observe(time.perf_counter() - started, store)
+    save_bytes.inc(store, amount=len(payload))
+
+
+def _json_stamp(db_file):
+    stat = os.stat(db_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def save_snapshot(db_file, state):
+    """Pickle `state` next to `db_file`, stamped with the JSON file's size and mtime"""
+    with span(f"store.{store_name(db_file)}.snapshot"):
+        payload = pickle.dumps((_json_stamp(db_file), state), protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_file = db_file + SNAPSHOT_SUFFIX + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_file, db_file + SNAPSHOT_SUFFIX)
+
+
+def load_snapshot(db_file):
+    """State saved by save_snapshot, or None if missing or the JSON changed since"""
+    try:
+        with open(db_file + SNAPSHOT_SUFFIX, 'rb') as f:
+            stamp, state = pickle.load(f)
+        if stamp != _json_stamp(db_file):
+            return None
+        return state
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable snapshot of {db_file}: {e}")
+        return None
+
+
+class SnapshotStore:
+    """Mixin for JSON stores whose loaded state can be cached in a snapshot.
+
+    The snapshot holds the parsed records together with the indexes built
+    from them, so a restart skips both JSON parsing and index rebuilding.
+    It is only used while the JSON file is exactly as it was when the
+    snapshot was taken; the JSON file remains the source of truth.
+    Attributes the constructor sets before loading, such as file paths and
+    the shard layout, keep their new values.
+    """
+
+    # Attributes that are wired up at runtime, e.g. listeners and clients
+    snapshot_exclude = ()
+
+    def _load_snapshot(self):
+        state = load_snapshot(self.db_file)
+        if state is None:
+            return False
+        self.__dict__.update({key: value for key, value in state.items() if key not in self.__dict__})
+        return True
+
+    def save_snapshot(self):
+        save_snapshot(self.db_file, {
+            key: value for key, value in self.__dict__.items() if key not in self.snapshot_exclude
+        })
+
+
+class LazyStore:
+    """Build an object in a background thread, blocking on first use.
+
+    Attribute access waits for the loader, so module-level stores can be
+    declared without paying for their loading at import time.
+    """
+
+    def __init__(self, factory, name=None):
+        object.__setattr__(self, '_name', name or getattr(factory, '__name__', 'store'))
+        object.__setattr__(self, '_loaded', threading.Event())
+        object.__setattr__(self, '_value', None)
+        object.__setattr__(self, '_error', None)
+        thread = threading.Thread(target=self._load, args=(factory,), name=f"load-{self._name}", daemon=True)
+        thread.start()
+
+    def _load(self, factory):
+        try:
+            object.__setattr__(self, '_value', factory())
+        except BaseException as e:
+            object.__setattr__(self, '_error', e)
+        finally:
+            self._loaded.set()
+
+    def wait(self):
+        """The loaded object; re-raises the loader's exception"""
+        self._loaded.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.wait(), name, value)
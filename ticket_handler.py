@@ -1,10 +1,20 @@
 import json
+from collections import Counter
 from datetime import datetime
+from storage import save_json, SnapshotStore
+from search_index import InvertedIndex
 
-class TicketSystem:
-    def __init__(self, db_file='tickets.json'):
+class TicketSystem(SnapshotStore):
+    snapshot_exclude = ('_ticket_listeners',)
+
+    def __init__(self, db_file='tickets.json', shard_index=0, shard_count=1):
+        """Shards number their tickets index+1, index+1+count, ... so ids stay unique"""
         self.db_file = db_file
-        self._load_db()
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self._ticket_listeners = []
+        if not self._load_snapshot():
+            self._load_db()
 
     def _load_db(self):
         try:
@@ -16,15 +26,69 @@ class TicketSystem:
                 'last_ticket_id': 0
             }
             self._save_db()
+        self._rebuild_stats()
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._tickets_by_id = {}
+        self._index = InvertedIndex()
+        for ticket in self.db['tickets']:
+            self._tickets_by_id[ticket['ticket_id']] = ticket
+            self._index.add(ticket['ticket_id'], ticket['subject'])
+            for message in ticket['messages']:
+                self._index.add(ticket['ticket_id'], message['message'])
+
+    def add_ticket_listener(self, listener):
+        """Call `listener(ticket)` whenever a ticket is created or changed"""
+        self._ticket_listeners.append(listener)
+
+    def _notify_ticket_change(self, ticket):
+        for listener in self._ticket_listeners:
+            listener(ticket)
+
+    def _rebuild_stats(self):
+        self._by_status = Counter()
+        self._awaiting_reply = set()
+        self._responded = set()
+        self._response_time_total = 0.0
+        for ticket in self.db['tickets']:
+            self._by_status[ticket['status']] += 1
+            self._track_awaiting(ticket)
+            for message in ticket['messages']:
+                if message['is_admin']:
+                    self._record_first_response(ticket, message)
+                    break
+
+    def is_awaiting_reply(self, ticket):
+        return ticket['ticket_id'] in self._awaiting_reply
+
+    def _track_awaiting(self, ticket):
+        # A ticket waits for staff while it is open and the customer spoke last
+        if ticket['status'] == 'open' and not ticket['messages'][-1]['is_admin']:
+            self._awaiting_reply.add(ticket['ticket_id'])
+        else:
+            self._awaiting_reply.discard(ticket['ticket_id'])
+
+    def _record_first_response(self, ticket, message):
+        if ticket['ticket_id'] in self._responded:
+            return
+        self._responded.add(ticket['ticket_id'])
+        elapsed = datetime.fromisoformat(message['timestamp']) - datetime.fromisoformat(ticket['created_at'])
+        self._response_time_total += elapsed.total_seconds()
+
+    def _set_status(self, ticket, status):
+        self._by_status[ticket['status']] -= 1
+        ticket['status'] = status
+        self._by_status[status] += 1
+        self._track_awaiting(ticket)
 
     def _save_db(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.db, f, indent=2)
+        save_json(self.db_file, self.db)
 
     def create_ticket(self, user_id, subject, message):
         self.db['last_ticket_id'] += 1
         ticket = {
-            'ticket_id': self.db['last_ticket_id'],
+            'ticket_id': (self.db['last_ticket_id'] - 1) * self.shard_count + self.shard_index + 1,
             'user_id': user_id,
             'subject': subject,
             'status': 'open',
@@ -38,52 +102,98 @@ class TicketSystem:
             'updated_at': datetime.now().isoformat()
         }
         self.db['tickets'].append(ticket)
+        self._tickets_by_id[ticket['ticket_id']] = ticket
+        self._index.add(ticket['ticket_id'], subject)
+        self._index.add(ticket['ticket_id'], message)
+        self._by_status['open'] += 1
+        self._track_awaiting(ticket)
         self._save_db()
+        self._notify_ticket_change(ticket)
         return ticket
 
     def add_message(self, ticket_id, user_id, message, is_admin=False):
-        for ticket in self.db['tickets']:
-            if ticket['ticket_id'] == ticket_id:
-                ticket['messages'].append({
-                    'user_id': user_id,
-                    'message': message,
-                    'timestamp': datetime.now().isoformat(),
-                    'is_admin': is_admin
-                })
-                ticket['updated_at'] = datetime.now().isoformat()
-                self._save_db()
-                return ticket
-        return None
+        ticket = self.get_ticket(ticket_id)
+        if not ticket:
+            return None
+        ticket['messages'].append({
+            'user_id': user_id,
+            'message': message,
+            'timestamp': datetime.now().isoformat(),
+            'is_admin': is_admin
+        })
+        self._index.add(ticket_id, message)
+        if is_admin:
+            self._record_first_response(ticket, ticket['messages'][-1])
+        self._track_awaiting(ticket)
+        ticket['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+        self._notify_ticket_change(ticket)
+        return ticket
 
     def close_ticket(self, ticket_id):
-        for ticket in self.db['tickets']:
-            if ticket['ticket_id'] == ticket_id:
-                ticket['status'] = 'closed'
-                ticket['updated_at'] = datetime.now().isoformat()
-                self._save_db()
-                return ticket
-        return None
+        ticket = self.get_ticket(ticket_id)
+        if not ticket:
+            return None
+        self._set_status(ticket, 'closed')
+        ticket['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+        self._notify_ticket_change(ticket)
+        return ticket
 
     def reopen_ticket(self, ticket_id):
-        for ticket in self.db['tickets']:
-            if ticket['ticket_id'] == ticket_id:
-                ticket['status'] = 'open'
-                ticket['updated_at'] = datetime.now().isoformat()
-                self._save_db()
-                return ticket
-        return None
+        ticket = self.get_ticket(ticket_id)
+        if not ticket:
+            return None
+        self._set_status(ticket, 'open')
+        ticket['reopen_count'] = ticket.get('reopen_count', 0) + 1
+        ticket['updated_at'] = datetime.now().isoformat()
+        self._save_db()
+        self._notify_ticket_change(ticket)
+        return ticket
 
     def get_user_tickets(self, user_id):
         return [ticket for ticket in self.db['tickets'] if ticket['user_id'] == user_id]
 
     def get_ticket(self, ticket_id):
-        for ticket in self.db['tickets']:
-            if ticket['ticket_id'] == ticket_id:
-                return ticket
-        return None
+        return self._tickets_by_id.get(ticket_id)
+
+    def search(self, query, status=None, user_id=None, date_from=None, date_to=None, limit=10, offset=0,
+               with_scores=False):
+        """Find tickets whose subject or messages contain every word of `query`.
+
+        Dates are ISO strings (``YYYY-MM-DD``) compared with the creation
+        date, both ends inclusive. Returns ``(total, tickets)`` with the
+        best matches first and newer tickets winning ties, as
+        ``(score, ticket)`` pairs if `with_scores` is set.
+        """
+        matches = []
+        for ticket_id, score in self._index.search(query).items():
+            ticket = self._tickets_by_id[ticket_id]
+            if status and ticket['status'] != status:
+                continue
+            if user_id is not None and ticket['user_id'] != user_id:
+                continue
+            created = ticket['created_at'][:10]
+            if (date_from and created < date_from) or (date_to and created > date_to):
+                continue
+            matches.append((score, ticket_id))
+        matches.sort(reverse=True)
+        page = [(score, self._tickets_by_id[ticket_id]) for score, ticket_id in matches[offset:offset + limit]]
+        return len(matches), page if with_scores else [ticket for _, ticket in page]
 
     def get_open_tickets(self):
         return [ticket for ticket in self.db['tickets'] if ticket['status'] == 'open']
 
     def get_closed_tickets(self):
         return [ticket for ticket in self.db['tickets'] if ticket['status'] == 'closed']
+
+    def get_stats(self):
+        """Ticket counts and response times, maintained by the mutators"""
+        responded = len(self._responded)
+        return {
+            'total': len(self.db['tickets']),
+            'by_status': {status: count for status, count in self._by_status.items() if count},
+            'awaiting_reply': len(self._awaiting_reply),
+            'responded': responded,
+            'avg_first_response': self._response_time_total / responded if responded else None
+        }
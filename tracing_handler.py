@@ -0,0 +1,174 @@
+import io
+import sys
+import time
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_depth = contextvars.ContextVar('current_depth', default=0)
+
+
+class Trace:
+    """Spans recorded while handling one update.
+
+    The trace lives in a context variable, so tasks and `asyncio.to_thread`
+    calls started by a handler record into the same trace.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []
+
+    def add(self, name, started, duration, depth):
+        self.spans.append((started - self.started, duration, depth, name))
+
+    def format(self):
+        lines = [f"{self.name} took {self.duration * 1000:.1f}ms"]
+        for offset, duration, depth, name in sorted(self.spans):
+            lines.append(f"{'  ' * (depth + 1)}{name}: {duration * 1000:.1f}ms (+{offset * 1000:.1f}ms)")
+        return "\n".join(lines)
+
+
+@contextmanager
+def span(name):
+    """Time a block as part of the current trace; a no-op outside of one"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    depth = _current_depth.get()
+    token = _current_depth.set(depth + 1)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started, depth)
+        _current_depth.reset(token)
+
+
+def describe_update(update):
+    if update.callback_query:
+        return f"callback {update.callback_query.data!r}"
+    if update.message and update.message.text and update.message.text.startswith('/'):
+        return f"command {update.message.text.split()[0]}"
+    if update.message:
+        return "message"
+    return f"update {update.update_id}"
+
+
+class TracedApplication(Application):
+    """Application that traces every update and logs the slow ones.
+
+    Use with ``Application.builder().application_class(TracedApplication,
+    kwargs={'slow_threshold': 1.0})``.
+    """
+
+    def __init__(self, *, slow_threshold=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.slow_threshold = slow_threshold
+
+    async def process_update(self, update):
+        trace = Trace(describe_update(update) if hasattr(update, 'update_id') else type(update).__name__)
+        token = _current_trace.set(trace)
+        try:
+            await super().process_update(update)
+        finally:
+            trace.duration = time.perf_counter() - trace.started
+            _current_trace.reset(token)
+            if trace.duration >= self.slow_threshold:
+                logger.warning(f"Slow update: {trace.format()}")
+
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API calls as spans"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        with span(f"telegram.{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, request_data, **kwargs)
+
+
+class SamplingProfiler:
+    """Sample the stacks of all threads at a fixed interval.
+
+    Unlike cProfile it does not slow down every function call, so it can
+    run on a live bot. Samples are kept as collapsed stacks, the input
+    format of flamegraph tools.
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def summary(self, top=30):
+        """Return a text report: hottest functions, then collapsed stacks"""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+
+        out = io.StringIO()
+        duration = time.time() - self.started_at if self.started_at else 0
+        out.write(f"{self.samples} samples over {duration:.1f}s every {self.interval * 1000:.0f}ms\n\n")
+        out.write("Self samples:\n")
+        for frame, count in own.most_common(top):
+            out.write(f"{count:8d}  {frame}\n")
+        out.write("\nTotal samples (including callees):\n")
+        for frame, count in total.most_common(top):
+            out.write(f"{count:8d}  {frame}\n")
+        out.write("\nCollapsed stacks:\n")
+        for stack, count in self.stacks.most_common():
+            out.write(f"{stack} {count}\n")
+        return out.getvalue()
@@ -0,0 +1,111 @@
+import time
+
+from deadline_queue import DeadlineQueue
+from hosting_handler import parse_datetime
+
+HOUR = 3600
+
+
+class TriageQueue:
+    """Open tickets waiting on staff, most urgent first.
+
+    The priority of a ticket is how long the customer has been waiting plus
+    a bonus for paying customers and for each reopen. Every waiting ticket
+    ages at the same rate, so ordering by ``waiting_since - bonus`` gives
+    the same order at any moment and a heap key never has to be refreshed
+    over time; it only changes when the ticket does.
+
+    Admins take tickets with `next_ticket` or `claim`. A claimed ticket
+    leaves the heap until it is answered, released or the claim expires,
+    so two admins never get the same ticket.
+    """
+
+    def __init__(self, ticket_system, is_paying=None, paying_bonus=4 * HOUR,
+                 reopen_bonus=2 * HOUR, claim_ttl=15 * 60):
+        self.ticket_system = ticket_system
+        self.is_paying = is_paying or (lambda user_id: False)
+        self.paying_bonus = paying_bonus
+        self.reopen_bonus = reopen_bonus
+        self.claim_ttl = claim_ttl
+        self.queue = DeadlineQueue()
+        self._claims = {}
+        ticket_system.add_ticket_listener(self.track)
+        self.rebuild()
+
+    def rebuild(self):
+        for ticket in self.ticket_system.get_open_tickets():
+            self.track(ticket)
+
+    def waiting_since(self, ticket):
+        """Time of the first customer message since the last staff reply"""
+        since = None
+        for message in reversed(ticket['messages']):
+            if message['is_admin']:
+                break
+            since = message['timestamp']
+        return parse_datetime(since or ticket['created_at']).timestamp()
+
+    def priority_key(self, ticket):
+        bonus = ticket.get('reopen_count', 0) * self.reopen_bonus
+        if self.is_paying(ticket['user_id']):
+            bonus += self.paying_bonus
+        return self.waiting_since(ticket) - bonus
+
+    def track(self, ticket):
+        ticket_id = ticket['ticket_id']
+        if not self.ticket_system.is_awaiting_reply(ticket):
+            # Answered or closed, the claim has done its job
+            self.queue.remove(ticket_id)
+            self._claims.pop(ticket_id, None)
+            return
+        key = self.priority_key(ticket)
+        if ticket_id in self._claims:
+            self._claims[ticket_id]['key'] = key
+        else:
+            self.queue.push(ticket_id, key)
+
+    def _expire_claims(self):
+        now = time.time()
+        for ticket_id, claim in list(self._claims.items()):
+            if claim['expires_at'] <= now:
+                self.release(ticket_id)
+
+    def claim(self, ticket_id, admin_id):
+        """Reserve a ticket for an admin; False if another admin holds it"""
+        self._expire_claims()
+        claim = self._claims.get(ticket_id)
+        if claim and claim['admin_id'] != admin_id:
+            return False
+        if not claim:
+            key = self.queue.get(ticket_id)
+            self.queue.remove(ticket_id)
+            claim = self._claims[ticket_id] = {'admin_id': admin_id, 'key': key}
+        claim['expires_at'] = time.time() + self.claim_ttl
+        return True
+
+    def release(self, ticket_id):
+        claim = self._claims.pop(ticket_id, None)
+        if claim and claim['key'] is not None:
+            self.queue.push(ticket_id, claim['key'])
+
+    def claimed_by(self, ticket_id):
+        self._expire_claims()
+        claim = self._claims.get(ticket_id)
+        return claim['admin_id'] if claim else None
+
+    def next_ticket(self, admin_id):
+        """Claim and return the most urgent unclaimed ticket, or None"""
+        self._expire_claims()
+        item = self.queue.peek_item()
+        if item is None:
+            return None
+        self.claim(item[1], admin_id)
+        return self.ticket_system.get_ticket(item[1])
+
+    def top(self, n=10):
+        """``(priority key, ticket)`` of the `n` most urgent unclaimed tickets"""
+        self._expire_claims()
+        return [(key, self.ticket_system.get_ticket(ticket_id)) for key, ticket_id in self.queue.smallest(n)]
+
+    def get_stats(self):
+        return {'waiting': len(self.queue), 'claimed': len(self._claims)}